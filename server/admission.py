@@ -0,0 +1,380 @@
+"""
+Admission control in front of the OpenAI-backed routes.
+
+Every request to an admitted route goes through three checks before its
+handler runs:
+
+1. Rate limit. Each client has a token bucket refilled at ADMISSION_RATE
+   requests per second, holding up to ADMISSION_BURST. A client is its
+   address: headers a client sets itself (X-Client-Id, API keys nobody
+   verifies) would let it take a fresh bucket per request. Behind a reverse
+   proxy, list the proxy addresses or networks in ADMISSION_TRUSTED_PROXIES;
+   for requests from them the client is the last X-Forwarded-For hop that
+   isn't a trusted proxy. An empty bucket gets an immediate 429 with
+   Retry-After set to when the next token is due. ADMISSION_RATE=0 turns the
+   rate limit off.
+
+2. Concurrency. At most `limit` admitted requests run at a time. The others
+   wait in one queue ordered by priority class, interactive routes (OCR,
+   solving) ahead of batch ones (quizzes, grading, worksheets, jobs), so a
+   burst of quiz generation can't hold up a student waiting on a solution.
+   Each route may have at most ADMISSION_QUEUE requests waiting (override per
+   route with e.g. ADMISSION_QUEUE_SOLVE_MATH=64); past that the request gets
+   an immediate 503 with Retry-After, as does one that waited longer than its
+   class allows (ADMISSION_WAIT_INTERACTIVE, ADMISSION_WAIT_BATCH).
+
+3. Adaptive limit. `limit` starts at ADMISSION_CONCURRENCY and follows the
+   upstream responses seen by the OpenAI client (see `response_hook`): every
+   429 from OpenAI cuts it by ADMISSION_BACKOFF (at most once per
+   ADMISSION_BACKOFF_INTERVAL seconds, since one overload shows up as a burst
+   of 429s), down to ADMISSION_MIN_CONCURRENCY, and every success raises it
+   by 1/limit, so it grows back by about one per `limit` successes.
+
+POST /jobs is only rate limited; the job itself is admitted when it runs,
+as a batch request that isn't charged to the client again (see `job`). A
+job has nobody to give a 503 to, so it waits for its slot however long that
+takes, outside the route queues; the job workers bound how many wait.
+State is per process: under gunicorn each worker has its own buckets and
+limit, so the rate a client gets is ADMISSION_RATE times the worker count.
+"""
+import asyncio
+import contextvars
+import heapq
+import ipaddress
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+ADMISSION_ENABLED = os.getenv("ADMISSION", "1") == "1"
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "5"))
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "20"))
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "64"))
+ADMISSION_MIN_CONCURRENCY = int(os.getenv("ADMISSION_MIN_CONCURRENCY", "4"))
+ADMISSION_QUEUE = int(os.getenv("ADMISSION_QUEUE", "32"))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", "0.75"))
+ADMISSION_BACKOFF_INTERVAL = float(os.getenv("ADMISSION_BACKOFF_INTERVAL", "2"))
+# Reverse proxies whose X-Forwarded-For is believed: addresses or networks, comma separated
+ADMISSION_TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
+# Buckets are kept for at most this many clients
+ADMISSION_MAX_CLIENTS = int(os.getenv("ADMISSION_MAX_CLIENTS", "10000"))
+
+INTERACTIVE = 0
+BATCH = 1
+MAX_WAIT = {
+    INTERACTIVE: float(os.getenv("ADMISSION_WAIT_INTERACTIVE", "5")),
+    BATCH: float(os.getenv("ADMISSION_WAIT_BATCH", "30")),
+}
+
+# Route (as registered, with its leading slash) -> priority class
+ROUTE_CLASSES = {
+    "/latex": INTERACTIVE,
+    "/latex/upload": INTERACTIVE,
+    "/text": INTERACTIVE,
+    "/text/upload": INTERACTIVE,
+    "/solve-problem": INTERACTIVE,
+    "/solve-problem/stream": INTERACTIVE,
+    "/solve-math": INTERACTIVE,
+    "/solve-math/stream": INTERACTIVE,
+    "/generate-quiz": BATCH,
+    "/evaluate-answers": BATCH,
+    "/worksheet": BATCH,
+}
+# Routes that are rate limited but take no slot
+RATE_LIMITED_ONLY = ("/jobs",)
+
+_job = contextvars.ContextVar("admission_job", default=False)
+
+
+class Rejected(Exception):
+    """Raised when a request is turned away; carries the HTTP status and Retry-After seconds."""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+@contextmanager
+def job():
+    """
+    Marks the requests dispatched inside the block as a job's: batch priority,
+    and not charged to the client, who paid when submitting it.
+    """
+    token = _job.set(True)
+    try:
+        yield
+    finally:
+        _job.reset(token)
+
+
+def _trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return False
+    return any(ip in network for network in ADMISSION_TRUSTED_PROXIES)
+
+
+def client_key(headers, remote_addr):
+    """
+    The rate-limit identity of a request: its address, or the address a
+    trusted proxy forwarded it for.
+    """
+    address = remote_addr or "unknown"
+    if _trusted_proxy(address):
+        # Hops are appended left to right, so only the ones our proxies added can be believed
+        for hop in reversed((headers.get("X-Forwarded-For") or "").split(",")):
+            address = hop.strip() or address
+            if not _trusted_proxy(address):
+                break
+    return f"addr:{address}"
+
+
+def _route_queue(route):
+    name = route.strip("/").upper().replace("-", "_").replace("/", "_")
+    return int(os.getenv(f"ADMISSION_QUEUE_{name}", str(ADMISSION_QUEUE)))
+
+
+class _Waiter:
+    __slots__ = ("priority", "route", "granted", "cancelled", "wake")
+
+    def __init__(self, priority, route, wake):
+        self.priority = priority
+        self.route = route
+        self.granted = False
+        self.cancelled = False
+        self.wake = wake
+
+
+class AdmissionController:
+    """
+    Token buckets, the priority queue and the adaptive concurrency limit.
+
+    `acquire` (threads) and `aacquire` (asyncio) return a ticket for the
+    caller to pass to `release` once the response is done, or None for a
+    request that took no slot.
+    """
+
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, concurrency=ADMISSION_CONCURRENCY,
+                 min_concurrency=ADMISSION_MIN_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.max_limit = concurrency
+        self.min_limit = min(min_concurrency, concurrency)
+        self.queue_sizes = {route: _route_queue(route) for route in ROUTE_CLASSES}
+        self._reset()
+        # A forked worker must not inherit the parent's lock or its queue
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._waiting = {}
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._last_backoff = 0.0
+        self._hold_seconds = 1.0
+        self.admitted = 0
+        self.queued = 0
+        self.rate_limited = 0
+        self.queue_full = 0
+        self.timed_out = 0
+        self.upstream_429 = 0
+        self.backoffs = 0
+
+    def _take_token(self, client):
+        if self.rate <= 0 or _job.get():
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[client] = (tokens, now)
+                self.rate_limited += 1
+                raise Rejected("Too many requests. Please slow down.", 429, (1 - tokens) / self.rate)
+            # Re-inserted last, so the dict stays in least recently used order
+            self._buckets[client] = (tokens - 1, now)
+            if len(self._buckets) > ADMISSION_MAX_CLIENTS:
+                del self._buckets[next(iter(self._buckets))]
+
+    def _enter(self, route, wake):
+        """Takes a slot, or queues a waiter; returns the waiter or None when admitted."""
+        is_job = _job.get()
+        priority = BATCH if is_job else ROUTE_CLASSES[route]
+        # Jobs wait apart, so they never fill a route's queue
+        queue = "/jobs" if is_job else route
+        with self._lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+            if not is_job and self._waiting.get(route, 0) >= self.queue_sizes[route]:
+                self.queue_full += 1
+                raise Rejected("The server is busy. Please try again shortly.", 503, self._retry_after())
+            waiter = _Waiter(priority, queue, wake)
+            heapq.heappush(self._heap, (priority, next(self._sequence), waiter))
+            self._waiting[queue] = self._waiting.get(queue, 0) + 1
+            self.queued += 1
+            return waiter
+
+    def _cancel(self, waiter):
+        """Takes a waiter out of the queue; returns True if it had been granted a slot meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self._waiting[waiter.route] -= 1
+            return False
+
+    @staticmethod
+    def _max_wait(waiter):
+        # None: a job waits until it is granted a slot
+        return None if _job.get() else MAX_WAIT[waiter.priority]
+
+    def _timed_out(self):
+        with self._lock:
+            self.timed_out += 1
+            retry_after = self._retry_after()
+        raise Rejected("The server is busy. Please try again shortly.", 503, retry_after)
+
+    def _grant(self):
+        # Called with the lock held
+        woken = []
+        while self._heap and self.in_flight < int(self.limit):
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self._waiting[waiter.route] -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            woken.append(waiter)
+        return woken
+
+    def _retry_after(self):
+        # Roughly how long until the queue ahead has drained
+        return self._hold_seconds * (1 + len(self._heap) / max(1, int(self.limit)))
+
+    def acquire(self, route, client):
+        """
+        Admits a request, blocking while it is queued.
+
+        Returns:
+            float or None: The ticket for `release`.
+
+        Raises:
+            Rejected: With 429 when the client is over its rate, 503 when the
+                route's queue is full or the wait ran out (never for a job).
+        """
+        if route not in ROUTE_CLASSES and route not in RATE_LIMITED_ONLY:
+            return None
+        self._take_token(client)
+        if route in RATE_LIMITED_ONLY:
+            return None
+        event = threading.Event()
+        waiter = self._enter(route, event.set)
+        if waiter is not None and not event.wait(self._max_wait(waiter)) and not self._cancel(waiter):
+            self._timed_out()
+        return time.monotonic()
+
+    async def aacquire(self, route, client):
+        """Async counterpart of `acquire`, for the ASGI app."""
+        if route not in ROUTE_CLASSES and route not in RATE_LIMITED_ONLY:
+            return None
+        self._take_token(client)
+        if route in RATE_LIMITED_ONLY:
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        waiter = self._enter(route, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self._max_wait(waiter))
+            except asyncio.TimeoutError:
+                if not self._cancel(waiter):
+                    self._timed_out()
+            except asyncio.CancelledError:
+                # The client went away while queued; hand a granted slot straight back
+                if self._cancel(waiter):
+                    self.release(time.monotonic())
+                raise
+        return time.monotonic()
+
+    def release(self, ticket):
+        """Frees the slot taken by `acquire`."""
+        if ticket is None:
+            return
+        held = time.monotonic() - ticket
+        with self._lock:
+            self.in_flight -= 1
+            self._hold_seconds += 0.1 * (held - self._hold_seconds)
+            woken = self._grant()
+        for waiter in woken:
+            waiter.wake()
+
+    def observe_upstream(self, status_code):
+        """Adjusts the limit from one upstream HTTP status."""
+        now = time.monotonic()
+        with self._lock:
+            if status_code == 429:
+                self.upstream_429 += 1
+                if now - self._last_backoff < ADMISSION_BACKOFF_INTERVAL:
+                    return
+                self._last_backoff = now
+                self.limit = max(float(self.min_limit), self.limit * ADMISSION_BACKOFF)
+                self.backoffs += 1
+                print(f"Upstream rate limited; admission limit lowered to {int(self.limit)}")
+                return
+            if status_code >= 400 or self.limit >= self.max_limit:
+                return
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            woken = self._grant()
+        for waiter in woken:
+            waiter.wake()
+
+    def response_hook(self, response):
+        """httpx response event hook for the OpenAI client."""
+        self.observe_upstream(response.status_code)
+
+    async def aresponse_hook(self, response):
+        """Async httpx response event hook for the AsyncOpenAI client."""
+        self.observe_upstream(response.status_code)
+
+    def stats(self):
+        with self._lock:
+            waiting = {route: count for route, count in self._waiting.items() if count}
+            return {
+                "enabled": True,
+                "limit": int(self.limit),
+                "maxLimit": self.max_limit,
+                "inFlight": self.in_flight,
+                "waiting": waiting,
+                "clients": len(self._buckets),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rateLimited": self.rate_limited,
+                "queueFull": self.queue_full,
+                "timedOut": self.timed_out,
+                "upstream429": self.upstream_429,
+                "backoffs": self.backoffs,
+                "avgHoldMs": round(1000 * self._hold_seconds, 1),
+            }
+
+
+def build_controller():
+    """Returns the AdmissionController configured from the environment, or None when it is disabled."""
+    return AdmissionController() if ADMISSION_ENABLED else None
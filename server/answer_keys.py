@@ -0,0 +1,150 @@
+"""
+Server-side answer keys for short-question quizzes.
+
+A short-question quiz is graded by /evaluate-answers, so its model answers
+never need to reach the device. /generate-quiz stores each question's
+`correctAnswer` in a SQLite file (ANSWER_KEYS_DB) under a random id and sends
+the client only {"id", "question"}. The client sends the ids back with its
+answers, and `attach` puts the stored keys in place of anything the client
+supplied, so neither the local grading rules nor the model grade against a
+key the client chose. Keys are kept for ANSWER_KEYS_TTL seconds; an answer
+whose key is unknown or expired is graded by the model without one.
+
+MCQs are graded on the device and keep their `correctAnswer`. Several
+processes can share the file, so a quiz can be graded by any of them.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+ANSWER_KEYS_DB = os.getenv(
+    "ANSWER_KEYS_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "answer_keys.db")
+)
+ANSWER_KEYS_TTL = float(os.getenv("ANSWER_KEYS_TTL", str(7 * 86400)))
+
+# Reference fields a client must not be able to set
+_CLIENT_KEYS = ("correctAnswer", "reference")
+
+_PURGE_INTERVAL = 3600
+
+
+class AnswerKeyStore:
+    """
+    SQLite table of question id -> reference answer.
+
+    Args:
+        path: The SQLite file. Created if missing.
+        ttl: Seconds a key is kept after its quiz was served.
+    """
+
+    def __init__(self, path, ttl=ANSWER_KEYS_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.issued = 0
+        self.found = 0
+        self.missing = 0
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS answer_keys (id TEXT PRIMARY KEY, answer TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        conn.commit()
+        # A forked worker must not reuse the parent's connections
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def issue(self, questions, quiz_type):
+        """
+        Prepares a quiz for the client.
+
+        Args:
+            questions: The quiz, as generated (with `correctAnswer`).
+            quiz_type: "MCQs" or "Short Questions".
+
+        Returns:
+            list: MCQs unchanged; short questions as {"id", "question"}, with
+                their keys stored here.
+        """
+        if quiz_type == "MCQs":
+            return questions
+        self._purge()
+        now = time.time()
+        served, rows = [], []
+        for item in questions:
+            question_id = uuid.uuid4().hex
+            answer = str(item.get("correctAnswer") or "").strip()
+            if answer:
+                rows.append((question_id, answer, now + self.ttl))
+            served.append({"id": question_id, "question": item.get("question")})
+        conn = self._conn()
+        conn.executemany("INSERT INTO answer_keys (id, answer, expires) VALUES (?, ?, ?)", rows)
+        conn.commit()
+        with self._lock:
+            self.issued += len(rows)
+        return served
+
+    def attach(self, user_answers):
+        """
+        Replaces the references in a graded submission with the stored keys.
+
+        Args:
+            user_answers: The /evaluate-answers `answers` list; items carry the
+                `id` they were served with.
+
+        Returns:
+            list: Copies of the items without client-supplied references, with
+                `correctAnswer` set where a key is stored for the id.
+        """
+        items = [
+            {k: v for k, v in item.items() if k not in _CLIENT_KEYS} if isinstance(item, dict) else {}
+            for item in user_answers
+        ]
+        ids = [str(item["id"]) for item in items if item.get("id")]
+        keys = {}
+        if ids:
+            placeholders = ", ".join("?" * len(ids))
+            keys = dict(self._conn().execute(
+                f"SELECT id, answer FROM answer_keys WHERE id IN ({placeholders}) AND expires >= ?",
+                (*ids, time.time()),
+            ).fetchall())
+        for item in items:
+            if item.get("id") and str(item["id"]) in keys:
+                item["correctAnswer"] = keys[str(item["id"])]
+        with self._lock:
+            self.found += len(keys)
+            self.missing += len(ids) - len(keys)
+        return items
+
+    def _purge(self):
+        now = time.time()
+        if now - self._last_purge < _PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM answer_keys WHERE expires < ?", (now,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Answer key purge failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"issued": self.issued, "found": self.found, "missing": self.missing}
@@ -1,95 +1,184 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS, cross_origin
-from PIL import Image,ImageOps
 import base64
+import time
 import traceback
-from pix2tex.cli import LatexOCR
-from pylatexenc.latex2text import LatexNodes2Text
-import pytesseract 
-import cv2
-import numpy as np
-import io
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from openai import DefaultHttpxClient, OpenAI
 import json
 from dotenv import load_dotenv
 import os
 
-load_dotenv()
+import admission
+import answer_keys
+import caching
+import engines
+import grading
+import jobs
+import llm
+import metrics
+import ocr_router
+import question_bank
+import quiz_pool
+import streaming
+import symbolic
+from imaging import pipeline_stats
+from normalize import canonicalize_problem
+from uploads import UploadError, read_flask_upload, to_data_uri
+import vision
+import worksheet
 
-# If you're on Windows, you will need to point pytesseract to the path where you installed Tesseract
-pytesseract.pytesseract.tesseract_cmd = r'tesseract'
+load_dotenv()
 
 app = Flask(__name__)
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
-# Initialize the LaTeX OCR model
-model = LatexOCR()
+# The OCR engines (pix2tex, Tesseract, LatexNodes2Text) are loaded on first use by
+# the routes that need them. Set WARMUP_ENGINES=tesseract,pix2tex to load them in
+# the background at startup instead, and REQUIRED_ENGINES to hold /healthz at 503
+# until they are ready. Under gunicorn (see gunicorn.conf.py) the master preloads
+# PRELOAD_ENGINES once and the workers share its copy.
+START_TIME = time.time()
+REQUIRED_ENGINES = engines.parse_engine_list(os.getenv("REQUIRED_ENGINES"))
+engines.warm_up(engines.parse_engine_list(os.getenv("WARMUP_ENGINES")))
+symbolic.warm_up()
+
+# OCR results are cached on the upload's bytes and its decoded pixels (see caching.ImageCache).
+# OCR_CACHE_KEY=phash also matches re-encoded copies of the same scan.
+ocr_cache = caching.build_cache("ocr", "OCR_CACHE")
+OCR_CACHE_KEY = os.getenv("OCR_CACHE_KEY", "exact")
+# Most differing bits (of 256) for two scans to count as the same in phash mode
+OCR_CACHE_PHASH_DISTANCE = int(os.getenv("OCR_CACHE_PHASH_DISTANCE", "10"))
+ocr_images = caching.ImageCache(ocr_cache, OCR_CACHE_KEY, max_distance=OCR_CACHE_PHASH_DISTANCE)
+
+# Crop/deskew/resize scans before sending them to GPT-4o (see vision.py)
+VISION_OPTIMIZE = os.getenv("VISION_OPTIMIZE", "1") == "1"
+
+@app.before_request
+def start_request_metrics():
+    # The URL rule ("/jobs/<job_id>"), not the path, keeps the label set bounded
+    g.metrics_request = metrics.begin(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+def record_request_metrics(response):
+    state = g.pop("metrics_request", None)
+    if state is None:
+        return response
+    if response.is_streamed:
+        # Streams (SSE, NDJSON) are timed until the last chunk has been sent
+        status = response.status_code
+        response.call_on_close(lambda: metrics.end(state, status))
+    else:
+        metrics.end(state, response.status_code)
+    return response
+
+
+@app.teardown_request
+def record_failed_request(exc):
+    # Only still set when the request raised before a response was made
+    state = g.pop("metrics_request", None)
+    if state is not None:
+        metrics.end(state, 500, exc)
+
+
+# Per-client rate limits, priority queueing and load shedding for the
+# OpenAI-backed routes (see admission.py). ADMISSION=0 turns it off.
+admission_controller = admission.build_controller()
+
+
+@app.before_request
+def admit_request():
+    if admission_controller is None or request.url_rule is None or request.method == "OPTIONS":
+        return None
+    try:
+        g.admission_ticket = admission_controller.acquire(
+            request.url_rule.rule, admission.client_key(request.headers, request.remote_addr)
+        )
+    except admission.Rejected as e:
+        return jsonify({"error": str(e)}), e.status, {"Retry-After": str(e.retry_after)}
+    return None
 
-def image_processing(image):
-    """
-    Processes an image for OCR.
 
-    Args:
-        image: The PIL Image object to be processed.
+@app.teardown_request
+def release_admission(exc):
+    # Streamed responses keep their slot until the stream is closed (stream_with_context)
+    if admission_controller is not None:
+        admission_controller.release(g.pop("admission_ticket", None))
+
+
+@app.route('/')
+@cross_origin()
+def home():
+    """
+    Home route for the application.
 
     Returns:
-        img: The processed image ready for OCR.
+        str: A string indicating that the server is running.
     """
-    try:
-        # Read the image file into a numpy array
-        img = np.array(image)
-
-        if len(img.shape) == 2:  # Grayscale image
-            gray = img
-        elif img.shape[2] == 4:  # RGBA image
-            gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
-        else:  # RGB image
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Apply Gaussian blur to remove noise
-        blur = cv2.GaussianBlur(gray, (5, 5), 0)
-        # Apply adaptive thresholding to get a binary image
-        bin_img = cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2)
-        
-        # Perform dilation and erosion to remove noise
-        kernel = np.ones((1, 1), np.uint8) 
-        img = cv2.dilate(bin_img, kernel, iterations=1) 
-        img = cv2.erode(img, kernel, iterations=1) 
-        
-        # Convert the NumPy array back to a PIL Image object
-        img = Image.fromarray(img)
-        return img
-    except Exception as e:
-        raise ValueError(f"Error in image processing: {str(e)}")
+    return 'Server is running!'
+
 
+@app.route('/healthz')
+@cross_origin()
+def healthz():
+    """
+    Readiness probe.
 
+    The LLM routes are ready as soon as the process is up; the OCR engines are
+    reported separately so a load balancer can tell which ones are warm.
 
-def image_processing2(image):
+    Returns:
+        flask.Response: 200 when every engine in REQUIRED_ENGINES is loaded, 503 otherwise.
     """
-    Minimal processing for LatexOCR.
+    ready = all(engines.is_loaded(name) for name in REQUIRED_ENGINES)
+    body = {
+        'status': 'ok' if ready else 'loading',
+        'uptimeSeconds': round(time.time() - START_TIME, 3),
+        'engines': engines.status(),
+        'preprocessing': pipeline_stats(),
+        'visionPayload': vision.stats(),
+        'ocrRouting': ocr_router.stats(),
+        'symbolic': symbolic.stats(),
+        'grading': grading.stats(),
+        'quizPool': quiz_pool_stats(),
+        'questionBank': question_bank_stats(),
+        'jobs': job_store.stats(),
+        'answerKeys': answer_key_store.stats(),
+        'worksheets': worksheet.stats(),
+        'admission': admission_controller.stats() if admission_controller else {'enabled': False},
+    }
+    return jsonify(body), 200 if ready else 503
+
+
+@app.route('/metrics')
+def prometheus_metrics():
     """
-    # 1. Convert to RGB (standard for most ML models)
-    if image.mode != "RGB":
-        image = image.convert("RGB")
-    
-    # 2. (Optional) Resize if the image is massive (e.g. > 2000px width) to speed up
-    # Standard phone photos are fine, but ensure it's not tiny.
-    
-    return image
-
+    Request, stage, token, cache and error metrics in the Prometheus text format.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
-@app.route('/')
+@app.route('/metrics/traces')
 @cross_origin()
-def home():
+def request_traces():
     """
-    Home route for the application.
+    The most recent sampled request traces (METRICS_TRACE_RATE), newest first.
+    """
+    return jsonify(metrics.traces()), 200
 
-    Returns:
-        str: A string indicating that the server is running.
+
+@app.route('/cache-stats')
+@cross_origin()
+def cache_stats():
     """
-    return 'Server is running!'
+    Returns hit/miss counters for the result caches.
+    """
+    return jsonify({
+        'ocr': dict(ocr_cache.stats(), **ocr_images.stats()),
+        'solutions': dict(solution_cache.stats(), coalesced=solution_flight.shared),
+    }), 200
 
 # @app.route('/latex', methods=['POST'])
 # @cross_origin()
@@ -119,10 +208,10 @@ def home():
 #         img = image_processing2(image_file)
 
 #         # Convert the image to LaTeX format using the model
-#         latex_response = model(img)
+#         latex_response = engines.get('pix2tex')(img)
         
 #         # Convert LaTeX to plain text
-#         text_response = LatexNodes2Text().latex_to_text(latex_response)
+#         text_response = engines.get('latex2text').latex_to_text(latex_response)
 #         print("Text response on server:", text_response)
 #     except Exception as e:
 #         return jsonify({'error': str(e)}), 400
@@ -130,6 +219,65 @@ def home():
 #     return jsonify({'latex': latex_response, 'text': text_response}), 200
 
 
+def latex_from_image(image_data, image_uri):
+    """
+    Returns the cached or freshly recognized LaTeX for an image.
+
+    Args:
+        image_data: The decoded image bytes, used for the cache key.
+        image_uri: The same image as a data URI, as sent to GPT-4o.
+    """
+    with metrics.stage("cache_key"):
+        cached, cache_keys = ocr_images.get(image_data, "latex")
+    if cached is not None:
+        return cached
+
+    result = ocr_router.try_local("latex", image_data)
+    if result is not None:
+        ocr_images.set(cache_keys, result)
+        return result
+
+    detail = "high"
+    if VISION_OPTIMIZE:
+        try:
+            with metrics.stage("vision_optimize"):
+                optimized, mimetype, detail, report = vision.optimize_for_vision(image_data)
+            if mimetype:
+                image_uri = to_data_uri(optimized, mimetype)
+            print("Vision payload:", report)
+        except Exception as e:
+            # Fall back to sending the original scan
+            print("Vision payload optimization failed:", e)
+
+    response = client.chat.completions.create(**llm.latex_request(image_uri, detail))
+
+    latex_response = llm.message_content(response)
+    print("OpenAI LaTeX:", latex_response)
+
+    result = {'latex': latex_response, 'text': latex_response, 'source': 'gpt-4o'}
+    ocr_images.set(cache_keys, result)
+    return result
+
+
+def text_from_image(image_data):
+    """
+    Returns the cached or freshly recognized text for an image.
+    """
+    with metrics.stage("cache_key"):
+        cached, cache_keys = ocr_images.get(image_data, "text")
+    if cached is not None:
+        return cached
+
+    result = ocr_router.try_local("text", image_data)
+    if result is None:
+        # Tesseract wasn't confident enough (TEXT_ROUTING=hybrid) or is disabled (llm)
+        image_uri = to_data_uri(image_data, "image/jpeg")
+        response = client.chat.completions.create(**llm.text_request(image_uri))
+        result = {'text': llm.message_content(response), 'source': 'gpt-4o'}
+
+    print(result['text'])
+    ocr_images.set(cache_keys, result)
+    return result
 
 
 @app.route('/latex', methods=['POST'])
@@ -144,44 +292,30 @@ def image_to_latex():
         # It handles the base64 URI directly.
         image_uri = data['uri'] 
 
-        prompt = """
-        Extract the mathematical content from this image. 
-        Return ONLY the raw LaTeX code. 
-        Do not add delimiters like ```latex or $$. 
-        If there is text mixed with math, wrap the text in \text{}.
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-4o", # Use gpt-4o or gpt-4-turbo
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_uri, # Send the data:image/jpeg;base64,... string directly
-                                "detail": "high"
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=300,
-        )
-
-        latex_response = response.choices[0].message.content
-        print("OpenAI LaTeX:", latex_response)
-
-        return jsonify({'latex': latex_response, 'text': latex_response}), 200
+        return jsonify(latex_from_image(caching.decode_data_uri(image_uri), image_uri)), 200
 
     except Exception as e:
         print("Error:", e)
         return jsonify({'error': str(e)}), 400
 
 
+@app.route('/latex/upload', methods=['POST'])
+@cross_origin()
+def upload_to_latex():
+    """
+    Binary variant of /latex.
 
+    Accepts multipart/form-data (field "image") or a raw image/* body and returns
+    the same JSON as /latex.
+    """
+    try:
+        image_data, mimetype = read_flask_upload(request)
+        return jsonify(latex_from_image(image_data, to_data_uri(image_data, mimetype))), 200
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print("Error:", e)
+        return jsonify({'error': str(e)}), 400
 
 
 @app.route('/text', methods=['POST'])
@@ -207,15 +341,8 @@ def image_to_text():
 
         # Decode the image data from the URI
         image_data = base64.b64decode(data['uri'].split(',')[1])
-        image_file = Image.open(io.BytesIO(image_data))
-        print('processing image')
-        # Process the image
-        img = image_processing(image_file)
-        
-        # Convert the processed image to text format using Tesseract OCR
-        
-        text_response = pytesseract.image_to_string(img)
-        print(text_response)
+
+        result = text_from_image(image_data)
     except Exception as e:
     
         print("Error:", e)
@@ -223,14 +350,65 @@ def image_to_text():
         return jsonify({'error': str(e)}), 400
 
     
-    return jsonify({'text': text_response}), 200
+    return jsonify(result), 200
+
+
+@app.route('/text/upload', methods=['POST'])
+@cross_origin()
+def upload_to_text():
+    """
+    Binary variant of /text.
+
+    Accepts multipart/form-data (field "image") or a raw image/* body and returns
+    the same JSON as /text.
+    """
+    try:
+        image_data, _ = read_flask_upload(request)
+        return jsonify(text_from_image(image_data)), 200
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print("Error:", e)
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 400
 #OpenAI integeration routes
 
 
-client = OpenAI(
+# Every OpenAI call is timed and its token usage counted (see metrics.py), and
+# every upstream response adjusts the admission limit, 429s lowering it
+client = metrics.instrument_openai(OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
-    organization=os.getenv("OPENAI_ORGANIZATION")
-)
+    organization=os.getenv("OPENAI_ORGANIZATION"),
+    http_client=DefaultHttpxClient(
+        event_hooks={"response": [admission_controller.response_hook]}
+    ) if admission_controller else None,
+))
+
+# Solutions are cached on the canonical form of the problem (see normalize.py) and
+# concurrent identical requests share one upstream call. Send "X-Cache-Bypass: 1"
+# to force a fresh answer.
+solution_cache = caching.build_cache("solutions", "SOLUTION_CACHE")
+solution_flight = caching.SingleFlight()
+metrics.register_cache(ocr_cache)
+metrics.register_cache(solution_cache)
+
+
+def cache_bypass_requested():
+    return request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes")
+
+
+def solve_problem_upstream(input_text):
+    """
+    Asks the model for a free-form step-by-step answer.
+
+    Returns:
+        dict: {"answer": ...}
+    """
+    response = client.chat.completions.create(**llm.solve_problem_request(input_text))
+
+    answer = llm.message_content(response) or "No answer provided."
+    return {"answer": answer}
+
 
 @app.route("/solve-problem", methods=["POST"])
 @cross_origin()
@@ -242,19 +420,15 @@ def solve_problem():
         if not input_text:
             return jsonify({"error": "Missing inputText"}), 400
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Solve this problem step-by-step: {input_text}",
-                }
-            ],
-            temperature=0.3,
+        key = "solve-problem:" + canonicalize_problem(input_text)
+        result = caching.cached_call(
+            solution_cache,
+            solution_flight,
+            key,
+            lambda: solve_problem_upstream(input_text),
+            bypass=cache_bypass_requested(),
         )
-
-        answer = response.choices[0].message.content or "No answer provided."
-        return jsonify({"answer": answer})
+        return jsonify(result)
     
     except Exception as e:
         print("CRITICAL ERROR IN SOLVE-PROBLEM:")
@@ -262,7 +436,25 @@ def solve_problem():
         traceback.print_exc()    # Prints the full location of the error
         # ----------------------------------
         return jsonify({"error": str(e)}), 500
-    
+
+
+def solve_math_upstream(input_text):
+    """
+    Solves locally with SymPy when possible, otherwise asks the model for a
+    structured `math_solution`.
+
+    Returns:
+        dict: {"overview": ..., "steps": [...], "finalAnswer": ...}
+    """
+    solution = symbolic.solve(input_text)
+    if solution is not None:
+        return solution
+
+    response = client.chat.completions.create(**llm.math_request(input_text))
+
+    answer_json_string = llm.message_content(response)
+    return json.loads(answer_json_string)
+
 
 @app.route("/solve-math", methods=["POST"])
 @cross_origin()
@@ -274,74 +466,14 @@ def solve_math_problem():
         if not input_text:
             return jsonify({"error": "Missing inputText"}), 400
 
-        # Define the Strict Schema (The "Contract" with the AI)
-        math_schema = {
-            "name": "math_solution",
-            "strict": True, # <--- GUARANTEES the structure
-            "schema": {
-                "type": "object",
-                "properties": {
-                    "overview": {
-                        "type": "string",
-                        "description": "A brief summary. Use $...$ for math."
-                    },
-                    "steps": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "title": {
-                                    "type": "string",
-                                    "description": "Short title of the step"
-                                },
-                                "content": {
-                                    "type": "string",
-                                    "description": "Detailed explanation. Use $ delimiters for ALL math symbols."
-                                }
-                            },
-                            "required": ["title", "content"],
-                            "additionalProperties": False
-                        }
-                    },
-                    "finalAnswer": {
-                        "type": "string",
-                        "description": "The final result in math format like $x = 5$"
-                    }
-                },
-                "required": ["overview", "steps", "finalAnswer"],
-                "additionalProperties": False
-            }
-        }
-
-        prompt = f"""
-        Solve this math problem: "{input_text}".
-        
-        CRITICAL RULES:
-        1. Use LaTeX for ALL math expressions, wrapped in single dollar signs ($).
-        2. Example: "The integral is $\\int x dx$".
-        3.  **Use LaTeX commands** for functions. 
-            - WRONG: "sin(x)", "cos(x)", "pi"
-            - CORRECT: "\\sin(x)", "\\cos(x)", "\\pi"
-        4.  **Wrap ALL math in single dollar signs ($).** - Example: "The derivative of $f(x)$ is $f'(x)$."
-        5.  **Final Answer:** Must be fully wrapped in LaTeX delimiters.
-            - Example: "$x = \\frac{{\\pi}}{{2}}$"
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-4o-2024-08-06", # Specific version optimized for strict outputs
-            messages=[
-                {"role": "system", "content": "You are a precise math tutor."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={
-                "type": "json_schema",
-                "json_schema": math_schema
-            },
-            temperature=0.1, 
+        key = "solve-math:" + canonicalize_problem(input_text)
+        answer_data = caching.cached_call(
+            solution_cache,
+            solution_flight,
+            key,
+            lambda: solve_math_upstream(input_text),
+            bypass=cache_bypass_requested(),
         )
-
-        answer_json_string = response.choices[0].message.content
-        answer_data = json.loads(answer_json_string)
         print("Math solution data:", answer_data)
         return jsonify(answer_data)
     
@@ -349,9 +481,199 @@ def solve_math_problem():
         print("Error:", e)
         return jsonify({"error": str(e)}), 500
     
+# ----------------------------------------------------------------------
+#  Streaming variants (server-sent events)
+# ----------------------------------------------------------------------
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@app.route("/solve-math/stream", methods=["POST"])
+@cross_origin()
+def solve_math_stream():
+    """
+    Streams a `math_solution` as server-sent events.
+
+    Emits `overview`, one `step` per element of `steps` and `finalAnswer` as soon
+    as each is complete, then `done` with the whole solution (or `error`).
+    """
+    data = request.get_json(silent=True) or {}
+    input_text = data.get("inputText")
+    if not input_text:
+        return jsonify({"error": "Missing inputText"}), 400
+
+    key = "solve-math:" + canonicalize_problem(input_text)
+    bypass = cache_bypass_requested()
+
+    def generate():
+        cached = None if bypass else solution_cache.get(key)
+        if cached is not None:
+            for event, payload in streaming.solution_events(cached):
+                yield streaming.sse(event, payload)
+            yield streaming.sse("done", cached)
+            return
+
+        solution = symbolic.solve(input_text)
+        if solution is not None:
+            solution_cache.set(key, solution)
+            for event, payload in streaming.solution_events(solution):
+                yield streaming.sse(event, payload)
+            yield streaming.sse("done", solution)
+            return
+
+        try:
+            stream = client.chat.completions.create(**llm.math_request(input_text), stream=True)
+            parser = streaming.SolutionStreamParser()
+            for delta in streaming.stream_deltas(stream):
+                for event, payload in parser.feed(delta):
+                    yield streaming.sse(event, payload)
+
+            solution = parser.result()
+            solution_cache.set(key, solution)
+            yield streaming.sse("done", solution)
+        except Exception as e:
+            print("Error:", e)
+            traceback.print_exc()
+            yield streaming.sse("error", {"error": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.route("/worksheet", methods=["POST"])
+@cross_origin()
+def solve_worksheet():
+    """
+    Solves every problem on a photographed worksheet in one request.
+
+    Accepts the page as JSON {"uri": <data URI>}, multipart/form-data (field
+    "image") or a raw image/* body. The page is split into problems (see
+    worksheet.py), which are recognized and solved concurrently; the results
+    stream back as NDJSON, one record per event, in completion order.
+    """
+    try:
+        if request.is_json:
+            data = request.get_json(silent=True) or {}
+            if 'uri' not in data:
+                return jsonify({'error': 'Invalid input data'}), 400
+            image_data = caching.decode_data_uri(data['uri'])
+        else:
+            image_data, _ = read_flask_upload(request)
+        regions, truncated = worksheet.segment(image_data)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print("Error:", e)
+        return jsonify({'error': str(e)}), 400
+
+    bypass = cache_bypass_requested()
+
+    def recognize(region):
+        return latex_from_image(region, to_data_uri(region, "image/png"))
+
+    def solve(problem):
+        key = "solve-math:" + canonicalize_problem(problem)
+        return caching.cached_call(
+            solution_cache, solution_flight, key, lambda: solve_math_upstream(problem), bypass=bypass
+        )
+
+    def generate():
+        for event, payload in worksheet.pipeline(regions, truncated, recognize, solve):
+            yield streaming.ndjson(event, payload)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers=SSE_HEADERS)
+
+
+@app.route("/solve-problem/stream", methods=["POST"])
+@cross_origin()
+def solve_problem_stream():
+    """
+    Streams a free-form answer as `delta` events followed by `done`.
+    """
+    data = request.get_json(silent=True) or {}
+    input_text = data.get("inputText")
+    if not input_text:
+        return jsonify({"error": "Missing inputText"}), 400
+
+    key = "solve-problem:" + canonicalize_problem(input_text)
+    bypass = cache_bypass_requested()
+
+    def generate():
+        cached = None if bypass else solution_cache.get(key)
+        if cached is not None:
+            yield streaming.sse("delta", {"text": cached["answer"]})
+            yield streaming.sse("done", cached)
+            return
+
+        try:
+            stream = client.chat.completions.create(**llm.solve_problem_request(input_text), stream=True)
+            parts = []
+            for delta in streaming.stream_deltas(stream):
+                parts.append(delta)
+                yield streaming.sse("delta", {"text": delta})
+
+            result = {"answer": "".join(parts) or "No answer provided."}
+            solution_cache.set(key, result)
+            yield streaming.sse("done", result)
+        except Exception as e:
+            print("Error:", e)
+            traceback.print_exc()
+            yield streaming.sse("error", {"error": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+
 # ======================================================================
 #  QUIZ GENERATION CODE
 # ======================================================================
+def generate_quiz_questions(topic, quiz_type, difficulty, count=5):
+    """
+    Asks the model for a new quiz of `count` questions and adds them to the question bank.
+
+    Returns:
+        list: The questions.
+
+    Raises:
+        json.JSONDecodeError, ValueError: If the response doesn't follow the requested structure.
+    """
+    response = client.chat.completions.create(**llm.quiz_request(topic, quiz_type, difficulty, count))
+    quiz_content = llm.message_content(response)
+    try:
+        questions = llm.parse_quiz(quiz_content)
+    except (json.JSONDecodeError, ValueError):
+        print("Raw AI response received:", quiz_content)
+        raise
+    if question_bank_instance:
+        question_bank_instance.add(topic, quiz_type, difficulty, questions)
+    return questions
+
+
+def pooled_quiz(topic, quiz_type, difficulty):
+    """Generates a quiz for the pool, which only keeps complete ones."""
+    return llm.validate_quiz(generate_quiz_questions(topic, quiz_type, difficulty), quiz_type)
+
+
+# Generated questions are kept and reused for matching topics (see question_bank.py)
+question_bank_instance = question_bank.build_bank()
+
+# Popular topic/type/difficulty combinations are pre-generated in the background (see quiz_pool.py)
+quiz_pool_instance = quiz_pool.QuizPool(pooled_quiz) if quiz_pool.QUIZ_POOL_ENABLED else None
+
+# Short-question answers stay on the server (see answer_keys.py)
+answer_key_store = answer_keys.AnswerKeyStore(answer_keys.ANSWER_KEYS_DB)
+
+
+def quiz_pool_stats():
+    return quiz_pool_instance.stats() if quiz_pool_instance else {"enabled": False}
+
+
+def question_bank_stats():
+    return question_bank_instance.stats() if question_bank_instance else {"enabled": False}
+
+
+def client_id(data):
+    """Identifies the student for the quiz pool and the bank: an explicit id if the app sends one, else the address."""
+    return data.get("clientId") or request.headers.get("X-Client-Id") or request.remote_addr
+
+
 @app.route("/generate-quiz", methods=["POST"])
 @cross_origin()
 def generate_quiz():
@@ -364,68 +686,31 @@ def generate_quiz():
         if not all([topic, quiz_type, difficulty]):
             return jsonify({"error": "Missing required fields: topic, quizType, difficulty"}), 400
 
-        # Define the expected JSON structure based on the quiz type
-        if quiz_type == 'MCQs':
-            json_format_instructions = """
-            "questions": [
-              {
-                "question": "The question text...",
-                "options": ["Option A", "Option B", "Option C", "Option D"],
-                "correctAnswer": "The text of the correct option"
-              }
-            ]
-            """
-        else:  # Short Questions
-            json_format_instructions = """
-            "questions": [
-              {
-                "question": "The question text..."
-              }
-            ]
-            """
-
-        # Construct a more robust prompt for the AI model
-        prompt = f"""
-        Generate a {difficulty} level quiz with 5 questions on the topic of "{topic}".
-        The quiz type must be "{quiz_type}".
-        Your entire response must be a single, valid JSON object.
-        The JSON object must have a single key called "questions", which contains an array of the question objects.
-        Do not include any other text, explanations, or markdown.
-        Follow this exact structure inside the JSON object:
-        {json_format_instructions}
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": "You are an API that generates quizzes in a specified JSON format. You will only respond with the JSON object."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.6,
-        )
-
-        quiz_content = response.choices[0].message.content
-        print(quiz_content)
-    
-        try:
-            # The AI should return a JSON string. Parse it into a Python object.
-            quiz_data = json.loads(quiz_content)
-            
-            # Now, we specifically look for the "questions" key, which should be a list.
-            if isinstance(quiz_data, dict) and "questions" in quiz_data and isinstance(quiz_data["questions"], list):
-                # We extract the list of questions and send that back to the client.
-                quiz_data = quiz_data["questions"]
+        student = client_id(data)
+        found = question_bank_instance.assemble(topic, quiz_type, difficulty, client_id=student) if question_bank_instance else []
+        quiz_data = found if len(found) == 5 else None
+
+        if quiz_data is None and quiz_pool_instance:
+            quiz_data = quiz_pool_instance.take(topic, quiz_type, difficulty, student)
+
+        if quiz_data is None:
+            try:
+                # Only the questions the bank couldn't supply are generated
+                quiz_data = generate_quiz_questions(topic, quiz_type, difficulty, 5 - len(found))
+                if found:
+                    quiz_data = question_bank.merge(found, quiz_data)
+                    if len(quiz_data) < 5:
+                        # Some generated questions repeated bank ones
+                        more = generate_quiz_questions(topic, quiz_type, difficulty, 5 - len(quiz_data))
+                        quiz_data = question_bank.merge(quiz_data, more)
                 print(quiz_data)
-                return jsonify({"quiz": quiz_data}), 200
-            else:
-                # This error is more specific if the AI fails to follow the new structure.
-                raise ValueError("JSON from AI does not contain a 'questions' list.")
+            except (json.JSONDecodeError, ValueError) as e:
+                print("Error parsing AI response:", e)
+                return jsonify({"error": "Failed to parse the generated quiz from AI."}), 500
 
-        except (json.JSONDecodeError, ValueError) as e:
-            print("Error parsing AI response:", e)
-            print("Raw AI response received:", quiz_content)
-            return jsonify({"error": "Failed to parse the generated quiz from AI."}), 500
+        if question_bank_instance:
+            question_bank_instance.record_served(student, quiz_type, difficulty, quiz_data)
+        return jsonify({"quiz": answer_key_store.issue(quiz_data, quiz_type)}), 200
 
     except Exception as e:
         print(f"An unexpected error occurred in /generate-quiz: {e}")
@@ -495,6 +780,11 @@ def generate_quiz():
 # ======================================================================
 # END: QUIZ GENERATION CODE
 # ======================================================================
+def grade_with_llm(items):
+    response = client.chat.completions.create(**llm.grading_request(items))
+    return llm.parse_evaluations(llm.message_content(response))
+
+
 @app.route("/evaluate-answers", methods=["POST"])
 @cross_origin()
 def evaluate_answers():
@@ -505,89 +795,88 @@ def evaluate_answers():
         if not user_answers or not isinstance(user_answers, list):
             return jsonify({"error": "Missing or invalid 'answers' field"}), 400
 
-        # Format inputs
-        answers_formatted_string = ""
-        for i, item in enumerate(user_answers):
-            answers_formatted_string += f"{i+1}. Question: {item.get('question')}\n   Answer: {item.get('answer')}\n"
-
-        prompt = f"""
-        Evaluate these user answers based on accuracy (1-5).
-        For each answer, provide a score and a very brief 1-sentence feedback.
-        
-        Data to evaluate:
-        {answers_formatted_string}
-        """
-
-        # --- THE NEVER-FAIL CONFIGURATION ---
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # <--- Use this model (Cheaper & Smarter)
-            messages=[
-                {"role": "system", "content": "You are a strict grading assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            # This "json_schema" enforces the format 100%
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "grading_schema",
-                    "strict": True, # <--- This prevents hallucinated keys
-                    "schema": {
-                        "type": "object",
-                        "properties": {
-                            "evaluations": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "score": {
-                                            "type": "integer",
-                                            "description": "Score from 1 to 5"
-                                        },
-                                        "feedback": {
-                                            "type": "string",
-                                            "description": "Short reasoning for the score"
-                                        }
-                                    },
-                                    "required": ["score", "feedback"],
-                                    "additionalProperties": False
-                                }
-                            }
-                        },
-                        "required": ["evaluations"],
-                        "additionalProperties": False
-                    }
-                }
-            },
-            temperature=0.2, 
-        )
-
-        evaluation_content = response.choices[0].message.content
-        
-        # We can trust this load() because "strict": True guarantees validity
-        evaluation_data = json.loads(evaluation_content)
-        scores_list = evaluation_data["evaluations"]
-
-        if len(scores_list) != len(user_answers):
-             return jsonify({"error": "AI returned mismatched number of scores."}), 500
-
-        # Merge results
-        final_results = []
-        for i, item in enumerate(user_answers):
-            final_results.append({
-                "question": item.get('question'),
-                "answer": item.get('answer'),
-                "score": scores_list[i].get('score'),
-                "feedback": scores_list[i].get('feedback') # Now you get feedback too!
-            })
+        # Graded against the stored keys, whatever the client sent
+        user_answers = answer_key_store.attach(user_answers)
+        # Answers a local rule can decide never reach the model
+        final_results = grading.grade(user_answers, grade_with_llm)
 
         return jsonify(final_results), 200
 
+    except grading.MismatchedScores as e:
+        return jsonify({"error": str(e)}), 500
+
     except Exception as e:
         print(f"Server Error: {e}")
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
 
+# ======================================================================
+# ASYNC JOBS (see jobs.py)
+# ======================================================================
+job_store = jobs.JobStore(jobs.JOBS_DB)
+job_executor = ThreadPoolExecutor(max_workers=jobs.JOBS_WORKERS, thread_name_prefix="job")
+
+
+def run_job(job_id, route, payload, headers, remote_addr):
+    """
+    Runs a job through the route's own handler, as if it had been posted to it.
+    """
+    job_store.start(job_id)
+    started = time.time()
+    try:
+        # Admitted as a batch request, without charging the client a second time
+        with admission.job(), app.test_request_context(
+            f"/{route}", method="POST", json=payload, headers=headers, environ_base={"REMOTE_ADDR": remote_addr}
+        ):
+            response = app.full_dispatch_request()
+        status, result = response.status_code, response.get_json(silent=True)
+    except Exception as e:
+        print(f"Job {job_id} ({route}) failed:", e)
+        traceback.print_exc()
+        status, result = 500, {"error": "An internal server error occurred."}
+    job_store.finish(job_id, status, result, time.time() - started)
+
+
+@app.route("/jobs", methods=["POST"])
+@cross_origin()
+def submit_job():
+    """
+    Queues a request to one of the JSON routes and returns its job right away.
+
+    Returns:
+        flask.Response: 202 with the new (or still running) job, 200 with a
+            finished one submitted earlier under the same Idempotency-Key.
+    """
+    try:
+        route, payload, key, headers = jobs.parse_submission(request.get_json(silent=True), request.headers)
+        job, created = job_store.create(route, payload, key)
+    except jobs.JobError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    if created:
+        job_executor.submit(run_job, job["id"], route, payload, headers, request.remote_addr)
+    status = 200 if job["status"] in ("done", "failed") else 202
+    return jsonify(job), status, {"Location": f"/jobs/{job['id']}"}
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@cross_origin()
+def get_job(job_id):
+    """
+    Returns a job and, once it is finished, its result. With ?wait=<seconds>
+    the response is held until the job finishes (up to JOBS_MAX_WAIT).
+    """
+    try:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    job = job_store.wait(job_id, wait) if wait > 0 else job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    return jsonify(job), 200
+
 
 if __name__ == '__main__':
     app.run(debug=True, host='192.168.0.100', port=5000)
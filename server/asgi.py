@@ -0,0 +1,752 @@
+"""
+Async (ASGI) serving mode for the tutoring API.
+
+Serves the same routes and JSON contract as app.py, but every handler is a
+coroutine so a request waiting on OpenAI no longer holds a worker thread:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+All routes share one AsyncOpenAI client with a keep-alive connection pool.
+Each route has its own concurrency limit and timeout, and the CPU-bound OCR
+work runs on a thread pool so it doesn't block the event loop.
+"""
+import asyncio
+import contextvars
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from openai import AsyncOpenAI
+from starlette.datastructures import Headers
+from starlette.routing import Match
+
+import admission
+import answer_keys
+import caching
+import engines
+import grading
+import jobs
+import llm
+import metrics
+import ocr_router
+import question_bank
+import quiz_pool
+import streaming
+import symbolic
+from imaging import pipeline_stats
+from normalize import canonicalize_problem
+from uploads import UploadError, read_asgi_upload, to_data_uri
+import vision
+import worksheet
+
+load_dotenv()
+
+START_TIME = time.time()
+REQUIRED_ENGINES = engines.parse_engine_list(os.getenv("REQUIRED_ENGINES"))
+OCR_CACHE_KEY = os.getenv("OCR_CACHE_KEY", "exact")
+OCR_CACHE_PHASH_DISTANCE = int(os.getenv("OCR_CACHE_PHASH_DISTANCE", "10"))
+VISION_OPTIMIZE = os.getenv("VISION_OPTIMIZE", "1") == "1"
+
+# Upstream connection pool, shared by all routes
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_KEEPALIVE = int(os.getenv("UPSTREAM_KEEPALIVE", "50"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "60"))
+
+# Per-route in-flight limits and timeouts (seconds). Override with e.g.
+# CONCURRENCY_SOLVE_MATH=100 or TIMEOUT_GENERATE_QUIZ=90.
+ROUTE_DEFAULTS = {
+    "latex": (64, 60),
+    "text": (os.cpu_count() or 4, 30),
+    "solve-problem": (128, 90),
+    "solve-math": (128, 90),
+    "generate-quiz": (64, 90),
+    "evaluate-answers": (64, 90),
+}
+
+
+def _route_env(prefix, route, default):
+    return os.getenv(f"{prefix}_{route.upper().replace('-', '_')}", default)
+
+
+class RouteLimit:
+    """
+    Concurrency semaphore plus timeout for one route.
+    """
+
+    def __init__(self, route, concurrency, timeout):
+        self.route = route
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+
+    async def run(self, coro):
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                return await asyncio.wait_for(coro, self.timeout)
+            finally:
+                self.in_flight -= 1
+
+
+limits = {
+    route: RouteLimit(
+        route,
+        int(_route_env("CONCURRENCY", route, concurrency)),
+        float(_route_env("TIMEOUT", route, timeout)),
+    )
+    for route, (concurrency, timeout) in ROUTE_DEFAULTS.items()
+}
+
+# Per-client rate limits, priority queueing and load shedding for the
+# OpenAI-backed routes (see admission.py). ADMISSION=0 turns it off.
+admission_controller = admission.build_controller()
+
+ocr_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 4))),
+    thread_name_prefix="ocr",
+)
+
+# Every OpenAI call is timed and its token usage counted (see metrics.py), and
+# every upstream response adjusts the admission limit, 429s lowering it
+client = metrics.instrument_openai(AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    organization=os.getenv("OPENAI_ORGANIZATION"),
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_KEEPALIVE,
+        ),
+        timeout=UPSTREAM_TIMEOUT,
+        event_hooks={"response": [admission_controller.aresponse_hook]} if admission_controller else None,
+    ),
+))
+
+ocr_cache = caching.build_cache("ocr", "OCR_CACHE")
+ocr_images = caching.ImageCache(ocr_cache, OCR_CACHE_KEY, max_distance=OCR_CACHE_PHASH_DISTANCE)
+solution_cache = caching.build_cache("solutions", "SOLUTION_CACHE")
+solution_flight = caching.AsyncSingleFlight()
+metrics.register_cache(ocr_cache)
+metrics.register_cache(solution_cache)
+
+
+def route_template(scope):
+    """The path the request matches as registered, e.g. "/jobs/{job_id}"."""
+    for route in scope["app"].router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return getattr(route, "path", "unmatched")
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request under its route template ("/jobs/{job_id}").
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        state = metrics.begin(route_template(scope))
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception as e:
+            metrics.end(state, 500, e)
+            raise
+        metrics.end(state, status)
+
+
+class AdmissionMiddleware:
+    """
+    Rate limits and queues the OpenAI-backed routes, holding the slot until
+    the response (streamed or not) has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or admission_controller is None or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+
+        client = scope.get("client")
+        try:
+            ticket = await admission_controller.aacquire(
+                route_template(scope), admission.client_key(Headers(scope=scope), client[0] if client else None)
+            )
+        except admission.Rejected as e:
+            response = JSONResponse({"error": str(e)}, status_code=e.status, headers={"Retry-After": str(e.retry_after)})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_controller.release(ticket)
+
+
+app = FastAPI(title="Kord AI Tutor")
+# Outermost last: metrics see every response, and rejections still get CORS headers
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(MetricsMiddleware)
+
+
+@app.on_event("startup")
+async def startup():
+    global main_loop
+    main_loop = asyncio.get_running_loop()
+    engines.warm_up(engines.parse_engine_list(os.getenv("WARMUP_ENGINES")))
+    symbolic.warm_up()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await client.close()
+    await job_client.aclose()
+    ocr_executor.shutdown(wait=False)
+
+
+def error(message, status):
+    return JSONResponse({"error": message}, status_code=status)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+def run_in_executor(fn, *args):
+    # Carry the request's context over, so stages timed in the pool count towards its route
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(ocr_executor, context.run, fn, *args)
+
+
+def cache_bypass_requested(request):
+    return request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes")
+
+
+@app.get("/", response_class=PlainTextResponse)
+async def home():
+    return "Server is running!"
+
+
+@app.get("/healthz")
+async def healthz():
+    ready = all(engines.is_loaded(name) for name in REQUIRED_ENGINES)
+    body = {
+        "status": "ok" if ready else "loading",
+        "uptimeSeconds": round(time.time() - START_TIME, 3),
+        "engines": engines.status(),
+        "preprocessing": pipeline_stats(),
+        "visionPayload": vision.stats(),
+        "ocrRouting": ocr_router.stats(),
+        "symbolic": symbolic.stats(),
+        "grading": grading.stats(),
+        "quizPool": quiz_pool_instance.stats() if quiz_pool_instance else {"enabled": False},
+        "questionBank": question_bank_instance.stats() if question_bank_instance else {"enabled": False},
+        "jobs": job_store.stats(),
+        "answerKeys": answer_key_store.stats(),
+        "worksheets": worksheet.stats(),
+        "admission": admission_controller.stats() if admission_controller else {"enabled": False},
+        "inFlight": {route: limit.in_flight for route, limit in limits.items()},
+    }
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/metrics/traces")
+async def request_traces():
+    return metrics.traces()
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return {
+        "ocr": dict(ocr_cache.stats(), **ocr_images.stats()),
+        "solutions": dict(solution_cache.stats(), coalesced=solution_flight.shared),
+    }
+
+
+async def latex_from_image(image_data, image_uri):
+    with metrics.stage("cache_key"):
+        cached, cache_keys = await run_in_executor(ocr_images.get, image_data, "latex")
+    if cached is not None:
+        return cached
+
+    result = await run_in_executor(ocr_router.try_local, "latex", image_data)
+    if result is not None:
+        ocr_images.set(cache_keys, result)
+        return result
+
+    detail = "high"
+    if VISION_OPTIMIZE:
+        try:
+            with metrics.stage("vision_optimize"):
+                optimized, mimetype, detail, report = await run_in_executor(vision.optimize_for_vision, image_data)
+            if mimetype:
+                image_uri = to_data_uri(optimized, mimetype)
+        except Exception as e:
+            print("Vision payload optimization failed:", e)
+
+    response = await client.chat.completions.create(**llm.latex_request(image_uri, detail))
+    latex_response = llm.message_content(response)
+    result = {"latex": latex_response, "text": latex_response, "source": "gpt-4o"}
+    ocr_images.set(cache_keys, result)
+    return result
+
+
+async def text_from_image(image_data):
+    with metrics.stage("cache_key"):
+        cached, cache_keys = await run_in_executor(ocr_images.get, image_data, "text")
+    if cached is not None:
+        return cached
+
+    result = await run_in_executor(ocr_router.try_local, "text", image_data)
+    if result is None:
+        image_uri = to_data_uri(image_data, "image/jpeg")
+        response = await client.chat.completions.create(**llm.text_request(image_uri))
+        result = {"text": llm.message_content(response), "source": "gpt-4o"}
+
+    ocr_images.set(cache_keys, result)
+    return result
+
+
+async def latex_from_uri(image_uri):
+    return await latex_from_image(caching.decode_data_uri(image_uri), image_uri)
+
+
+async def text_from_uri(image_uri):
+    return await text_from_image(caching.decode_data_uri(image_uri))
+
+
+async def _run_ocr(route, coro):
+    try:
+        return await limits[route].run(coro)
+    except asyncio.TimeoutError:
+        return error("Request timed out", 504)
+    except UploadError as e:
+        return error(str(e), e.status)
+    except Exception as e:
+        print("Error:", e)
+        traceback.print_exc()
+        return error(str(e), 400)
+
+
+@app.post("/latex")
+async def image_to_latex(request: Request):
+    data = await read_json(request)
+    if not data or "uri" not in data:
+        return error("Invalid input data", 400)
+
+    image_uri = data["uri"]
+    return await _run_ocr("latex", latex_from_uri(image_uri))
+
+
+@app.post("/latex/upload")
+async def upload_to_latex(request: Request):
+    try:
+        image_data, mimetype = await read_asgi_upload(request)
+    except UploadError as e:
+        return error(str(e), e.status)
+    return await _run_ocr("latex", latex_from_image(image_data, to_data_uri(image_data, mimetype)))
+
+
+@app.post("/text")
+async def image_to_text(request: Request):
+    data = await read_json(request)
+    if not data or "uri" not in data or "type" not in data or "name" not in data:
+        return error("Invalid input data", 400)
+
+    return await _run_ocr("text", text_from_uri(data["uri"]))
+
+
+@app.post("/text/upload")
+async def upload_to_text(request: Request):
+    try:
+        image_data, _ = await read_asgi_upload(request)
+    except UploadError as e:
+        return error(str(e), e.status)
+    return await _run_ocr("text", text_from_image(image_data))
+
+
+async def solve_problem_upstream(input_text):
+    response = await client.chat.completions.create(**llm.solve_problem_request(input_text))
+    return {"answer": llm.message_content(response) or "No answer provided."}
+
+
+async def solve_math_upstream(input_text):
+    solution = await symbolic.solve_async(input_text)
+    if solution is not None:
+        return solution
+
+    response = await client.chat.completions.create(**llm.math_request(input_text))
+    return json.loads(llm.message_content(response))
+
+
+async def _solve(request, route, upstream):
+    data = await read_json(request)
+    input_text = (data or {}).get("inputText")
+    if not input_text:
+        return error("Missing inputText", 400)
+
+    key = f"{route}:" + canonicalize_problem(input_text)
+    try:
+        return await limits[route].run(
+            caching.async_cached_call(
+                solution_cache,
+                solution_flight,
+                key,
+                lambda: upstream(input_text),
+                bypass=cache_bypass_requested(request),
+            )
+        )
+    except asyncio.TimeoutError:
+        return error("Request timed out", 504)
+    except Exception as e:
+        print(f"Error in /{route}:", e)
+        traceback.print_exc()
+        return error(str(e), 500)
+
+
+@app.post("/solve-problem")
+async def solve_problem(request: Request):
+    return await _solve(request, "solve-problem", solve_problem_upstream)
+
+
+@app.post("/solve-math")
+async def solve_math_problem(request: Request):
+    return await _solve(request, "solve-math", solve_math_upstream)
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@app.post("/solve-math/stream")
+async def solve_math_stream(request: Request):
+    data = await read_json(request) or {}
+    input_text = data.get("inputText")
+    if not input_text:
+        return error("Missing inputText", 400)
+
+    key = "solve-math:" + canonicalize_problem(input_text)
+    bypass = cache_bypass_requested(request)
+
+    async def generate():
+        cached = None if bypass else solution_cache.get(key)
+        if cached is not None:
+            for event, payload in streaming.solution_events(cached):
+                yield streaming.sse(event, payload)
+            yield streaming.sse("done", cached)
+            return
+
+        solution = await symbolic.solve_async(input_text)
+        if solution is not None:
+            solution_cache.set(key, solution)
+            for event, payload in streaming.solution_events(solution):
+                yield streaming.sse(event, payload)
+            yield streaming.sse("done", solution)
+            return
+
+        try:
+            async with limits["solve-math"].semaphore:
+                stream = await client.chat.completions.create(**llm.math_request(input_text), stream=True)
+                parser = streaming.SolutionStreamParser()
+                async for delta in streaming.astream_deltas(stream):
+                    for event, payload in parser.feed(delta):
+                        yield streaming.sse(event, payload)
+
+            solution = parser.result()
+            solution_cache.set(key, solution)
+            yield streaming.sse("done", solution)
+        except Exception as e:
+            print("Error:", e)
+            traceback.print_exc()
+            yield streaming.sse("error", {"error": str(e)})
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.post("/worksheet")
+async def solve_worksheet(request: Request):
+    try:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            data = await read_json(request)
+            if not data or "uri" not in data:
+                return error("Invalid input data", 400)
+            image_data = caching.decode_data_uri(data["uri"])
+        else:
+            image_data, _ = await read_asgi_upload(request)
+        regions, truncated = await run_in_executor(worksheet.segment, image_data)
+    except UploadError as e:
+        return error(str(e), e.status)
+    except Exception as e:
+        print("Error:", e)
+        return error(str(e), 400)
+
+    bypass = cache_bypass_requested(request)
+
+    async def recognize(region):
+        return await limits["latex"].run(latex_from_image(region, to_data_uri(region, "image/png")))
+
+    async def solve(problem):
+        key = "solve-math:" + canonicalize_problem(problem)
+        return await limits["solve-math"].run(
+            caching.async_cached_call(
+                solution_cache, solution_flight, key, lambda: solve_math_upstream(problem), bypass=bypass
+            )
+        )
+
+    async def generate():
+        async for event, payload in worksheet.apipeline(regions, truncated, recognize, solve):
+            yield streaming.ndjson(event, payload)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=SSE_HEADERS)
+
+
+@app.post("/solve-problem/stream")
+async def solve_problem_stream(request: Request):
+    data = await read_json(request) or {}
+    input_text = data.get("inputText")
+    if not input_text:
+        return error("Missing inputText", 400)
+
+    key = "solve-problem:" + canonicalize_problem(input_text)
+    bypass = cache_bypass_requested(request)
+
+    async def generate():
+        cached = None if bypass else solution_cache.get(key)
+        if cached is not None:
+            yield streaming.sse("delta", {"text": cached["answer"]})
+            yield streaming.sse("done", cached)
+            return
+
+        try:
+            parts = []
+            async with limits["solve-problem"].semaphore:
+                stream = await client.chat.completions.create(**llm.solve_problem_request(input_text), stream=True)
+                async for delta in streaming.astream_deltas(stream):
+                    parts.append(delta)
+                    yield streaming.sse("delta", {"text": delta})
+
+            result = {"answer": "".join(parts) or "No answer provided."}
+            solution_cache.set(key, result)
+            yield streaming.sse("done", result)
+        except Exception as e:
+            print("Error:", e)
+            traceback.print_exc()
+            yield streaming.sse("error", {"error": str(e)})
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def pooled_quiz(topic, quiz_type, difficulty):
+    """
+    Generates a quiz for the pool. Runs on a pool thread, so the request is
+    handed to the event loop and shares the route's concurrency limit.
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        limits["generate-quiz"].run(client.chat.completions.create(**llm.quiz_request(topic, quiz_type, difficulty))),
+        main_loop,
+    )
+    questions = llm.validate_quiz(llm.parse_quiz(llm.message_content(future.result())), quiz_type)
+    if question_bank_instance:
+        question_bank_instance.add(topic, quiz_type, difficulty, questions)
+    return questions
+
+
+# Generated questions are kept and reused for matching topics (see question_bank.py)
+question_bank_instance = question_bank.build_bank()
+
+# Popular topic/type/difficulty combinations are pre-generated in the background (see quiz_pool.py)
+main_loop = None
+quiz_pool_instance = quiz_pool.QuizPool(pooled_quiz) if quiz_pool.QUIZ_POOL_ENABLED else None
+
+# Short-question answers stay on the server (see answer_keys.py)
+answer_key_store = answer_keys.AnswerKeyStore(answer_keys.ANSWER_KEYS_DB)
+
+
+@app.post("/generate-quiz")
+async def generate_quiz(request: Request):
+    data = await read_json(request) or {}
+    topic = data.get("topic")
+    quiz_type = data.get("quizType")
+    difficulty = data.get("difficulty")
+
+    if not all([topic, quiz_type, difficulty]):
+        return error("Missing required fields: topic, quizType, difficulty", 400)
+
+    # Identifies the student, so neither the bank nor the pool serves them a question twice
+    client_id = data.get("clientId") or request.headers.get("X-Client-Id") or (request.client.host if request.client else "")
+    found = []
+    if question_bank_instance:
+        found = await asyncio.to_thread(
+            question_bank_instance.assemble, topic, quiz_type, difficulty, client_id=client_id
+        )
+    quiz_data = found if len(found) == 5 else None
+
+    if quiz_data is None and quiz_pool_instance:
+        quiz_data = quiz_pool_instance.take(topic, quiz_type, difficulty, client_id)
+
+    if quiz_data is None:
+        try:
+            # Only the questions the bank couldn't supply are generated
+            quiz_data = await generate_quiz_questions(topic, quiz_type, difficulty, 5 - len(found))
+            if found:
+                quiz_data = question_bank.merge(found, quiz_data)
+                if len(quiz_data) < 5:
+                    # Some generated questions repeated bank ones
+                    more = await generate_quiz_questions(topic, quiz_type, difficulty, 5 - len(quiz_data))
+                    quiz_data = question_bank.merge(quiz_data, more)
+        except asyncio.TimeoutError:
+            return error("Request timed out", 504)
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError
+            print("Error parsing AI response:", e)
+            return error("Failed to parse the generated quiz from AI.", 500)
+        except Exception as e:
+            print(f"An unexpected error occurred in /generate-quiz: {e}")
+            return error("An internal server error occurred.", 500)
+
+    if question_bank_instance:
+        await asyncio.to_thread(question_bank_instance.record_served, client_id, quiz_type, difficulty, quiz_data)
+    return {"quiz": await asyncio.to_thread(answer_key_store.issue, quiz_data, quiz_type)}
+
+
+async def generate_quiz_questions(topic, quiz_type, difficulty, count):
+    """
+    Asks the model for `count` new questions and adds them to the question bank.
+
+    Raises:
+        ValueError: If the response doesn't follow the requested structure.
+    """
+    response = await limits["generate-quiz"].run(
+        client.chat.completions.create(**llm.quiz_request(topic, quiz_type, difficulty, count))
+    )
+    quiz_content = llm.message_content(response)
+    try:
+        questions = llm.parse_quiz(quiz_content)
+    except ValueError:
+        print("Raw AI response received:", quiz_content)
+        raise
+    if question_bank_instance:
+        await asyncio.to_thread(question_bank_instance.add, topic, quiz_type, difficulty, questions)
+    return questions
+
+
+@app.post("/evaluate-answers")
+async def evaluate_answers(request: Request):
+    data = await read_json(request) or {}
+    user_answers = data.get("answers")
+
+    if not user_answers or not isinstance(user_answers, list):
+        return error("Missing or invalid 'answers' field", 400)
+    # Graded against the stored keys, whatever the client sent
+    user_answers = await asyncio.to_thread(answer_key_store.attach, user_answers)
+
+    async def grade_with_llm(items):
+        response = await client.chat.completions.create(**llm.grading_request(items))
+        return llm.parse_evaluations(llm.message_content(response))
+
+    try:
+        final_results = await limits["evaluate-answers"].run(grading.agrade(user_answers, grade_with_llm))
+    except asyncio.TimeoutError:
+        return error("Request timed out", 504)
+    except grading.MismatchedScores as e:
+        return error(str(e), 500)
+    except Exception as e:
+        print(f"Server Error: {e}")
+        traceback.print_exc()
+        return error(str(e), 500)
+
+    return JSONResponse(final_results)
+
+
+# ----------------------------------------------------------------------
+#  Async jobs (see jobs.py)
+# ----------------------------------------------------------------------
+job_store = jobs.JobStore(jobs.JOBS_DB)
+job_slots = asyncio.Semaphore(jobs.JOBS_WORKERS)
+# Jobs are posted to this app in-process, so they go through the routes' own limits
+job_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://jobs", timeout=None)
+job_tasks = set()
+job_events = {}
+
+
+async def run_job(job_id, route, payload, headers):
+    async with job_slots:
+        await asyncio.to_thread(job_store.start, job_id)
+        started = time.time()
+        try:
+            # Admitted as a batch request, without charging the client a second time
+            with admission.job():
+                response = await job_client.post(f"/{route}", json=payload, headers=headers)
+            status, result = response.status_code, response.json()
+        except Exception as e:
+            print(f"Job {job_id} ({route}) failed:", e)
+            traceback.print_exc()
+            status, result = 500, {"error": "An internal server error occurred."}
+        await asyncio.to_thread(job_store.finish, job_id, status, result, time.time() - started)
+        job_events.pop(job_id).set()
+
+
+@app.post("/jobs")
+async def submit_job(request: Request):
+    try:
+        route, payload, key, headers = jobs.parse_submission(await read_json(request), request.headers)
+        job, created = await asyncio.to_thread(job_store.create, route, payload, key)
+    except jobs.JobError as e:
+        return error(str(e), e.status)
+
+    if created:
+        job_events[job["id"]] = asyncio.Event()
+        task = asyncio.create_task(run_job(job["id"], route, payload, headers))
+        job_tasks.add(task)
+        task.add_done_callback(job_tasks.discard)
+    status = 200 if job["status"] in ("done", "failed") else 202
+    return JSONResponse(job, status_code=status, headers={"Location": f"/jobs/{job['id']}"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    deadline = time.time() + min(max(wait, 0), jobs.JOBS_MAX_WAIT)
+    while True:
+        job = await asyncio.to_thread(job_store.get, job_id)
+        remaining = deadline - time.time()
+        if job is None or job["status"] in ("done", "failed") or remaining <= 0:
+            break
+        event = job_events.get(job_id)
+        try:
+            # Our own jobs wake the poll when they finish; others' are re-read periodically
+            await asyncio.wait_for(
+                event.wait() if event else asyncio.sleep(jobs.JOBS_POLL_INTERVAL),
+                min(remaining, jobs.JOBS_MAX_WAIT),
+            )
+        except asyncio.TimeoutError:
+            pass
+
+    if job is None:
+        return error("Job not found or expired", 404)
+    return job
@@ -0,0 +1,472 @@
+"""
+Load test for the server against the local OpenAI stand-in (mock_openai.py).
+
+    python benchmark.py --app flask --duration 60 --concurrency 16 --json before.json
+    python benchmark.py --app asgi --duration 60 --concurrency 16 --compare before.json
+
+By default the benchmark starts mock_openai in-process and the server under
+gunicorn (gunicorn.conf.py, WEB_CONCURRENCY=--workers) with OPENAI_BASE_URL
+pointing at the mock and the job and question bank databases in a temporary
+directory, so every run starts from the same state. The per-client rate limit
+is off unless set with --env, since all the clients share one address. `--url` targets a server
+that is already running instead (point its OPENAI_BASE_URL at a mock started
+with `python mock_openai.py`); give its master's `--pid` to get memory figures.
+
+Each of the --concurrency clients sends one request at a time, picking the
+route from the weighted --mix (seeded by --seed): /latex and /text with the
+bundled p1.png and q1.png, /solve-math with a rotation of problems,
+/generate-quiz over a few topics and /evaluate-answers with answers that are
+partly graded locally and partly by the model. The report gives, per route
+and overall, requests, errors, req/s, p50/p95/p99 latency and the peak RSS of
+the server's process tree while requests to that route were in flight (read
+from /proc, so Linux only). `--json` saves it with the commit and settings;
+`--compare` prints the change against a saved run.
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import mock_openai
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ROUTES = ("latex", "text", "solve-math", "generate-quiz", "evaluate-answers")
+DEFAULT_MIX = "latex=2,text=1,solve-math=4,generate-quiz=1,evaluate-answers=2"
+
+PROBLEMS = [
+    "2x + 3 = 7",
+    "x^2 - 5x + 6 = 0",
+    "Find the derivative of x^3 sin(x)",
+    "Integrate 3x^2 + 2x dx",
+    "Solve the system x + y = 10, x - y = 2",
+    "Simplify (x^2 - 1)/(x + 1)",
+    "What is 15% of 240?",
+    "A train travels 120 km in 1.5 hours. What is its average speed?",
+]
+
+QUIZZES = [
+    ("Linear equations", "MCQs", "easy"),
+    ("Quadratic equations", "MCQs", "medium"),
+    ("Derivatives", "Short Questions", "medium"),
+    ("Probability", "MCQs", "hard"),
+    ("Trigonometric identities", "Short Questions", "hard"),
+]
+
+ANSWERS = [
+    {"question": "What is 7 x 8?", "answer": "56", "correctAnswer": "56"},
+    {"question": "Simplify 2/4", "answer": "0.5", "correctAnswer": "1/2"},
+    {"question": "Which is prime?", "answer": "B", "options": ["4", "7", "9", "12"], "correctAnswer": "7"},
+    {"question": "Why is the sky blue?", "answer": "Because of how air scatters sunlight",
+     "correctAnswer": "Rayleigh scattering of shorter wavelengths"},
+    {"question": "State the Pythagorean theorem", "answer": "the sides add up",
+     "correctAnswer": "a^2 + b^2 = c^2 for a right triangle"},
+    {"question": "What is a derivative?", "answer": "", "correctAnswer": "The instantaneous rate of change"},
+]
+
+
+def _data_uri(path):
+    with open(path, "rb") as f:
+        return "data:image/png;base64," + base64.b64encode(f.read()).decode("ascii")
+
+
+def payloads(rng):
+    """Returns route -> callable building one request body, for each of ROUTES."""
+    images = [_data_uri(os.path.join(HERE, name)) for name in ("p1.png", "q1.png")]
+    return {
+        "latex": lambda: {"uri": rng.choice(images)},
+        "text": lambda: {"uri": rng.choice(images)},
+        "solve-math": lambda: {"inputText": rng.choice(PROBLEMS)},
+        "generate-quiz": lambda: dict(zip(("topic", "quizType", "difficulty"), rng.choice(QUIZZES))),
+        "evaluate-answers": lambda: {"answers": rng.sample(ANSWERS, rng.randint(3, len(ANSWERS)))},
+    }
+
+
+def parse_mix(text):
+    """Parses "route=weight,..." into a dict, rejecting routes the benchmark can't build."""
+    mix = {}
+    for part in text.split(","):
+        route, _, weight = part.strip().partition("=")
+        if route not in ROUTES:
+            raise ValueError(f"Unknown route {route!r} in --mix")
+        mix[route] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def tree_rss(pid):
+    """
+    Returns the summed resident set size in bytes of a process and all its
+    descendants, or None where /proc isn't available.
+    """
+    if pid is None or not os.path.isdir("/proc"):
+        return None
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The process name can contain spaces; the parent pid follows its closing parenthesis
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending += children.get(current, [])
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class Recorder:
+    """Collects latencies per route and attributes memory samples to the routes in flight."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.in_flight = {}
+        self.peak_rss = {}
+        self.total_peak_rss = None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(0.1):
+            rss = tree_rss(self.pid)
+            if rss is None:
+                return
+            with self._lock:
+                self.total_peak_rss = max(self.total_peak_rss or 0, rss)
+                for route, count in self.in_flight.items():
+                    if count:
+                        self.peak_rss[route] = max(self.peak_rss.get(route, 0), rss)
+
+    def begin(self, route):
+        with self._lock:
+            self.in_flight[route] = self.in_flight.get(route, 0) + 1
+
+    def end(self, route, seconds, status):
+        with self._lock:
+            self.in_flight[route] -= 1
+            self.latencies.setdefault(route, []).append(seconds)
+            self.statuses.setdefault(route, {}).setdefault(status, 0)
+            self.statuses[route][status] += 1
+            if status == 0 or status >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def _client(url, deadline, count, rng, mix, recorder, headers, timeout):
+    builders = payloads(rng)
+    routes, weights = list(mix), list(mix.values())
+    parts = urlsplit(url)
+    conn = None
+    sent = 0
+    while time.perf_counter() < deadline and (count is None or sent < count):
+        route = rng.choices(routes, weights)[0]
+        body = json.dumps(builders[route]()).encode("utf-8")
+        sent += 1
+        recorder.begin(route)
+        started = time.perf_counter()
+        status = 0
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+            conn.request("POST", f"{parts.path.rstrip('/')}/{route}", body, headers)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            if response.getheader("Connection", "").lower() == "close":
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            if conn is not None:
+                conn.close()
+            conn = None
+        recorder.end(route, time.perf_counter() - started, status)
+    if conn is not None:
+        conn.close()
+
+
+def run_load(url, mix, concurrency, duration, requests_per_client, seed, pid, cache_bypass, timeout):
+    """
+    Drives the server with `concurrency` closed-loop clients.
+
+    Returns:
+        tuple: (Recorder, elapsed seconds).
+    """
+    recorder = Recorder(pid)
+    recorder.start()
+    deadline = time.perf_counter() + (duration if duration else float("inf"))
+    threads = []
+    for i in range(concurrency):
+        headers = {"Content-Type": "application/json", "X-Client-Id": f"bench-{i}"}
+        if cache_bypass:
+            headers["X-Cache-Bypass"] = "1"
+        # One generator per client keeps each client's sequence the same across runs
+        rng = random.Random(f"{seed}-{i}")
+        threads.append(threading.Thread(
+            target=_client,
+            args=(url, deadline, requests_per_client, rng, mix, recorder, headers, timeout),
+            daemon=True,
+        ))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    recorder.stop()
+    return recorder, elapsed
+
+
+def _summary(latencies, errors, elapsed, peak_rss, statuses=None):
+    ordered = sorted(latencies)
+    ms = lambda value: round(1000 * value, 1) if value is not None else None  # noqa: E731
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "reqPerSec": round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        "p50Ms": ms(percentile(ordered, 0.50)),
+        "p95Ms": ms(percentile(ordered, 0.95)),
+        "p99Ms": ms(percentile(ordered, 0.99)),
+        "maxMs": ms(ordered[-1] if ordered else None),
+        "peakRssMb": round(peak_rss / 2 ** 20, 1) if peak_rss else None,
+        "statuses": {str(k): v for k, v in sorted((statuses or {}).items())},
+    }
+
+
+def report(recorder, elapsed):
+    routes = {
+        route: _summary(latencies, recorder.errors.get(route, 0), elapsed,
+                        recorder.peak_rss.get(route), recorder.statuses.get(route))
+        for route, latencies in sorted(recorder.latencies.items())
+    }
+    statuses = {}
+    for counts in recorder.statuses.values():
+        for status, count in counts.items():
+            statuses[status] = statuses.get(status, 0) + count
+    total = _summary(
+        [value for latencies in recorder.latencies.values() for value in latencies],
+        sum(recorder.errors.values()), elapsed, recorder.total_peak_rss, statuses,
+    )
+    return routes, total
+
+
+_COLUMNS = (("requests", "reqs", 6), ("errors", "errs", 5), ("reqPerSec", "req/s", 8), ("p50Ms", "p50 ms", 9),
+            ("p95Ms", "p95 ms", 9), ("p99Ms", "p99 ms", 9), ("peakRssMb", "RSS MB", 8))
+
+
+def _cell(value, width):
+    return f"{'-' if value is None else value:>{width}}"
+
+
+def print_table(routes, total, baseline=None):
+    print(f"{'route':<18}" + "".join(_cell(title, width) for _, title, width in _COLUMNS))
+    rows = list(routes.items()) + [("total", total)]
+    for route, summary in rows:
+        print(f"{route:<18}" + "".join(_cell(summary[key], width) for key, _, width in _COLUMNS))
+        old = None
+        if baseline is not None:
+            old = baseline["total"] if route == "total" else baseline["routes"].get(route)
+        if old:
+            changes = []
+            for key, _, width in _COLUMNS:
+                before, after = old.get(key), summary[key]
+                if key in ("requests", "errors") or not before or after is None:
+                    changes.append(_cell("", width))
+                else:
+                    changes.append(_cell(f"{100 * (after - before) / before:+.1f}%", width))
+            print(f"{'  vs baseline':<18}" + "".join(changes))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _wait_ready(url, process, timeout):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with status {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request("GET", "/healthz")
+            if conn.getresponse().status == 200:
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"The server wasn't ready after {timeout:.0f}s")
+
+
+def start_server(app, port, mock_port, workers, state_dir, extra_env):
+    """
+    Starts the app under gunicorn, talking to the mock, with its output in
+    server.log in `state_dir`. Returns the Popen.
+    """
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"]
+    if app == "asgi":
+        command += ["-k", "uvicorn.workers.UvicornWorker"]
+    command.append(f"{app if app == 'asgi' else 'app'}:app")
+    env = dict(os.environ)
+    env.update({
+        "BIND": f"127.0.0.1:{port}",
+        "WEB_CONCURRENCY": str(workers),
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "OPENAI_API_KEY": "bench",
+        "JOBS_DB": os.path.join(state_dir, "jobs.db"),
+        "QUESTION_BANK_DB": os.path.join(state_dir, "question_bank.db"),
+        # The engines would otherwise be loaded in the master on every run
+        "PRELOAD_ENGINES": env.get("PRELOAD_ENGINES", ""),
+        # All the clients share one address; use --env ADMISSION_RATE=... to measure the limiter
+        "ADMISSION_RATE": env.get("ADMISSION_RATE", "0"),
+    })
+    env.update(extra_env)
+    with open(os.path.join(state_dir, "server.log"), "wb") as log:
+        return subprocess.Popen(command, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--app", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--pid", type=int, help="with --url: the server's master pid, for memory figures")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the started server, e.g. OCR_CACHE_SIZE=0")
+    parser.add_argument("--mock-port", type=int, default=8911)
+    parser.add_argument("--mock-latency", action="append", metavar="KIND=MEDIAN:SIGMA",
+                        help="see mock_openai.py; e.g. --mock-latency math=0.2:0")
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30, help="seconds; 0 to stop after --requests")
+    parser.add_argument("--requests", type=int, help="requests per client")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cache-bypass", action="store_true", help="send X-Cache-Bypass with every request")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--ready-timeout", type=float, default=180)
+    parser.add_argument("--json", help="save the report to this file")
+    parser.add_argument("--compare", help="a report saved with --json to compare against")
+    args = parser.parse_args()
+    if not args.duration and not args.requests:
+        parser.error("--duration 0 needs --requests")
+
+    mix = parse_mix(args.mix)
+    latencies = mock_openai.parse_latency(args.mock_latency)
+    mock_server, mock = mock_openai.serve(args.mock_port, latencies=latencies,
+                                          error_rate=args.mock_error_rate, seed=args.seed)
+    process = state_dir = None
+    url, pid = args.url, args.pid
+    try:
+        if url is None:
+            state_dir = tempfile.mkdtemp(prefix="kord-bench-")
+            extra_env = dict(item.split("=", 1) for item in args.env)
+            process = start_server(args.app, args.port, args.mock_port, args.workers, state_dir, extra_env)
+            url, pid = f"http://127.0.0.1:{args.port}", process.pid
+            try:
+                _wait_ready(url, process, args.ready_timeout)
+            except RuntimeError:
+                with open(os.path.join(state_dir, "server.log"), errors="replace") as f:
+                    print("".join(f.readlines()[-40:]), file=sys.stderr)
+                raise
+        if args.warmup:
+            run_load(url, mix, args.concurrency, args.warmup, None, f"warmup-{args.seed}", None,
+                     args.cache_bypass, args.timeout)
+            mock.reset()
+
+        recorder, elapsed = run_load(url, mix, args.concurrency, args.duration, args.requests, args.seed, pid,
+                                     args.cache_bypass, args.timeout)
+    finally:
+        if process is not None:
+            os.killpg(process.pid, signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+        mock_server.shutdown()
+        if state_dir is not None:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+    routes, total = report(recorder, elapsed)
+    result = {
+        "commit": _git_commit(),
+        "settings": {
+            "app": args.app if args.url is None else args.url,
+            "workers": args.workers if args.url is None else None,
+            "concurrency": args.concurrency,
+            "duration": round(elapsed, 2),
+            "mix": mix,
+            "seed": args.seed,
+            "cacheBypass": args.cache_bypass,
+            "mockLatency": {kind: list(value) for kind, value in latencies.items()},
+            "mockErrorRate": args.mock_error_rate,
+            "python": platform.python_version(),
+        },
+        "upstream": {"requests": mock.requests, "rateLimited": mock.rate_limited},
+        "routes": routes,
+        "total": total,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Baseline: commit {baseline.get('commit')}, {baseline['settings'].get('app')}")
+    print(f"Commit {result['commit']}, {result['settings']['app']}, {args.concurrency} clients, {elapsed:.1f}s")
+    print_table(routes, total, baseline)
+    print(f"Upstream calls: {mock.requests}, rate limited: {mock.rate_limited}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,572 @@
+"""
+Result caches for the server routes.
+
+Two tiers are used: a bounded in-process LRU with a TTL, and an optional SQLite
+file that survives restarts and can be shared by several processes on the same
+machine. Values must be JSON serialisable.
+"""
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache where every entry expires after `ttl` seconds.
+
+    With policy "lru" (the default) reads refresh an entry; with "fifo" entries
+    are evicted strictly in insertion order.
+    """
+
+    def __init__(self, max_size=512, ttl=3600, policy="lru"):
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.policy = policy
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return None
+            if self.policy == "lru":
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStore:
+    """
+    On-disk cache tier backed by a single SQLite table.
+    """
+
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)"
+        )
+        conn.commit()
+        # A forked worker must not reuse the parent's connections
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires),
+        )
+        conn.commit()
+
+    def delete(self, key):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        conn.commit()
+
+    def purge_expired(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+        conn.commit()
+
+
+class TieredCache:
+    """
+    Memory cache in front of an optional disk store, with hit/miss counters.
+
+    Args:
+        name: Label used in the stats report.
+        memory: The LRUCache tier.
+        disk: Optional SQLiteStore tier. Disk hits are promoted to memory.
+    """
+
+    def __init__(self, name, memory, disk=None):
+        self.name = name
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value, counter = self._lookup(key)
+        self._count(counter)
+        return value
+
+    def _lookup(self, key):
+        # Returns the value and the counter it belongs to, without counting
+        value = self.memory.get(key)
+        if value is not None:
+            return value, "hits"
+
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except sqlite3.Error as e:
+                print(f"Disk cache read failed for {self.name}: {e}")
+                value = None
+            if value is not None:
+                self.memory.set(key, value)
+                return value, "disk_hits"
+
+        return None, "misses"
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error as e:
+                print(f"Disk cache write failed for {self.name}: {e}")
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "diskHits": self.disk_hits,
+            "misses": self.misses,
+            "hitRate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "size": len(self.memory),
+            "evictions": self.memory.evictions,
+        }
+
+
+def build_cache(name, prefix):
+    """
+    Builds a TieredCache configured from `<prefix>_*` environment variables.
+
+    Args:
+        name: Label for the stats report.
+        prefix: Env var prefix, e.g. "OCR_CACHE" reads OCR_CACHE_SIZE, OCR_CACHE_TTL,
+            OCR_CACHE_POLICY and OCR_CACHE_DB.
+
+    Returns:
+        TieredCache: The configured cache.
+    """
+    ttl = float(os.getenv(f"{prefix}_TTL", "3600"))
+    memory = LRUCache(
+        max_size=int(os.getenv(f"{prefix}_SIZE", "512")),
+        ttl=ttl,
+        policy=os.getenv(f"{prefix}_POLICY", "lru"),
+    )
+    disk = None
+    db_path = os.getenv(f"{prefix}_DB")
+    if db_path:
+        disk = SQLiteStore(db_path, ttl=float(os.getenv(f"{prefix}_DB_TTL", str(ttl * 24))))
+    return TieredCache(name, memory, disk)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one execution.
+
+    The first caller for a key runs the function; callers that arrive while it
+    is still running wait for it and receive the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+            else:
+                self.shared += 1
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["event"].set()
+
+
+def cached_call(cache, flight, key, fn, bypass=False):
+    """
+    Returns `fn()` through the cache, with one upstream call in flight per key.
+
+    Args:
+        cache: The TieredCache to read and fill.
+        flight: The SingleFlight used to coalesce concurrent misses.
+        key: The cache key.
+        fn: Zero-argument callable that computes the value.
+        bypass: Skip the cache read (the fresh value is still stored).
+
+    Returns:
+        The cached or freshly computed value.
+    """
+    if bypass:
+        value = fn()
+        cache.set(key, value)
+        return value
+
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    def compute():
+        # A request that finished while we were waiting may already have filled the cache
+        value = cache.memory.get(key)
+        if value is None:
+            value = fn()
+            cache.set(key, value)
+        return value
+
+    return flight.do(key, compute)
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of SingleFlight for the ASGI app.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, fn):
+        import asyncio
+
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+
+async def async_cached_call(cache, flight, key, fn, bypass=False):
+    """
+    Same as cached_call, for an async `fn` and an AsyncSingleFlight.
+    """
+    if bypass:
+        value = await fn()
+        cache.set(key, value)
+        return value
+
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    async def compute():
+        value = cache.memory.get(key)
+        if value is None:
+            value = await fn()
+            cache.set(key, value)
+        return value
+
+    return await flight.do(key, compute)
+
+
+# ----------------------------------------------------------------------
+#  Image keys
+# ----------------------------------------------------------------------
+def decode_data_uri(uri):
+    """Returns the raw bytes of a `data:image/...;base64,...` URI (or bare base64)."""
+    import base64
+    payload = uri.split(",", 1)[1] if "," in uri else uri
+    return base64.b64decode(payload)
+
+
+def image_key(image_bytes, namespace, mode="exact", hash_size=16):
+    """
+    Builds a cache key from the decoded pixels of an image.
+
+    Hashing the pixels rather than the upload means EXIF or container changes
+    don't cause a miss. In "phash" mode a difference hash of a downscaled
+    grayscale copy is used instead; a re-encoded JPEG of the same scan gets a
+    hash a few bits away, which `ImageCache` matches by Hamming distance.
+
+    Args:
+        image_bytes: The encoded image file.
+        namespace: Prefix that separates results of different routes.
+        mode: "exact" or "phash".
+        hash_size: Side of the difference-hash grid in phash mode.
+
+    Returns:
+        str: The cache key.
+    """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_bytes))
+    if mode == "phash":
+        gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = gray.tobytes()
+        bits = 0
+        for row in range(hash_size):
+            offset = row * (hash_size + 1)
+            for col in range(hash_size):
+                bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+        return f"{namespace}:p:{bits:0{hash_size * hash_size // 4}x}"
+
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return f"{namespace}:x:{digest.hexdigest()}"
+
+
+class ImageCache:
+    """
+    Looks results up by image in a TieredCache.
+
+    Most repeated uploads are the very same file, so the raw bytes are hashed
+    first; only on a miss is the image decoded for its `image_key`. A result
+    is stored under both keys, and a pixel-key hit is copied to the raw key so
+    the next identical upload skips the decode.
+
+    In "phash" mode a hash that isn't stored is matched against the stored
+    ones within `max_distance` differing bits. The hash is cut into
+    max_distance + 1 bands, and two hashes that close must agree on at least
+    one whole band, so only the hashes sharing a band with the lookup are
+    compared. The bands are indexed in memory (the last `max_entries` hashes)
+    and, when the cache has a disk tier, in the same SQLite file so that other
+    processes and restarts find them too.
+
+    Args:
+        cache: The TieredCache holding the results.
+        mode: The `image_key` mode, "exact" or "phash".
+        hash_size: Side of the difference-hash grid in phash mode.
+        max_distance: Most differing hash bits still treated as the same image.
+        max_entries: Hashes kept in the in-memory band index.
+    """
+
+    def __init__(self, cache, mode="exact", hash_size=16, max_distance=10, max_entries=None):
+        if mode not in ("exact", "phash"):
+            raise ValueError(f"Unknown image key mode: {mode}")
+        self.cache = cache
+        self.mode = mode
+        self.hash_size = hash_size
+        self.max_distance = max_distance
+        self.max_entries = max_entries or cache.memory.max_size
+        self.near_hits = 0
+        bits = hash_size * hash_size
+        bands = min(max_distance + 1, bits)
+        self._bands = [(i * bits // bands, (i + 1) * bits // bands) for i in range(bands)]
+        self._hashes = OrderedDict()
+        self._index = {}
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        if mode == "phash" and cache.disk is not None:
+            try:
+                conn = cache.disk._conn()
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS image_bands "
+                    "(band TEXT NOT NULL, hash TEXT NOT NULL, expires REAL, PRIMARY KEY (band, hash))"
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Image band index unavailable for {cache.name}: {e}")
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+
+    def get(self, image_bytes, namespace):
+        """
+        Looks an image up.
+
+        Args:
+            image_bytes: The encoded image file.
+            namespace: Prefix that separates results of different routes.
+
+        Returns:
+            tuple: (value or None, keys). Pass `keys` to `set` after a miss.
+        """
+        raw_key = f"{namespace}:r:{hashlib.sha256(image_bytes).hexdigest()}"
+        value, counter = self.cache._lookup(raw_key)
+        if value is not None:
+            self.cache._count(counter)
+            return value, [raw_key]
+
+        key = image_key(image_bytes, namespace, self.mode, self.hash_size)
+        keys = [raw_key, key]
+        value, counter = self.cache._lookup(key)
+        if value is None and self.mode == "phash":
+            value, counter = self._nearest(namespace, int(key.rsplit(":", 1)[1], 16))
+            if value is not None:
+                with self._lock:
+                    self.near_hits += 1
+                self.set(keys, value)
+        elif value is not None:
+            self.cache.set(raw_key, value)
+        self.cache._count(counter)
+        return value, keys
+
+    def set(self, keys, value):
+        for key in keys:
+            self.cache.set(key, value)
+            namespace, kind, digest = key.rsplit(":", 2)
+            if kind == "p":
+                self._add(namespace, int(digest, 16))
+
+    def _band_keys(self, namespace, bits):
+        total = self.hash_size * self.hash_size
+        keys = []
+        for i, (start, end) in enumerate(self._bands):
+            band = (bits >> (total - end)) & ((1 << (end - start)) - 1)
+            keys.append(f"{namespace}:{i}:{band:x}")
+        return keys
+
+    def _key(self, namespace, bits):
+        return f"{namespace}:p:{bits:0{self.hash_size * self.hash_size // 4}x}"
+
+    def _add(self, namespace, bits):
+        bands = self._band_keys(namespace, bits)
+        with self._lock:
+            self._hashes[(namespace, bits)] = bands
+            self._hashes.move_to_end((namespace, bits))
+            for band in bands:
+                self._index.setdefault(band, set()).add(bits)
+            while len(self._hashes) > self.max_entries:
+                (_, old), old_bands = self._hashes.popitem(last=False)
+                for band in old_bands:
+                    members = self._index.get(band)
+                    if members is not None:
+                        members.discard(old)
+                        if not members:
+                            del self._index[band]
+        disk = self.cache.disk
+        if disk is None:
+            return
+        now = time.time()
+        expires = now + disk.ttl if disk.ttl else None
+        try:
+            conn = disk._conn()
+            conn.executemany(
+                "INSERT OR REPLACE INTO image_bands (band, hash, expires) VALUES (?, ?, ?)",
+                [(band, f"{bits:x}", expires) for band in bands],
+            )
+            if now - self._last_purge > 3600:
+                self._last_purge = now
+                conn.execute("DELETE FROM image_bands WHERE expires IS NOT NULL AND expires < ?", (now,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Image band index write failed for {self.cache.name}: {e}")
+
+    def _candidates(self, namespace, bits):
+        bands = self._band_keys(namespace, bits)
+        with self._lock:
+            found = set().union(*(self._index.get(band, ()) for band in bands))
+        if self.cache.disk is not None:
+            placeholders = ", ".join("?" * len(bands))
+            try:
+                rows = self.cache.disk._conn().execute(
+                    f"SELECT DISTINCT hash FROM image_bands WHERE band IN ({placeholders}) "
+                    "AND (expires IS NULL OR expires >= ?)",
+                    (*bands, time.time()),
+                ).fetchall()
+                found.update(int(row[0], 16) for row in rows)
+            except sqlite3.Error as e:
+                print(f"Image band index read failed for {self.cache.name}: {e}")
+        return found
+
+    def _nearest(self, namespace, bits):
+        # Closest stored hashes first; one may have expired from the cache since it was indexed
+        near = []
+        for candidate in self._candidates(namespace, bits):
+            distance = bin(candidate ^ bits).count("1")
+            if distance <= self.max_distance:
+                near.append((distance, candidate))
+        for _, candidate in sorted(near):
+            value, counter = self.cache._lookup(self._key(namespace, candidate))
+            if value is not None:
+                return value, counter
+        return None, "misses"
+
+    def stats(self):
+        return {"mode": self.mode, "nearHits": self.near_hits, "indexed": len(self._hashes)}
@@ -0,0 +1,69 @@
+"""
+Compares the eager pix2tex model with its ONNX export on sample images.
+
+    python compare_pix2tex.py --onnx-dir pix2tex-onnx p1.png [more.png ...]
+
+For every image and backend (eager torch, ONNX fp32 and, if exported, ONNX
+int8) it prints the median latency over --runs calls and the prediction, and
+whether the prediction matches the eager one exactly and after
+`normalize_latex`, plus a character-level similarity. The eager model samples
+at temperature 0.25 and the ONNX one decodes greedily; `--greedy` makes the
+eager model greedy too, as in pix2tex_onnx.py's parity check.
+"""
+import argparse
+import os
+import statistics
+import time
+
+from PIL import Image
+from rapidfuzz import fuzz
+
+from normalize import normalize_latex
+
+
+def _time(model, image, runs):
+    model(image)  # warm-up
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        prediction = model(image)
+        timings.append(time.perf_counter() - start)
+    return prediction, 1000 * statistics.median(timings)
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="*", default=[os.path.join(here, "p1.png")])
+    parser.add_argument("--onnx-dir", default="pix2tex-onnx")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--greedy", action="store_true", help="decode greedily with the eager model too")
+    args = parser.parse_args()
+
+    from pix2tex.cli import LatexOCR
+    from pix2tex_onnx import GREEDY_TEMPERATURE, OnnxLatexOCR
+
+    eager = LatexOCR()
+    if args.greedy:
+        eager.args.temperature = GREEDY_TEMPERATURE
+    backends = [("torch", eager), ("onnx", OnnxLatexOCR(args.onnx_dir))]
+    if os.path.exists(os.path.join(args.onnx_dir, "encoder.int8.onnx")):
+        backends.append(("onnx-int8", OnnxLatexOCR(args.onnx_dir, int8=True)))
+
+    for path in args.images:
+        image = Image.open(path).convert("RGB")
+        print(f"\n{path}")
+        reference = None
+        for name, model in backends:
+            prediction, ms = _time(model, image, args.runs)
+            if reference is None:
+                reference = prediction
+            exact = prediction == reference
+            normalized = normalize_latex(prediction) == normalize_latex(reference)
+            similarity = fuzz.ratio(prediction, reference)
+            print(f"  {name:<10} {ms:8.1f} ms  exact={exact!s:<5} normalized={normalized!s:<5} "
+                  f"similarity={similarity:5.1f}  {prediction}")
+
+
+if __name__ == "__main__":
+    main()
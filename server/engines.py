@@ -0,0 +1,174 @@
+"""
+Lazy registry for the local OCR engines used by the server.
+
+Importing torch/pix2tex or building a LatexOCR model takes seconds and a few
+hundred MB of memory, so nothing heavy is imported here. Each engine is
+registered with a loader that runs the first time a route asks for it (or when
+a warm-up is requested), and the result is kept for the life of the process.
+"""
+import os
+import threading
+import time
+
+
+_loaders = {}
+_engines = {}
+_load_seconds = {}
+_errors = {}
+# One lock per engine, so a slow load (pix2tex) doesn't hold up the others
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def register(name, loader):
+    """
+    Registers a loader for an engine.
+
+    Args:
+        name: The name routes use to look the engine up.
+        loader: A zero-argument callable that builds and returns the engine.
+    """
+    _loaders[name] = loader
+
+
+def get(name):
+    """
+    Returns an engine, loading it on first use.
+
+    Args:
+        name: The registered engine name.
+
+    Returns:
+        The loaded engine object.
+    """
+    engine = _engines.get(name)
+    if engine is not None:
+        return engine
+
+    if name not in _loaders:
+        raise KeyError(f"Unknown engine: {name}")
+
+    with _locks_guard:
+        lock = _locks.setdefault(name, threading.Lock())
+
+    with lock:
+        # Another thread may have finished loading while we waited for the lock
+        engine = _engines.get(name)
+        if engine is not None:
+            return engine
+
+        print(f"Loading engine '{name}'...")
+        start = time.perf_counter()
+        try:
+            engine = _loaders[name]()
+        except Exception as e:
+            _errors[name] = str(e)
+            raise
+        _load_seconds[name] = time.perf_counter() - start
+        _errors.pop(name, None)
+        _engines[name] = engine
+        print(f"Engine '{name}' loaded in {_load_seconds[name]:.2f}s")
+        return engine
+
+
+def is_loaded(name):
+    return name in _engines
+
+
+def status():
+    """
+    Reports the state of every registered engine.
+
+    Returns:
+        dict: Engine name mapped to its loaded flag, load time, last error and,
+            for engines that keep counters, their `stats()`.
+    """
+    report = {}
+    for name in _loaders:
+        report[name] = {
+            "loaded": name in _engines,
+            "loadSeconds": round(_load_seconds[name], 3) if name in _load_seconds else None,
+            "error": _errors.get(name),
+        }
+        engine = _engines.get(name)
+        if engine is not None and hasattr(engine, "stats"):
+            report[name]["stats"] = engine.stats()
+    return report
+
+
+def warm_up(names, background=True):
+    """
+    Loads the given engines ahead of the first request.
+
+    Args:
+        names: Iterable of engine names.
+        background: Load on a daemon thread so the server can start serving immediately.
+
+    Returns:
+        threading.Thread or None: The warm-up thread when running in the background.
+    """
+    names = [name for name in names if name]
+
+    def run():
+        for name in names:
+            try:
+                get(name)
+            except Exception as e:
+                print(f"Warm-up of engine '{name}' failed: {e}")
+
+    if not background:
+        run()
+        return None
+
+    thread = threading.Thread(target=run, name="engine-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def parse_engine_list(value):
+    """Splits a comma separated env value like "tesseract,pix2tex" into names."""
+    return [name.strip() for name in (value or "").split(",") if name.strip()]
+
+
+# ----------------------------------------------------------------------
+#  Built-in engines
+# ----------------------------------------------------------------------
+def _load_pix2tex():
+    from pix2tex_batcher import BatchedLatexOCR, configure_torch_threads
+
+    # PIX2TEX_BACKEND=onnx serves the graphs written by pix2tex_onnx.py, once they passed its parity check
+    if os.getenv("PIX2TEX_BACKEND", "torch") == "onnx":
+        from pix2tex_onnx import OnnxLatexOCR, verified
+
+        model_dir = os.getenv("PIX2TEX_ONNX_DIR", "pix2tex-onnx")
+        int8 = os.getenv("PIX2TEX_INT8", "0") == "1"
+        ok, reason = verified(model_dir, int8)
+        print(f"pix2tex ONNX graphs {'in use' if ok else 'not used, keeping the eager model'}: {reason}")
+        if ok:
+            return BatchedLatexOCR(OnnxLatexOCR(model_dir, int8=int8))
+
+    from pix2tex.cli import LatexOCR
+
+    configure_torch_threads()
+    return BatchedLatexOCR(LatexOCR())
+
+
+def _load_tesseract():
+    from tesseract_pool import TesseractPool
+
+    size = int(os.getenv("TESSERACT_WORKERS", "0")) or None
+    return TesseractPool(
+        size=size,
+        lang=os.getenv("TESSERACT_LANG", "eng"),
+        backend=os.getenv("TESSERACT_BACKEND", "auto"),
+    )
+
+
+def _load_latex2text():
+    from pylatexenc.latex2text import LatexNodes2Text
+    return LatexNodes2Text()
+
+
+register("pix2tex", _load_pix2tex)
+register("tesseract", _load_tesseract)
+register("latex2text", _load_latex2text)
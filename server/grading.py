@@ -0,0 +1,376 @@
+"""
+Local pre-grading for /evaluate-answers.
+
+Many answers don't need a model to grade: blank answers, an MCQ option that is
+or isn't the correct one, "0.5" against a reference of "1/2". `grade` scores
+each answer locally when it can, forwards only the unresolved ones to the
+model, and merges the scores back in the original order.
+
+Local rules, in order (the first that decides wins):
+
+    exact       same text after case/space/punctuation folding -> 5
+    unanswered  blank / "Not Answered"                       -> 1
+    option      the answer picks an MCQ option (or its letter) -> 5 or 1
+    math        both sides parse as math and are SymPy-equivalent -> 5
+    fuzzy       rapidfuzz token_sort_ratio >= GRADER_ACCEPT_SIMILARITY -> 5
+
+A high similarity says little when the few characters that differ carry the
+meaning, so the option and fuzzy rules only decide when both sides have the
+same numbers, negations and single-letter variables ("100 degrees" vs "10
+degrees", "is not" vs "is"), and the math rule only when both name the same
+variable ("x = 4" vs "y = 4"). The rest goes to the model.
+
+Everything except the "unanswered" rule needs a reference answer: the item's
+`correctAnswer` or `reference`. The routes only pass the keys stored when the
+quiz was served (see answer_keys.py), never ones the client sent. Set
+GRADER_LOCAL=0 to send every answer to the model.
+
+The unresolved answers are split into chunks of GRADING_CHUNK_SIZE and graded
+concurrently, at most GRADING_PARALLELISM requests at a time, so a long exam
+takes about as long as one chunk. A chunk that fails or comes back with the
+wrong number of scores is retried GRADING_RETRIES times on its own, then
+graded one answer at a time; an answer that still can't be graded gets a
+score of 0 and a note instead of failing the whole submission.
+"""
+import asyncio
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+GRADER_LOCAL = os.getenv("GRADER_LOCAL", "1") == "1"
+GRADER_ACCEPT_SIMILARITY = float(os.getenv("GRADER_ACCEPT_SIMILARITY", "90"))
+GRADING_CHUNK_SIZE = max(1, int(os.getenv("GRADING_CHUNK_SIZE", "8")))
+GRADING_PARALLELISM = max(1, int(os.getenv("GRADING_PARALLELISM", "4")))
+GRADING_RETRIES = int(os.getenv("GRADING_RETRIES", "1"))
+
+UNGRADED = {"score": 0, "feedback": "This answer could not be graded right now. Please try again."}
+
+# Only unmistakable phrases: "NA" or "N/A" can be the answer (sodium, not applicable)
+_UNANSWERED = {"", "not answered", "no answer", "idk", "i don't know", "i dont know"}
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+_OPTION_LETTER = re.compile(r"^\(?([a-d])[\).:]?$")
+# Plain-text math: numbers, operators and single-letter variables (checked again below)
+_PLAIN_MATH = re.compile(r"^[0-9A-Za-z\s.+\-*/^()=,]+$")
+_IDENTIFIER = re.compile(r"[A-Za-z]+")
+_MATH_FUNCTIONS = {"sqrt", "pi", "sin", "cos", "tan", "log", "ln", "exp"}
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+_CONTRACTED_NOT = re.compile(r"\b(is|are|was|were|do|does|did|ca|wo|could|should|would|has|have|had)n['’]?t\b")
+_NEGATIONS = {"not", "no", "never", "none", "nor", "neither", "without", "nothing", "nobody"}
+
+_lock = threading.Lock()
+_counts = {"local": 0, "llm": 0, "chunks": 0, "retries": 0, "ungraded": 0}
+_rules = {}
+
+
+class MismatchedScores(ValueError):
+    """Raised when the model returns a different number of scores than it was sent."""
+
+
+def _fold(text):
+    return _SPACES.sub(" ", str(text).replace("$", "")).strip().casefold().rstrip(".")
+
+
+def _fuzzy_key(text):
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", _fold(text))).strip()
+
+
+def _meaning(text):
+    """
+    The tokens a fuzzy match must not gloss over: numbers, negations ("isn't"
+    and "cannot" count as "not") and single-letter words.
+    """
+    folded = _CONTRACTED_NOT.sub(r"\1 not", _fold(text).replace("cannot", "can not"))
+    words = _fuzzy_key(_NUMBER.sub(" ", folded)).split()
+    return (
+        sorted(number.replace(",", "") for number in _NUMBER.findall(folded)),
+        sorted(word for word in words if word in _NEGATIONS),
+        sorted(word for word in words if len(word) == 1 and word not in ("a", "i")),
+    )
+
+
+def _lhs(text):
+    text = str(text).strip().strip("$")
+    return _fold(text.rsplit("=", 1)[0]).replace(" ", "") if "=" in text else None
+
+
+def _math_value(text):
+    """
+    Parses an answer like "4", "0.5", "x = 3/4" or "\\frac{3}{4}" into a SymPy
+    expression, or returns None. Only strings built from numbers, operators,
+    single-letter variables and a few function names reach `parse_expr`.
+    """
+    from sympy import Expr, Float, nsimplify
+
+    text = str(text).strip().strip("$").strip()
+    if not text or len(text) > 100:
+        return None
+    if "=" in text:
+        # "x = 4": grade the right-hand side
+        text = text.rsplit("=", 1)[1].strip()
+
+    try:
+        if "\\" in text:
+            from sympy.parsing.latex import parse_latex
+
+            value = parse_latex(text)
+        else:
+            if not _PLAIN_MATH.match(text):
+                return None
+            words = _IDENTIFIER.findall(text)
+            if any(len(word) > 1 and word.lower() not in _MATH_FUNCTIONS for word in words):
+                return None
+            from sympy.parsing.sympy_parser import (
+                convert_xor,
+                implicit_multiplication_application,
+                parse_expr,
+                standard_transformations,
+            )
+
+            transformations = standard_transformations + (implicit_multiplication_application, convert_xor)
+            value = parse_expr(text, transformations=transformations)
+    except Exception:
+        return None
+
+    # "1,000" and "(1, 2)" parse as tuples
+    if not isinstance(value, Expr):
+        return None
+    if value.has(Float):
+        value = nsimplify(value, rational=True)
+    return value
+
+
+def _math_rule(answer, reference):
+    a, b = _math_value(answer), _math_value(reference)
+    if a is None or b is None:
+        return None
+    if None not in (_lhs(answer), _lhs(reference)) and _lhs(answer) != _lhs(reference):
+        return None
+    try:
+        equal = (a - b).equals(0)
+    except Exception:
+        return None
+    if equal:
+        return 5, "Correct. Your answer is equivalent to the expected answer."
+    # Different values may still be a fair rounding (9.8 for 9.81, 3.14 for pi): the model decides
+    return None
+
+
+def _option_rule(answer, reference, options):
+    folded = _fold(answer)
+    letter = _OPTION_LETTER.match(folded)
+    if letter and ord(letter.group(1)) - ord("a") < len(options):
+        folded = _fold(options[ord(letter.group(1)) - ord("a")])
+
+    from rapidfuzz import fuzz, process
+
+    keys = [_fuzzy_key(option) for option in options]
+    match = process.extractOne(_fuzzy_key(folded), keys, scorer=fuzz.token_sort_ratio)
+    if match is None or match[1] < GRADER_ACCEPT_SIMILARITY or _meaning(folded) != _meaning(options[match[2]]):
+        return None
+    if keys[match[2]] == _fuzzy_key(reference):
+        return 5, "Correct."
+    return 1, f"Incorrect. The correct answer is {reference}."
+
+
+def local_grade(item):
+    """
+    Grades one answer without the model when a local rule decides it.
+
+    Args:
+        item: An element of the request's `answers` list.
+
+    Returns:
+        tuple or None: (rule, {"score": ..., "feedback": ...}), or None when
+            the answer needs the model.
+    """
+    answer = item.get("answer")
+    reference = item.get("correctAnswer") or item.get("reference")
+    has_reference = reference is not None and str(reference).strip()
+    # Checked first, so an answer that happens to read like a blank still counts
+    if answer is not None and has_reference and _fold(answer) == _fold(reference):
+        return "exact", {"score": 5, "feedback": "Correct."}
+
+    if answer is None or _fold(answer) in _UNANSWERED:
+        return "unanswered", {"score": 1, "feedback": "No answer was given."}
+    if not has_reference:
+        return None
+
+    options = item.get("options")
+    if isinstance(options, list) and options:
+        decided = _option_rule(answer, reference, options)
+        if decided:
+            return "option", {"score": decided[0], "feedback": decided[1]}
+
+    decided = _math_rule(answer, reference)
+    if decided:
+        return "math", {"score": decided[0], "feedback": decided[1]}
+
+    from rapidfuzz import fuzz
+
+    if (
+        fuzz.token_sort_ratio(_fuzzy_key(answer), _fuzzy_key(reference)) >= GRADER_ACCEPT_SIMILARITY
+        and _meaning(answer) == _meaning(reference)
+    ):
+        return "fuzzy", {"score": 5, "feedback": "Correct."}
+    return None
+
+
+def _split(user_answers):
+    results = [None] * len(user_answers)
+    rules = []
+    if GRADER_LOCAL:
+        for i, item in enumerate(user_answers):
+            try:
+                decided = local_grade(item if isinstance(item, dict) else {})
+            except Exception as e:
+                # A rule that trips over an odd answer leaves it to the model
+                print("Local grading failed:", e)
+                decided = None
+            if decided:
+                rules.append(decided[0])
+                results[i] = decided[1]
+    pending = [i for i, result in enumerate(results) if result is None]
+    return results, pending, rules
+
+
+def _merge(user_answers, results, pending, rules, scores):
+    import llm
+
+    if len(scores) != len(pending):
+        raise MismatchedScores("AI returned mismatched number of scores.")
+    for i, score in zip(pending, scores):
+        results[i] = score
+    _record(rules, len(pending))
+    return llm.merge_evaluations(user_answers, results)
+
+
+def _chunks(items):
+    return [items[i:i + GRADING_CHUNK_SIZE] for i in range(0, len(items), GRADING_CHUNK_SIZE)]
+
+
+def _checked(chunk, scores):
+    if isinstance(scores, list) and len(scores) == len(chunk):
+        return scores
+    print(f"Grading chunk of {len(chunk)} came back with {len(scores) if isinstance(scores, list) else 'no'} scores")
+    return None
+
+
+def _grade_chunk(chunk, grade_with_llm):
+    for attempt in range(GRADING_RETRIES + 1):
+        if attempt:
+            _count("retries")
+        try:
+            scores = _checked(chunk, grade_with_llm(chunk))
+        except Exception as e:
+            print("Grading chunk failed:", e)
+            scores = None
+        if scores is not None:
+            return scores
+
+    if len(chunk) > 1:
+        # One troublesome answer shouldn't sink the rest of its chunk
+        return [score for item in chunk for score in _grade_chunk([item], grade_with_llm)]
+    _count("ungraded")
+    return [dict(UNGRADED)]
+
+
+async def _agrade_chunk(chunk, grade_with_llm):
+    for attempt in range(GRADING_RETRIES + 1):
+        if attempt:
+            _count("retries")
+        try:
+            scores = _checked(chunk, await grade_with_llm(chunk))
+        except Exception as e:
+            print("Grading chunk failed:", e)
+            scores = None
+        if scores is not None:
+            return scores
+
+    if len(chunk) > 1:
+        scores = []
+        for item in chunk:
+            scores += await _agrade_chunk([item], grade_with_llm)
+        return scores
+    _count("ungraded")
+    return [dict(UNGRADED)]
+
+
+def _fan_out(items, grade_with_llm):
+    chunks = _chunks(items)
+    _count("chunks", len(chunks))
+    if len(chunks) == 1:
+        return _grade_chunk(chunks[0], grade_with_llm)
+    with ThreadPoolExecutor(max_workers=min(GRADING_PARALLELISM, len(chunks))) as pool:
+        graded = list(pool.map(lambda chunk: _grade_chunk(chunk, grade_with_llm), chunks))
+    return [score for scores in graded for score in scores]
+
+
+async def _afan_out(items, grade_with_llm):
+    chunks = _chunks(items)
+    _count("chunks", len(chunks))
+    semaphore = asyncio.Semaphore(GRADING_PARALLELISM)
+
+    async def run(chunk):
+        async with semaphore:
+            return await _agrade_chunk(chunk, grade_with_llm)
+
+    graded = await asyncio.gather(*(run(chunk) for chunk in chunks))
+    return [score for scores in graded for score in scores]
+
+
+def grade(user_answers, grade_with_llm):
+    """
+    Grades a submission, asking the model only about answers no local rule decides.
+
+    Args:
+        user_answers: The request's `answers` list.
+        grade_with_llm: Callable taking a chunk of unresolved items and
+            returning their {"score", "feedback"} dicts in the same order.
+            Called concurrently from several threads.
+
+    Returns:
+        list: The `{question, answer, score, feedback}` results, in order.
+    """
+    results, pending, rules = _split(user_answers)
+    scores = _fan_out([user_answers[i] for i in pending], grade_with_llm) if pending else []
+    return _merge(user_answers, results, pending, rules, scores)
+
+
+async def agrade(user_answers, grade_with_llm):
+    """Same as `grade`, with a coroutine function for the model call."""
+    results, pending, rules = _split(user_answers)
+    scores = await _afan_out([user_answers[i] for i in pending], grade_with_llm) if pending else []
+    return _merge(user_answers, results, pending, rules, scores)
+
+
+def _count(name, amount=1):
+    with _lock:
+        _counts[name] += amount
+
+
+def _record(rules, llm_count):
+    with _lock:
+        _counts["local"] += len(rules)
+        _counts["llm"] += llm_count
+        for rule in rules:
+            _rules[rule] = _rules.get(rule, 0) + 1
+
+
+def stats():
+    """
+    Returns how many answers were graded locally (by rule) and by the model.
+    """
+    with _lock:
+        total = _counts["local"] + _counts["llm"]
+        return {
+            "enabled": GRADER_LOCAL,
+            "local": _counts["local"],
+            "llm": _counts["llm"],
+            "localRate": round(_counts["local"] / total, 4) if total else 0.0,
+            "rules": dict(_rules),
+            "chunks": _counts["chunks"],
+            "retries": _counts["retries"],
+            "ungraded": _counts["ungraded"],
+        }
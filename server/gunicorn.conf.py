@@ -0,0 +1,79 @@
+"""
+Pre-fork serving mode: one master loads the models, workers share them.
+
+    gunicorn -c gunicorn.conf.py app:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+With `preload_app` the app is imported in the master, which also loads
+PRELOAD_ENGINES (default "pix2tex") before any worker is forked. The torch
+weights are moved to shared memory and the master's heap is frozen out of the
+garbage collector, so workers map the master's copy instead of each importing
+torch and building their own LatexOCR. Workers are recycled after
+MAX_REQUESTS requests and are simply forked again from the master, without
+reloading anything.
+
+Each worker gets PIX2TEX_THREADS torch threads, by default the core count
+divided by the number of workers, so one worker per core runs single-threaded
+inference. WARMUP_ENGINES is applied per worker after the fork: engines
+that start threads or hold native handles (Tesseract, ONNX Runtime sessions)
+don't survive fork() and must not be loaded in the master.
+"""
+import gc
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import engines  # noqa: E402
+import symbolic  # noqa: E402
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = True
+max_requests = int(os.getenv("MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "100"))
+
+PRELOAD_ENGINES = engines.parse_engine_list(os.getenv("PRELOAD_ENGINES", "pix2tex"))
+# The app would otherwise start its background warm-up in the master
+WORKER_WARMUP = engines.parse_engine_list(os.environ.pop("WARMUP_ENGINES", ""))
+
+
+def _fork_safe(name):
+    if name == "tesseract":
+        return False
+    if name == "pix2tex":
+        return os.getenv("PIX2TEX_BACKEND", "torch") != "onnx"
+    return True
+
+
+def when_ready(server):
+    preload = [name for name in PRELOAD_ENGINES if _fork_safe(name)]
+    for name in set(PRELOAD_ENGINES) - set(preload):
+        server.log.info(f"Engine '{name}' is not fork-safe; loading it per worker instead")
+        WORKER_WARMUP.append(name)
+
+    engines.warm_up(preload, background=False)
+    for name in preload:
+        engine = engines.get(name) if engines.is_loaded(name) else None
+        if hasattr(engine, "share_memory"):
+            engine.share_memory()
+
+    # The app started importing SymPy in the background; forking mid-import breaks it in every worker
+    symbolic.wait_warm_up()
+
+    # Keep the collector from touching (and so copying) every preloaded object in each worker
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if "torch" in sys.modules:
+        from pix2tex_batcher import PIX2TEX_THREADS, configure_torch_threads
+
+        configure_torch_threads(PIX2TEX_THREADS or max(1, multiprocessing.cpu_count() // server.cfg.workers))
+
+    engines.warm_up(WORKER_WARMUP)
@@ -0,0 +1,260 @@
+"""
+Image decoding and preprocessing for the OCR routes.
+
+OpenCV and NumPy are imported inside the functions so that importing this
+module stays cheap for processes that only serve the LLM routes.
+
+The /text pipeline decodes straight from the request bytes with
+`cv2.imdecode`, asks libjpeg for a reduced-size decode when the photo is far
+larger than OCR needs, downscales to OCR_MAX_SIDE and thresholds into
+per-thread buffers that are reused across requests.
+"""
+import io
+import os
+import threading
+import time
+
+from PIL import Image
+
+import engines
+import metrics
+
+
+# Longest side, in pixels, that the OCR input is reduced to. Printed text on a
+# phone photo of a page is still ~25px tall at this size, which is what
+# Tesseract is trained on; larger inputs only cost time.
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "2000"))
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stage_totals = {}
+_peak_buffer_bytes = 0
+
+
+def _buffer(name, shape):
+    """
+    Returns a uint8 array of `shape` backed by a per-thread buffer that is
+    grown as needed and reused by later calls on the same thread.
+    """
+    import numpy as np
+
+    global _peak_buffer_bytes
+
+    buffers = getattr(_local, "buffers", None)
+    if buffers is None:
+        buffers = _local.buffers = {}
+
+    size = shape[0] * shape[1]
+    buf = buffers.get(name)
+    if buf is None or buf.size < size:
+        buf = buffers[name] = np.empty(size, np.uint8)
+        total = sum(b.nbytes for b in buffers.values())
+        with _stats_lock:
+            _peak_buffer_bytes = max(_peak_buffer_bytes, total)
+    return buf[:size].reshape(shape)
+
+
+def _record(timings):
+    for stage, seconds in timings.items():
+        metrics.observe_stage(stage, seconds)
+    with _stats_lock:
+        for stage, seconds in timings.items():
+            count, total, peak = _stage_totals.get(stage, (0, 0.0, 0.0))
+            _stage_totals[stage] = (count + 1, total + seconds, max(peak, seconds))
+
+
+def pipeline_stats():
+    """
+    Returns the average and maximum time spent in each preprocessing stage.
+    """
+    with _stats_lock:
+        stages = {
+            stage: {
+                "count": count,
+                "avgMs": round(1000 * total / count, 3),
+                "maxMs": round(1000 * peak, 3),
+            }
+            for stage, (count, total, peak) in _stage_totals.items()
+        }
+        return {"stages": stages, "peakBufferBytes": _peak_buffer_bytes}
+
+
+def decode_grayscale(image_data, max_side=OCR_MAX_SIDE):
+    """
+    Decodes an encoded image straight into a single-channel array.
+
+    JPEGs much larger than `max_side` are decoded at 1/2, 1/4 or 1/8 scale by
+    libjpeg itself, which is far cheaper than decoding at full size and
+    resizing afterwards.
+
+    Args:
+        image_data: The raw bytes of the uploaded image.
+        max_side: The size the caller will reduce the image to.
+
+    Returns:
+        numpy.ndarray: The grayscale image.
+    """
+    import cv2
+    import numpy as np
+
+    reduced_flags = {
+        1: cv2.IMREAD_GRAYSCALE,
+        2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+
+    factor = 1
+    try:
+        # Only reads the header
+        with Image.open(io.BytesIO(image_data)) as probe:
+            if probe.format == "JPEG":
+                longest = max(probe.size)
+                while factor < 8 and longest // (factor * 2) >= max_side:
+                    factor *= 2
+    except Exception:
+        pass
+
+    # np.frombuffer wraps the request bytes without copying them
+    gray = cv2.imdecode(np.frombuffer(image_data, np.uint8), reduced_flags[factor])
+    if gray is None:
+        raise ValueError("Could not decode image")
+    return gray
+
+
+def preprocess_gray(gray, max_side=OCR_MAX_SIDE, timings=None):
+    """
+    Downscales, blurs and binarises a grayscale image for OCR.
+
+    The result is a view into a per-thread buffer: it stays valid until the
+    next call on the same thread, so copy it if it has to outlive the request.
+
+    Args:
+        gray: A 2-D uint8 array.
+        max_side: Longest side of the OCR input.
+        timings: Optional dict that receives the seconds spent in each stage.
+
+    Returns:
+        numpy.ndarray: The binary image.
+    """
+    import cv2
+
+    timings = {} if timings is None else timings
+
+    start = time.perf_counter()
+    height, width = gray.shape
+    scale = max_side / max(height, width)
+    if scale < 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        resized = _buffer("resized", (size[1], size[0]))
+        cv2.resize(gray, size, dst=resized, interpolation=cv2.INTER_AREA)
+        gray = resized
+    timings["resize"] = time.perf_counter() - start
+
+    # Apply Gaussian blur to remove noise
+    start = time.perf_counter()
+    blur = _buffer("blur", gray.shape)
+    cv2.GaussianBlur(gray, (5, 5), 0, dst=blur)
+    timings["blur"] = time.perf_counter() - start
+
+    # Apply adaptive thresholding to get a binary image
+    start = time.perf_counter()
+    binary = _buffer("binary", gray.shape)
+    cv2.adaptiveThreshold(blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2, dst=binary)
+    timings["threshold"] = time.perf_counter() - start
+
+    return binary
+
+
+def image_processing(image):
+    """
+    Processes an image for OCR.
+
+    Args:
+        image: The PIL Image object to be processed.
+
+    Returns:
+        img: The processed image ready for OCR.
+    """
+    import cv2
+    import numpy as np
+
+    try:
+        # np.asarray shares the PIL buffer instead of copying it
+        img = np.asarray(image)
+
+        if len(img.shape) == 2:  # Grayscale image
+            gray = img
+        elif img.shape[2] == 4:  # RGBA image
+            gray = cv2.cvtColor(img, cv2.COLOR_RGBA2GRAY)
+        else:  # RGB image
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+        timings = {}
+        binary = preprocess_gray(gray, timings=timings)
+        _record(timings)
+
+        # Copy out of the reusable buffer, the caller owns this image
+        return Image.fromarray(binary.copy())
+    except Exception as e:
+        raise ValueError(f"Error in image processing: {str(e)}")
+
+
+def image_processing2(image):
+    """
+    Minimal processing for LatexOCR.
+    """
+    # 1. Convert to RGB (standard for most ML models)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    # 2. (Optional) Resize if the image is massive (e.g. > 2000px width) to speed up
+    # Standard phone photos are fine, but ensure it's not tiny.
+
+    return image
+
+
+def _run_ocr(image_data, method):
+    timings = {}
+    try:
+        start = time.perf_counter()
+        gray = decode_grayscale(image_data)
+        timings["decode"] = time.perf_counter() - start
+
+        binary = preprocess_gray(gray, timings=timings)
+    except Exception as e:
+        raise ValueError(f"Error in image processing: {str(e)}")
+
+    # Wrap the buffer without copying; OCR finishes before this thread reuses it
+    height, width = binary.shape
+    img = Image.frombuffer("L", (width, height), binary, "raw", "L", 0, 1)
+
+    # Convert the processed image to text format using Tesseract OCR
+    start = time.perf_counter()
+    result = getattr(engines.get('tesseract'), method)(img)
+    timings["ocr"] = time.perf_counter() - start
+    _record(timings)
+    return result
+
+
+def extract_text(image_data):
+    """
+    Runs the /text pipeline on an encoded image: decode, preprocess and Tesseract.
+
+    Args:
+        image_data: The raw bytes of the uploaded image.
+
+    Returns:
+        str: The recognized text.
+    """
+    return _run_ocr(image_data, "image_to_string")
+
+
+def recognize_text(image_data):
+    """
+    Same pipeline as extract_text, also returning Tesseract's per-word confidences.
+
+    Returns:
+        tuple: (text, list of word confidences from 0 to 100)
+    """
+    return _run_ocr(image_data, "recognize")
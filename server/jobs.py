@@ -0,0 +1,272 @@
+"""
+Asynchronous jobs for the slow routes.
+
+Instead of holding a connection open for the whole request, a client can
+submit it as a job and collect the result later:
+
+    POST /jobs       {"route": "solve-math", "payload": {"inputText": "..."}}
+                     Idempotency-Key: <client-chosen key>
+                  -> 202 {"id": "...", "status": "queued", ...}
+    GET  /jobs/<id>?wait=20
+                  -> 200 {"id": "...", "status": "done", "httpStatus": 200, "result": {...}}
+
+A job runs the route's existing handler on a worker pool (JOBS_WORKERS) and
+its result, including error responses, is kept in a SQLite file (JOBS_DB)
+for JOBS_TTL seconds. `wait` long-polls for up to JOBS_MAX_WAIT seconds.
+
+Submitting again with the same Idempotency-Key (header, or "idempotencyKey"
+in the body) returns the existing job, finished or not, instead of running
+the work twice; reusing a key for a different request is rejected. Several
+processes can share the file, so a job can be polled from any of them.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.db"))
+JOBS_TTL = float(os.getenv("JOBS_TTL", "86400"))
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "8"))
+JOBS_MAX_WAIT = float(os.getenv("JOBS_MAX_WAIT", "30"))
+# How often a long-poll re-reads a job that another process is running
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "0.25"))
+# A job still unfinished after this long was lost with its process
+JOBS_STALE_AFTER = float(os.getenv("JOBS_STALE_AFTER", "600"))
+
+# The JSON routes a job can run
+JOB_ROUTES = ("latex", "text", "solve-problem", "solve-math", "generate-quiz", "evaluate-answers")
+# Request headers passed on to the route
+FORWARDED_HEADERS = ("X-Client-Id", "X-Cache-Bypass")
+
+_PURGE_INTERVAL = 60
+
+
+class JobError(ValueError):
+    """Raised for a job submission that can't be accepted; carries the HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_submission(data, headers):
+    """
+    Validates a POST /jobs body.
+
+    Returns:
+        tuple: (route, payload, idempotency key or None, forwarded headers).
+
+    Raises:
+        JobError: If the route isn't one a job can run or the payload is missing.
+    """
+    if not isinstance(data, dict):
+        raise JobError("Invalid input data")
+    route = str(data.get("route") or "").strip("/")
+    if route not in JOB_ROUTES:
+        raise JobError(f"route must be one of: {', '.join(JOB_ROUTES)}")
+    payload = data.get("payload")
+    if not isinstance(payload, dict):
+        raise JobError("payload must be a JSON object")
+    key = headers.get("Idempotency-Key") or data.get("idempotencyKey")
+    forwarded = {name: headers[name] for name in FORWARDED_HEADERS if headers.get(name)}
+    return route, payload, key, forwarded
+
+
+def request_hash(route, payload):
+    return hashlib.sha256(json.dumps([route, payload], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class JobStore:
+    """
+    SQLite table of jobs and their results.
+
+    Args:
+        path: The SQLite file. Created if missing.
+        ttl: Seconds a job and its result are kept after submission.
+    """
+
+    def __init__(self, path, ttl=JOBS_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._done = {}
+        self._last_purge = 0.0
+        self.submitted = 0
+        self.reused = 0
+        self.finished = 0
+        self.failed = 0
+        self.run_seconds = 0.0
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, idempotency_key TEXT UNIQUE, route TEXT NOT NULL, request_hash TEXT NOT NULL,"
+            " status TEXT NOT NULL, http_status INTEGER, result TEXT,"
+            " created REAL NOT NULL, updated REAL NOT NULL, expires REAL NOT NULL)"
+        )
+        conn.commit()
+        # A forked worker must not reuse the parent's connections
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._done = {}
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, route, payload, idempotency_key=None):
+        """
+        Records a new job, or finds the one already submitted under the same key.
+
+        Returns:
+            tuple: (job dict, True if the caller must run it).
+
+        Raises:
+            JobError: If the key was already used for a different request (422).
+        """
+        self._purge()
+        digest = request_hash(route, payload)
+        if idempotency_key:
+            existing = self._existing(idempotency_key, digest)
+            if existing is not None:
+                return existing, False
+
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        conn = self._conn()
+        try:
+            if idempotency_key:
+                # An expired job still holding the key (not purged yet) gives it up
+                conn.execute("DELETE FROM jobs WHERE idempotency_key = ? AND expires < ?", (idempotency_key, now))
+            conn.execute(
+                "INSERT INTO jobs (id, idempotency_key, route, request_hash, status, created, updated, expires)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, idempotency_key, route, digest, now, now, now + self.ttl),
+            )
+            conn.commit()
+        except sqlite3.IntegrityError:
+            # Another request with the same key got there first
+            conn.rollback()
+            existing = self._existing(idempotency_key, digest)
+            if existing is None:
+                raise
+            return existing, False
+        with self._lock:
+            self.submitted += 1
+            self._done[job_id] = threading.Event()
+        return self.get(job_id), True
+
+    def _existing(self, idempotency_key, digest):
+        existing = self._row("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,))
+        if existing is None:
+            return None
+        if existing["request_hash"] != digest:
+            raise JobError("Idempotency-Key was already used for a different request", 422)
+        with self._lock:
+            self.reused += 1
+        return self._public(existing)
+
+    def start(self, job_id):
+        self._update(job_id, "UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), job_id))
+
+    def finish(self, job_id, http_status, result, seconds):
+        """Stores the route's response; any status >= 400 marks the job as failed."""
+        status = "done" if http_status < 400 else "failed"
+        self._update(
+            job_id,
+            "UPDATE jobs SET status = ?, http_status = ?, result = ?, updated = ? WHERE id = ?",
+            (status, http_status, json.dumps(result), time.time(), job_id),
+        )
+        with self._lock:
+            self.finished += status == "done"
+            self.failed += status == "failed"
+            self.run_seconds += seconds
+            event = self._done.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    def _update(self, job_id, sql, params):
+        conn = self._conn()
+        conn.execute(sql, params)
+        conn.commit()
+
+    def _row(self, sql, params):
+        row = self._conn().execute(sql, params).fetchone()
+        if row is None or row["expires"] < time.time():
+            return None
+        return row
+
+    def _public(self, row):
+        status = row["status"]
+        result = json.loads(row["result"]) if row["result"] is not None else None
+        http_status = row["http_status"]
+        if status in ("queued", "running") and time.time() - row["updated"] > JOBS_STALE_AFTER:
+            status, http_status, result = "failed", 500, {"error": "The job was interrupted. Please submit it again."}
+        return {
+            "id": row["id"],
+            "route": row["route"],
+            "status": status,
+            "httpStatus": http_status,
+            "result": result,
+            "createdAt": row["created"],
+            "updatedAt": row["updated"],
+            "expiresAt": row["expires"],
+        }
+
+    def get(self, job_id):
+        """Returns the job as a JSON-ready dict, or None if it is unknown or expired."""
+        row = self._row("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._public(row) if row is not None else None
+
+    def wait(self, job_id, timeout):
+        """
+        Long-polls: returns the job once it is finished, or as it is after `timeout` seconds.
+        """
+        deadline = time.time() + min(max(timeout, 0), JOBS_MAX_WAIT)
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job["status"] in ("done", "failed") or remaining <= 0:
+                return job
+            event = self._done.get(job_id)
+            if event is not None:
+                # Ours: wake up as soon as it finishes
+                event.wait(remaining)
+            else:
+                time.sleep(min(JOBS_POLL_INTERVAL, remaining))
+
+    def _purge(self):
+        now = time.time()
+        if now - self._last_purge < _PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        try:
+            self._update(None, "DELETE FROM jobs WHERE expires < ?", (now,))
+        except sqlite3.Error as e:
+            print(f"Job store purge failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            completed = self.finished + self.failed
+            return {
+                "submitted": self.submitted,
+                "reused": self.reused,
+                "done": self.finished,
+                "failed": self.failed,
+                "pending": len(self._done),
+                "avgRunMs": round(1000 * self.run_seconds / completed, 2) if completed else 0.0,
+            }
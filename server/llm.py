@@ -0,0 +1,314 @@
+"""
+Prompts, schemas and response parsing for the OpenAI-backed routes.
+
+Each `*_request` function returns the keyword arguments for
+`client.chat.completions.create`, so the same request can be sent from the
+Flask app (blocking `OpenAI` client) and the ASGI app (`AsyncOpenAI`).
+"""
+import json
+
+
+LATEX_PROMPT = """
+        Extract the mathematical content from this image.
+        Return ONLY the raw LaTeX code.
+        Do not add delimiters like ```latex or $$.
+        If there is text mixed with math, wrap the text in \text{}.
+        """
+
+
+def latex_request(image_uri, detail="high"):
+    return dict(
+        model="gpt-4o", # Use gpt-4o or gpt-4-turbo
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": LATEX_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_uri, # Send the data:image/jpeg;base64,... string directly
+                            "detail": detail
+                        },
+                    },
+                ],
+            }
+        ],
+        max_tokens=300,
+    )
+
+
+TEXT_PROMPT = """
+        Extract all of the text in this image exactly as written.
+        Return ONLY the text, keeping the original line breaks.
+        """
+
+
+def text_request(image_uri, detail="high"):
+    return dict(
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": TEXT_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_uri, "detail": detail}},
+                ],
+            }
+        ],
+        max_tokens=1000,
+    )
+
+
+def solve_problem_request(input_text):
+    return dict(
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "user",
+                "content": f"Solve this problem step-by-step: {input_text}",
+            }
+        ],
+        temperature=0.3,
+    )
+
+
+# Define the Strict Schema (The "Contract" with the AI)
+MATH_SCHEMA = {
+    "name": "math_solution",
+    "strict": True, # <--- GUARANTEES the structure
+    "schema": {
+        "type": "object",
+        "properties": {
+            "overview": {
+                "type": "string",
+                "description": "A brief summary. Use $...$ for math."
+            },
+            "steps": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title": {
+                            "type": "string",
+                            "description": "Short title of the step"
+                        },
+                        "content": {
+                            "type": "string",
+                            "description": "Detailed explanation. Use $ delimiters for ALL math symbols."
+                        }
+                    },
+                    "required": ["title", "content"],
+                    "additionalProperties": False
+                }
+            },
+            "finalAnswer": {
+                "type": "string",
+                "description": "The final result in math format like $x = 5$"
+            }
+        },
+        "required": ["overview", "steps", "finalAnswer"],
+        "additionalProperties": False
+    }
+}
+
+
+def math_request(input_text):
+    prompt = f"""
+        Solve this math problem: "{input_text}".
+
+        CRITICAL RULES:
+        1. Use LaTeX for ALL math expressions, wrapped in single dollar signs ($).
+        2. Example: "The integral is $\\int x dx$".
+        3.  **Use LaTeX commands** for functions.
+            - WRONG: "sin(x)", "cos(x)", "pi"
+            - CORRECT: "\\sin(x)", "\\cos(x)", "\\pi"
+        4.  **Wrap ALL math in single dollar signs ($).** - Example: "The derivative of $f(x)$ is $f'(x)$."
+        5.  **Final Answer:** Must be fully wrapped in LaTeX delimiters.
+            - Example: "$x = \\frac{{\\pi}}{{2}}$"
+        """
+
+    return dict(
+        model="gpt-4o-2024-08-06", # Specific version optimized for strict outputs
+        messages=[
+            {"role": "system", "content": "You are a precise math tutor."},
+            {"role": "user", "content": prompt}
+        ],
+        response_format={
+            "type": "json_schema",
+            "json_schema": MATH_SCHEMA
+        },
+        temperature=0.1,
+    )
+
+
+def quiz_request(topic, quiz_type, difficulty, count=5):
+    # Define the expected JSON structure based on the quiz type
+    if quiz_type == 'MCQs':
+        json_format_instructions = """
+            "questions": [
+              {
+                "question": "The question text...",
+                "options": ["Option A", "Option B", "Option C", "Option D"],
+                "correctAnswer": "The text of the correct option"
+              }
+            ]
+            """
+    else:  # Short Questions
+        json_format_instructions = """
+            "questions": [
+              {
+                "question": "The question text...",
+                "correctAnswer": "A short model answer"
+              }
+            ]
+            """
+
+    # Construct a more robust prompt for the AI model
+    prompt = f"""
+        Generate a {difficulty} level quiz with {count} questions on the topic of "{topic}".
+        The quiz type must be "{quiz_type}".
+        Your entire response must be a single, valid JSON object.
+        The JSON object must have a single key called "questions", which contains an array of the question objects.
+        Do not include any other text, explanations, or markdown.
+        Follow this exact structure inside the JSON object:
+        {json_format_instructions}
+        """
+
+    return dict(
+        model="gpt-4o",
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": "You are an API that generates quizzes in a specified JSON format. You will only respond with the JSON object."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.6,
+    )
+
+
+def parse_quiz(quiz_content):
+    """
+    Extracts the list of questions from the model's quiz JSON.
+
+    Raises:
+        json.JSONDecodeError, ValueError: If the response doesn't follow the requested structure.
+    """
+    # The AI should return a JSON string. Parse it into a Python object.
+    quiz_data = json.loads(quiz_content)
+
+    # Now, we specifically look for the "questions" key, which should be a list.
+    if isinstance(quiz_data, dict) and "questions" in quiz_data and isinstance(quiz_data["questions"], list):
+        return quiz_data["questions"]
+
+    # This error is more specific if the AI fails to follow the new structure.
+    raise ValueError("JSON from AI does not contain a 'questions' list.")
+
+
+def valid_question(item, quiz_type):
+    """Returns True when a generated question has its text, and for MCQs options containing the answer."""
+    if not isinstance(item, dict) or not str(item.get("question") or "").strip():
+        return False
+    if quiz_type == 'MCQs':
+        options = item.get("options")
+        return isinstance(options, list) and len(options) >= 2 and item.get("correctAnswer") in options
+    return True
+
+
+def validate_quiz(questions, quiz_type, count=5):
+    """
+    Checks that a parsed quiz is complete enough to serve again later.
+
+    Raises:
+        ValueError: If a question is missing fields or an MCQ's answer isn't one of its options.
+    """
+    if len(questions) != count:
+        raise ValueError(f"Expected {count} questions, got {len(questions)}.")
+    if not all(valid_question(item, quiz_type) for item in questions):
+        raise ValueError("Quiz question without text, or an MCQ with its answer outside its options.")
+    return questions
+
+
+GRADING_SCHEMA = {
+    "name": "grading_schema",
+    "strict": True, # <--- This prevents hallucinated keys
+    "schema": {
+        "type": "object",
+        "properties": {
+            "evaluations": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "score": {
+                            "type": "integer",
+                            "description": "Score from 1 to 5"
+                        },
+                        "feedback": {
+                            "type": "string",
+                            "description": "Short reasoning for the score"
+                        }
+                    },
+                    "required": ["score", "feedback"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["evaluations"],
+        "additionalProperties": False
+    }
+}
+
+
+def grading_request(user_answers):
+    # Format inputs
+    answers_formatted_string = ""
+    for i, item in enumerate(user_answers):
+        answers_formatted_string += f"{i+1}. Question: {item.get('question')}\n   Answer: {item.get('answer')}\n"
+        if item.get('correctAnswer'):
+            answers_formatted_string += f"   Expected answer: {item.get('correctAnswer')}\n"
+
+    prompt = f"""
+        Evaluate these user answers based on accuracy (1-5).
+        For each answer, provide a score and a very brief 1-sentence feedback.
+
+        Data to evaluate:
+        {answers_formatted_string}
+        """
+
+    # --- THE NEVER-FAIL CONFIGURATION ---
+    return dict(
+        model="gpt-4o-mini",  # <--- Use this model (Cheaper & Smarter)
+        messages=[
+            {"role": "system", "content": "You are a strict grading assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        # This "json_schema" enforces the format 100%
+        response_format={
+            "type": "json_schema",
+            "json_schema": GRADING_SCHEMA
+        },
+        temperature=0.2,
+    )
+
+
+def parse_evaluations(evaluation_content):
+    # We can trust this load() because "strict": True guarantees validity
+    evaluation_data = json.loads(evaluation_content)
+    return evaluation_data["evaluations"]
+
+
+def merge_evaluations(user_answers, scores_list):
+    # Merge results
+    final_results = []
+    for i, item in enumerate(user_answers):
+        final_results.append({
+            "question": item.get('question'),
+            "answer": item.get('answer'),
+            "score": scores_list[i].get('score'),
+            "feedback": scores_list[i].get('feedback') # Now you get feedback too!
+        })
+    return final_results
+
+
+def message_content(response):
+    return response.choices[0].message.content
@@ -0,0 +1,372 @@
+"""
+Request metrics in the Prometheus text format, plus sampled request traces.
+
+    GET /metrics          Prometheus exposition (text/plain; version=0.0.4)
+    GET /metrics/traces   the most recent sampled traces, as JSON
+
+Every request is timed per route, with an in-flight gauge, and the work
+inside it is timed per stage: the image pipeline stages reported by
+imaging.py, the local OCR and solver fast paths, and the OpenAI round trip.
+The OpenAI client is wrapped by `instrument_openai`, which also counts the
+tokens reported in `response.usage` (streams are asked to include usage in
+their last chunk) and upstream errors by exception type. Cache hit/miss
+counters are read from the caches when /metrics is scraped.
+
+The current route travels in a context variable, so stages and token counts
+recorded anywhere below a request are attributed to it; work outside any
+request (quiz pool refills, warm-up) is labelled "background".
+
+A fraction METRICS_TRACE_RATE of requests (default 1%) also keeps the start
+offset and duration of every stage; the last METRICS_TRACES of them are
+served by /metrics/traces. Metrics are per process: under gunicorn each
+worker reports its own.
+"""
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_TRACE_RATE = float(os.getenv("METRICS_TRACE_RATE", "0.01"))
+METRICS_TRACES = int(os.getenv("METRICS_TRACES", "100"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_request = contextvars.ContextVar("metrics_request", default=None)
+_traces = deque(maxlen=METRICS_TRACES)
+_caches = []
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down."""
+
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with their sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        names = self.label_names + ("le",)
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(names, key + (_number(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+_registry = []
+
+request_duration = Histogram(
+    "kord_request_duration_seconds", "Time to produce each response, by route and status.", ("route", "status")
+)
+requests_in_flight = Gauge("kord_requests_in_flight", "Requests currently being handled, by route.", ("route",))
+stage_duration = Histogram(
+    "kord_stage_duration_seconds", "Time spent in each stage of a request, by route and stage.", ("route", "stage")
+)
+upstream_tokens = Counter(
+    "kord_upstream_tokens_total", "OpenAI tokens used, by route, model and kind.", ("route", "model", "kind")
+)
+errors = Counter("kord_errors_total", "Failed requests, by route and error type.", ("route", "type"))
+upstream_errors = Counter(
+    "kord_upstream_errors_total", "Exceptions raised by OpenAI calls, by route and type.", ("route", "type")
+)
+
+
+class _Request:
+    __slots__ = ("route", "started", "spans", "tokens", "error", "token")
+
+    def __init__(self, route, sampled):
+        self.route = route
+        self.started = time.perf_counter()
+        self.spans = [] if sampled else None
+        self.tokens = 0
+        self.error = None
+
+
+def current_route():
+    state = _request.get()
+    return state.route if state is not None else "background"
+
+
+def begin(route):
+    """
+    Starts timing a request and makes it the current one. Returns a handle to pass to `end`.
+    """
+    requests_in_flight.inc(route=route)
+    state = _Request(route, random.random() < METRICS_TRACE_RATE)
+    state.token = _request.set(state)
+    return state
+
+
+def end(state, status, exc=None):
+    """
+    Finishes a request started with `begin`: records its duration and status,
+    counts it as an error if it failed, and keeps its trace if it was sampled.
+    """
+    try:
+        _request.reset(state.token)
+    except ValueError:
+        # Finished from another context, e.g. a streamed response closed by the server
+        pass
+    elapsed = time.perf_counter() - state.started
+    requests_in_flight.dec(route=state.route)
+    request_duration.observe(elapsed, route=state.route, status=status)
+    if exc is not None:
+        state.error = type(exc).__name__
+    if status >= 400 or exc is not None:
+        errors.inc(route=state.route, type=state.error or f"http_{status}")
+    if state.spans is not None:
+        _traces.append({
+            "route": state.route,
+            "status": status,
+            "startedAt": round(time.time() - elapsed, 3),
+            "durationMs": round(1000 * elapsed, 3),
+            "tokens": state.tokens,
+            "error": state.error,
+            "spans": state.spans,
+        })
+
+
+def observe_stage(stage, seconds, started=None):
+    """Records a stage duration measured by the caller."""
+    state = _request.get()
+    stage_duration.observe(seconds, route=state.route if state is not None else "background", stage=stage)
+    if state is not None and state.spans is not None:
+        offset = (started if started is not None else time.perf_counter() - seconds) - state.started
+        state.spans.append({"stage": stage, "startMs": round(1000 * offset, 3), "durationMs": round(1000 * seconds, 3)})
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as one stage of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started, started)
+
+
+def _upstream_error(exc):
+    # Remembered, so a request that fails because of it is reported under its type
+    state = _request.get()
+    if state is not None:
+        state.error = type(exc).__name__
+    upstream_errors.inc(route=current_route(), type=type(exc).__name__)
+
+
+def record_usage(usage, model):
+    """Counts the tokens of one OpenAI response's `usage` block."""
+    if usage is None:
+        return
+    route = current_route()
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    upstream_tokens.inc(prompt, route=route, model=model, kind="prompt")
+    upstream_tokens.inc(completion, route=route, model=model, kind="completion")
+    state = _request.get()
+    if state is not None:
+        state.tokens += prompt + completion
+
+
+def _stream_options(kwargs):
+    if kwargs.get("stream") and "stream_options" not in kwargs:
+        kwargs["stream_options"] = {"include_usage": True}
+    return kwargs
+
+
+def _sync_stream(stream, model, started):
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                record_usage(chunk.usage, model)
+            yield chunk
+    finally:
+        observe_stage("upstream", time.perf_counter() - started, started)
+
+
+async def _async_stream(stream, model, started):
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                record_usage(chunk.usage, model)
+            yield chunk
+    finally:
+        observe_stage("upstream", time.perf_counter() - started, started)
+
+
+def instrument_openai(client):
+    """
+    Wraps `client.chat.completions.create` (OpenAI or AsyncOpenAI) so every
+    call is timed as the "upstream" stage, its token usage is counted and its
+    exceptions are counted by type. Streams are timed until they are exhausted.
+
+    Returns:
+        The same client.
+    """
+    from openai import AsyncOpenAI
+
+    completions = client.chat.completions
+    create = completions.create
+
+    if isinstance(client, AsyncOpenAI):
+        async def instrumented(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                response = await create(*args, **_stream_options(kwargs))
+            except Exception as e:
+                _upstream_error(e)
+                observe_stage("upstream", time.perf_counter() - started, started)
+                raise
+            if kwargs.get("stream"):
+                return _async_stream(response, kwargs.get("model", ""), started)
+            observe_stage("upstream", time.perf_counter() - started, started)
+            record_usage(getattr(response, "usage", None), kwargs.get("model", ""))
+            return response
+    else:
+        def instrumented(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                response = create(*args, **_stream_options(kwargs))
+            except Exception as e:
+                _upstream_error(e)
+                observe_stage("upstream", time.perf_counter() - started, started)
+                raise
+            if kwargs.get("stream"):
+                return _sync_stream(response, kwargs.get("model", ""), started)
+            observe_stage("upstream", time.perf_counter() - started, started)
+            record_usage(getattr(response, "usage", None), kwargs.get("model", ""))
+            return response
+
+    completions.create = instrumented
+    return client
+
+
+def register_cache(cache):
+    """Exposes a caching.TieredCache's counters on /metrics."""
+    _caches.append(cache)
+
+
+def _cache_lines():
+    lookups, evictions = [], []
+    for cache in _caches:
+        lookups += [
+            (cache.name, "hit", cache.hits),
+            (cache.name, "disk_hit", cache.disk_hits),
+            (cache.name, "miss", cache.misses),
+        ]
+        evictions.append((cache.name, cache.memory.evictions))
+    lines = [
+        "# HELP kord_cache_lookups_total Result cache lookups, by cache and outcome.",
+        "# TYPE kord_cache_lookups_total counter",
+    ]
+    lines += [f"kord_cache_lookups_total{_labels(('cache', 'result'), (name, result))} {count}" for name, result, count in lookups]
+    lines += [
+        "# HELP kord_cache_evictions_total Entries evicted from the in-memory cache tier.",
+        "# TYPE kord_cache_evictions_total counter",
+    ]
+    lines += [f"kord_cache_evictions_total{_labels(('cache',), (name,))} {count}" for name, count in evictions]
+    return lines
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    lines += _cache_lines()
+    return "\n".join(lines) + "\n"
+
+
+def traces():
+    """Returns the most recent sampled traces, newest first."""
+    return list(reversed(_traces))
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,295 @@
+"""
+Local stand-in for the OpenAI chat-completions API, for benchmarks.
+
+    python mock_openai.py --port 8911 --latency math=1.5:0.3 --error-rate 0.01
+    OPENAI_BASE_URL=http://127.0.0.1:8911/v1 OPENAI_API_KEY=bench gunicorn -c gunicorn.conf.py app:app
+
+POST /v1/chat/completions answers every request the app makes with canned
+content of the right shape, after a simulated delay. The kind of request is
+told from its body, the same way llm.py builds them:
+
+    latex     image prompt asking for LaTeX      raw LaTeX
+    text      image prompt asking for text       plain text
+    solve     free-form "solve step-by-step"     plain text
+    math      json_schema "math_solution"        overview / steps / finalAnswer
+    quiz      json_object quiz prompt            as many questions as asked, MCQs or short
+    grading   json_schema "grading_schema"       one evaluation per answer
+
+Delays are log-normal: `--latency KIND=MEDIAN:SIGMA` sets the median (seconds)
+and the spread of one kind, "default" applies to the others. Streams send
+their first chunk after a third of the delay and the rest evenly over the
+remainder, ending with a usage chunk when `stream_options.include_usage` is
+set. `--error-rate` answers that fraction of requests with a 429 and a
+Retry-After header, like an exhausted rate limit. With `--seed`, the delays,
+errors and generated questions repeat from run to run.
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# kind -> (median seconds, log-normal sigma)
+DEFAULT_LATENCIES = {
+    "default": (0.8, 0.4),
+    "latex": (1.2, 0.35),
+    "text": (1.5, 0.35),
+    "solve": (3.0, 0.4),
+    "math": (2.5, 0.4),
+    "quiz": (4.0, 0.3),
+    "grading": (1.5, 0.3),
+}
+
+# Roughly what one high-detail image costs in prompt tokens
+_IMAGE_TOKENS = 765
+_STREAM_CHUNKS = 8
+
+_QUIZ_COUNT = re.compile(r"with (\d+) questions")
+_QUIZ_TOPIC = re.compile(r'on the topic of "(.*?)"')
+_QUIZ_TYPE = re.compile(r'quiz type must be "(.*?)"')
+_GRADED_ANSWER = re.compile(r"^\s*\d+\. Question:", re.MULTILINE)
+
+
+def parse_latency(specs):
+    """
+    Parses `KIND=MEDIAN:SIGMA` strings on top of DEFAULT_LATENCIES.
+
+    Raises:
+        ValueError: If a spec is malformed or names an unknown kind.
+    """
+    latencies = dict(DEFAULT_LATENCIES)
+    for spec in specs or ():
+        kind, _, value = spec.partition("=")
+        median, _, sigma = value.partition(":")
+        if kind not in latencies:
+            raise ValueError(f"Unknown request kind {kind!r}, expected one of: {', '.join(latencies)}")
+        latencies[kind] = (float(median), float(sigma or 0))
+    return latencies
+
+
+def _texts(messages):
+    texts, images = [], 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or ():
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                images += 1
+    return "\n".join(texts), images
+
+
+def request_kind(body):
+    """Tells which of the app's requests a chat-completions body is."""
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        name = response_format.get("json_schema", {}).get("name")
+        return "grading" if name == "grading_schema" else "math"
+    if response_format.get("type") == "json_object":
+        return "quiz"
+    text, images = _texts(body.get("messages", []))
+    if images:
+        return "latex" if "LaTeX" in text else "text"
+    return "solve"
+
+
+class MockOpenAI:
+    """
+    Builds the canned responses and draws the delays.
+
+    Args:
+        latencies: kind -> (median seconds, sigma), see `parse_latency`.
+        error_rate: Fraction of requests answered with a 429.
+        seed: Seed for delays, errors and generated content; None for a random one.
+    """
+
+    def __init__(self, latencies=None, error_rate=0.0, seed=None):
+        self.latencies = latencies or dict(DEFAULT_LATENCIES)
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.rate_limited = 0
+
+    def reset(self):
+        """Clears the request counts, e.g. after a warm-up."""
+        with self._lock:
+            self.requests = {}
+            self.rate_limited = 0
+
+    def delay(self, kind):
+        median, sigma = self.latencies.get(kind, self.latencies["default"])
+        with self._lock:
+            return median * math.exp(self._random.gauss(0, sigma)) if sigma else median
+
+    def rate_limit(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            limited = self._random.random() < self.error_rate
+            self.rate_limited += limited
+        return limited
+
+    def content(self, kind, body):
+        text, _ = _texts(body.get("messages", []))
+        if kind == "latex":
+            return r"\frac{x^{2}-1}{x+1}=x-1"
+        if kind == "text":
+            return "Solve for x:\n2x + 3 = 7"
+        if kind == "solve":
+            return "Step 1: Subtract 3 from both sides: 2x = 4.\nStep 2: Divide by 2: x = 2.\n\nFinal answer: x = 2"
+        if kind == "math":
+            return json.dumps({
+                "overview": "We isolate $x$ on one side of the equation.",
+                "steps": [
+                    {"title": "Subtract 3", "content": "$2x + 3 - 3 = 7 - 3$, so $2x = 4$."},
+                    {"title": "Divide by 2", "content": "$x = \\frac{4}{2} = 2$."},
+                ],
+                "finalAnswer": "$x = 2$",
+            })
+        if kind == "grading":
+            count = len(_GRADED_ANSWER.findall(text)) or 1
+            with self._lock:
+                scores = [self._random.randint(1, 5) for _ in range(count)]
+            return json.dumps({"evaluations": [{"score": s, "feedback": "Mostly correct."} for s in scores]})
+        if kind == "quiz":
+            return json.dumps({"questions": self._questions(text)})
+        return "OK"
+
+    def _questions(self, prompt):
+        count = int((_QUIZ_COUNT.search(prompt) or [0, 5])[1])
+        topic = (_QUIZ_TOPIC.search(prompt) or [0, "mathematics"])[1]
+        mcq = (_QUIZ_TYPE.search(prompt) or [0, "MCQs"])[1] == "MCQs"
+        questions = []
+        for _ in range(count):
+            with self._lock:
+                a, b = self._random.randint(2, 99), self._random.randint(2, 99)
+            question = {"question": f"In {topic}, what is {a} + {b}?", "correctAnswer": str(a + b)}
+            if mcq:
+                question["options"] = [str(a + b), str(a + b + 1), str(a + b - 1), str(a * b)]
+            questions.append(question)
+        return questions
+
+    def usage(self, body, content):
+        text, images = _texts(body.get("messages", []))
+        prompt = len(text) // 4 + images * _IMAGE_TOKENS
+        completion = max(1, len(content) // 4)
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+def _handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status, payload, headers=()):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError:
+                return self._json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self._json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+            kind = request_kind(body)
+            if mock.rate_limit(kind):
+                return self._json(
+                    429,
+                    {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                    [("Retry-After", "1")],
+                )
+            delay = mock.delay(kind)
+            content = mock.content(kind, body)
+            usage = mock.usage(body, content)
+            model = body.get("model", "gpt-4o")
+            if body.get("stream"):
+                return self._stream(body, model, content, usage, delay)
+
+            time.sleep(delay)
+            self._json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        def _stream(self, body, model, content, usage, delay):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def send(choices, **extra):
+                chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": model, "choices": choices, **extra}
+                self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+
+            time.sleep(delay / 3)
+            size = max(1, math.ceil(len(content) / _STREAM_CHUNKS))
+            pieces = [content[i:i + size] for i in range(0, len(content), size)]
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(2 * delay / 3 / len(pieces))
+                send([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+            send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+
+    return Handler
+
+
+def serve(port=8911, host="127.0.0.1", latencies=None, error_rate=0.0, seed=None):
+    """
+    Starts the mock in a background thread.
+
+    Returns:
+        tuple: (ThreadingHTTPServer, MockOpenAI). Call `server.shutdown()` to stop it.
+    """
+    mock = MockOpenAI(latencies, error_rate, seed)
+    server = ThreadingHTTPServer((host, port), _handler(mock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server, mock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8911)
+    parser.add_argument("--latency", action="append", metavar="KIND=MEDIAN:SIGMA",
+                        help=f"kinds: {', '.join(DEFAULT_LATENCIES)}")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server, _ = serve(args.port, args.host, parse_latency(args.latency), args.error_rate, args.seed)
+    print(f"Mock OpenAI API on http://{args.host}:{args.port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
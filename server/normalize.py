@@ -0,0 +1,135 @@
+"""
+Canonical forms for problem text, used as cache keys.
+
+Two submissions of the same textbook problem usually differ only in spacing,
+math delimiters or equivalent LaTeX spellings (\\dfrac vs \\frac, \\left( vs (,
+...). `canonicalize_problem` folds those differences away. When the input is a
+single math expression that SymPy can parse, the SymPy form is used instead so
+that `x+2=5` and `2+x = 5` also collide.
+"""
+import re
+from collections import Counter
+
+
+# Spellings that render (and mean) the same thing
+_LATEX_ALIASES = {
+    "dfrac": r"\frac",
+    "tfrac": r"\frac",
+    "displaystyle": "",
+    "left": "",
+    "right": "",
+    "bigl": "",
+    "bigr": "",
+    "Bigl": "",
+    "Bigr": "",
+    "times": r"\cdot",
+    "le": r"\leq",
+    "ge": r"\geq",
+    "neq": r"\ne",
+}
+# Only whole command names, so \leftarrow is left alone
+_LATEX_COMMAND = re.compile(r"\\([A-Za-z]+)(?![A-Za-z])")
+
+# Spacing commands: \, \; \: \! \quad \qquad and "\ "
+_LATEX_SPACING = re.compile(r"\\(?:[,;:!]|quad|qquad|\s)")
+_MATH_DELIMITERS = re.compile(r"\$\$?|\\\(|\\\)|\\\[|\\\]")
+# A one-digit script followed by more digits: in TeX `x^2 3` is x^{2}3, parse_latex reads x^{23}
+_SPACED_SCRIPT = re.compile(r"([_^])(\d) (?=\d)")
+# Any other digits split by whitespace ("1 000", "2 3") have no single reading
+_SPACED_DIGITS = re.compile(r"\d\s+\d")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+_SPACE_AROUND_SYMBOLS = re.compile(r"\s*([^\w\s\\])\s*")
+_WHITESPACE = re.compile(r"\s+")
+_WORDS = re.compile(r"[A-Za-z]{3,}")
+# Prose words (not LaTeX commands); single-letter variables keep their case
+_PROSE_WORD = re.compile(r"(?<![\\A-Za-z])[A-Za-z]{3,}")
+
+
+def normalize_latex(text):
+    """
+    Applies the purely textual normalisations.
+
+    Args:
+        text: The raw problem text.
+
+    Returns:
+        str: The text with delimiters, spacing commands and aliases folded.
+    """
+    text = _MATH_DELIMITERS.sub(" ", text)
+    text = _LATEX_SPACING.sub(" ", text)
+    text = _LATEX_COMMAND.sub(lambda m: _LATEX_ALIASES.get(m.group(1), m.group(0)), text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    text = _SPACED_SCRIPT.sub(r"\1{\2}", text)
+    text = _SPACE_AROUND_SYMBOLS.sub(r"\1", text)
+    text = _PROSE_WORD.sub(lambda m: m.group(0).lower(), text)
+    return text.rstrip(".")
+
+
+def _looks_like_pure_math(text):
+    # Words other than LaTeX commands mean there is a prose question around the math
+    stripped = re.sub(r"\\[A-Za-z]+", "", text)
+    return not _WORDS.search(stripped)
+
+
+def parse_round_trips(text, expr):
+    """
+    Tells whether a parse still contains every number written in the text.
+
+    parse_latex silently joins digit groups separated by whitespace
+    (`2^3 4` becomes 2^34, `\\int_0^1 2x` integrates up to 12), which gives
+    confident wrong answers and merges cache keys of different problems.
+
+    Args:
+        text: The normalized LaTeX that was parsed.
+        expr: The unevaluated parse_latex result.
+
+    Returns:
+        bool: False when digits are split by whitespace or a number of the text is missing from `expr`.
+    """
+    if _SPACED_DIGITS.search(text):
+        return False
+    from sympy import Rational, preorder_traversal
+
+    parsed = Counter()
+    for node in preorder_traversal(expr):
+        if node.is_Number:
+            value = abs(Rational(str(node)) if node.is_Float else node)
+            parsed.update([value, value.p, value.q] if value.q != 1 else [value])
+    written = Counter(Rational(number) for number in _NUMBER.findall(text))
+    return not written - parsed
+
+
+def sympy_canonical(text):
+    """
+    Returns SymPy's string form of a LaTeX expression, or None when it can't be parsed.
+
+    `sympy.parsing.latex` needs the optional antlr4 runtime; without it this
+    always returns None and callers fall back to the textual form. So does a
+    parse that doesn't round-trip (see `parse_round_trips`).
+    """
+    try:
+        from sympy.parsing.latex import parse_latex
+        from sympy import srepr
+
+        expr = parse_latex(text)
+        return srepr(expr) if parse_round_trips(text, expr) else None
+    except Exception:
+        return None
+
+
+def canonicalize_problem(text):
+    """
+    Builds the canonical form of a problem statement.
+
+    Args:
+        text: The `inputText` sent by the client.
+
+    Returns:
+        str: A string that is equal for trivially different spellings of the same problem.
+    """
+    normalized = normalize_latex(text or "")
+    if normalized and _looks_like_pure_math(normalized):
+        canonical = sympy_canonical(normalized)
+        if canonical:
+            return "sympy:" + canonical
+    return "text:" + normalized
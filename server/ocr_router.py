@@ -0,0 +1,168 @@
+"""
+Local-first routing for the OCR routes.
+
+Each OCR route runs in one of three modes, set per route with LATEX_ROUTING
+and TEXT_ROUTING:
+
+    llm     always send the image to GPT-4o (the /latex default)
+    local   only use the local engine (the /text default)
+    hybrid  run the local engine first and escalate to GPT-4o only when its
+            confidence is below the route's threshold
+
+For /latex the local engine is pix2tex; its output is scored by whether
+pylatexenc can parse it strictly and by how repetitive it is (a runaway decode
+is pix2tex's usual failure). For /text it is Tesseract, scored by the mean of
+its per-word confidences. With nothing to score against (local mode), /text
+keeps Tesseract's own page layout (`extract_text`) rather than the lines
+rebuilt from the word boxes the confidences come with.
+"""
+import io
+import os
+import re
+import threading
+import time
+
+from PIL import Image
+
+import engines
+import metrics
+from imaging import extract_text, image_processing2, recognize_text
+
+ROUTING = {
+    "latex": os.getenv("LATEX_ROUTING", "llm"),
+    "text": os.getenv("TEXT_ROUTING", "local"),
+}
+MIN_CONFIDENCE = {
+    # 0-1 score from latex_confidence
+    "latex": float(os.getenv("LATEX_MIN_CONFIDENCE", "0.8")),
+    # Tesseract word confidences are 0-100
+    "text": float(os.getenv("TEXT_MIN_CONFIDENCE", "75")),
+}
+
+_LATEX_TOKEN = re.compile(r"\\[A-Za-z]+|\\.|\S")
+# pix2tex stops at 512 tokens; outputs near that length are almost always runaways
+_MAX_LATEX_TOKENS = 400
+
+_lock = threading.Lock()
+_counts = {route: {"local": 0, "escalated": 0, "llm": 0, "localSeconds": 0.0} for route in ROUTING}
+
+
+def latex_confidence(latex):
+    """
+    Scores a pix2tex prediction between 0 and 1.
+
+    Args:
+        latex: The predicted LaTeX string.
+
+    Returns:
+        float: 0 for empty or unparseable output, lower for repetitive or overlong output.
+    """
+    from pylatexenc.latexwalker import LatexWalker
+
+    if not latex or not latex.strip():
+        return 0.0
+    try:
+        LatexWalker(latex, tolerant_parsing=False).get_latex_nodes()
+    except Exception:
+        return 0.0
+
+    tokens = _LATEX_TOKEN.findall(latex)
+    score = 1.0
+    if len(tokens) >= 12:
+        # Share of distinct 3-grams; a decode stuck in a loop repeats the same few
+        trigrams = [tuple(tokens[i:i + 3]) for i in range(len(tokens) - 2)]
+        distinct = len(set(trigrams)) / len(trigrams)
+        if distinct < 0.5:
+            score *= distinct / 0.5
+    if len(tokens) > _MAX_LATEX_TOKENS:
+        score *= 0.5
+    return round(score, 3)
+
+
+def text_confidence(confidences):
+    """
+    Returns the mean Tesseract word confidence, ignoring non-word boxes (-1).
+    """
+    words = [c for c in confidences if c >= 0]
+    return sum(words) / len(words) if words else 0.0
+
+
+def _local_latex(image_data, scored):
+    image = Image.open(io.BytesIO(image_data))
+    latex = engines.get('pix2tex')(image_processing2(image))
+    return {'latex': latex, 'text': latex, 'source': 'pix2tex'}, latex_confidence(latex)
+
+
+def _local_text(image_data, scored):
+    if not scored:
+        return {'text': extract_text(image_data), 'source': 'tesseract'}, None
+    text, confidences = recognize_text(image_data)
+    return {'text': text, 'source': 'tesseract'}, text_confidence(confidences)
+
+
+_LOCAL = {"latex": _local_latex, "text": _local_text}
+
+
+def try_local(route, image_data):
+    """
+    Runs the local engine for a route according to its routing mode.
+
+    Args:
+        route: "latex" or "text".
+        image_data: The encoded image bytes.
+
+    Returns:
+        dict or None: The route's JSON result when the local answer is accepted,
+            or None when the caller should send the image to GPT-4o.
+    """
+    mode = ROUTING[route]
+    if mode == "llm":
+        _count(route, "llm")
+        return None
+
+    start = time.perf_counter()
+    try:
+        result, confidence = _LOCAL[route](image_data, mode == "hybrid")
+    except Exception as e:
+        if mode == "local":
+            raise
+        print(f"Local {route} OCR failed, escalating:", e)
+        _count(route, "escalated", time.perf_counter() - start)
+        return None
+    elapsed = time.perf_counter() - start
+
+    if mode == "local" or confidence >= MIN_CONFIDENCE[route]:
+        _count(route, "local", elapsed)
+        return result
+
+    print(f"Local {route} OCR confidence {confidence} below {MIN_CONFIDENCE[route]}, escalating")
+    _count(route, "escalated", elapsed)
+    return None
+
+
+def _count(route, outcome, seconds=0.0):
+    if outcome != "llm":
+        metrics.observe_stage("ocr_local", seconds)
+    with _lock:
+        _counts[route][outcome] += 1
+        _counts[route]["localSeconds"] += seconds
+
+
+def stats():
+    """
+    Returns per-route routing counts and the escalation rate of the hybrid mode.
+    """
+    with _lock:
+        report = {}
+        for route, counts in _counts.items():
+            tried = counts["local"] + counts["escalated"]
+            report[route] = {
+                "mode": ROUTING[route],
+                "minConfidence": MIN_CONFIDENCE[route],
+                "local": counts["local"],
+                "escalated": counts["escalated"],
+                "llm": counts["llm"],
+                "escalationRate": round(counts["escalated"] / tried, 4) if tried else 0.0,
+                "avgLocalMs": round(1000 * counts["localSeconds"] / tried, 2) if tried else 0.0,
+            }
+        return report
@@ -0,0 +1,239 @@
+"""
+Micro-batching front end for the pix2tex LatexOCR model.
+
+Calling `LatexOCR()(img)` from several Flask threads at once runs one
+encoder/decoder pass per image, and every one of those passes competes for
+torch's intra-op thread pool. `BatchedLatexOCR` instead funnels all requests
+through a single inference thread: the first image in the queue waits up to
+PIX2TEX_MAX_WAIT_MS for others to arrive, up to PIX2TEX_MAX_BATCH images are
+padded to a common size and stacked, and the batch goes through the encoder
+and the autoregressive decoder together. Each caller blocks on its own future,
+so the object is a drop-in for `model(img)`.
+
+Torch is given PIX2TEX_THREADS intra-op threads (default: all cores) and a
+single inter-op thread, since only the inference thread ever runs the model.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from PIL import Image
+
+PIX2TEX_MAX_BATCH = int(os.getenv("PIX2TEX_MAX_BATCH", "8"))
+PIX2TEX_MAX_WAIT_MS = float(os.getenv("PIX2TEX_MAX_WAIT_MS", "5"))
+PIX2TEX_THREADS = int(os.getenv("PIX2TEX_THREADS", "0"))
+
+
+def configure_torch_threads(threads=PIX2TEX_THREADS):
+    """
+    Sets torch's thread pools for a process that runs one model on one thread.
+    """
+    import torch
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+    try:
+        # Only allowed before torch has started any inter-op work
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def prepare_image(img, args, resize_width=None):
+    """
+    Returns the padded PIL image LatexOCR would feed to its encoder.
+
+    Args:
+        img: The input PIL image.
+        args: The model's settings (max_dimensions, min_dimensions, no_resize).
+        resize_width: Optional callable that takes the normalised (1, 1, H, W)
+            tensor and returns the width the resizer network picks for it.
+    """
+    from pix2tex.dataset.transforms import test_transform
+    from pix2tex.utils import minmax_size, pad
+
+    import numpy as np
+
+    img = minmax_size(pad(img), args.max_dimensions, args.min_dimensions)
+    if resize_width is None or args.get("no_resize", False):
+        return pad(img).convert("RGB")
+
+    # Same search as LatexOCR.__call__: let the resizer network pick the width
+    input_image = img.convert("RGB").copy()
+    r, w, h = 1, input_image.size[0], input_image.size[1]
+    for _ in range(10):
+        h = int(h * r)
+        resample = Image.Resampling.BILINEAR if r > 1 else Image.Resampling.LANCZOS
+        img = pad(minmax_size(input_image.resize((w, h), resample), args.max_dimensions, args.min_dimensions))
+        t = test_transform(image=np.array(img.convert("RGB")))["image"][:1].unsqueeze(0)
+        w = resize_width(t)
+        if w == img.size[0]:
+            break
+        r = w / img.size[0]
+    return img.convert("RGB")
+
+
+def pad_batch(images):
+    """
+    Pads prepared images to a common size and stacks them into a (B, 1, H, W) tensor.
+    """
+    from pix2tex.dataset.transforms import test_transform
+
+    import numpy as np
+    import torch
+
+    # pix2tex pads with white to the bottom right, so batching does the same
+    width = max(image.size[0] for image in images)
+    height = max(image.size[1] for image in images)
+    tensors = []
+    for image in images:
+        if image.size != (width, height):
+            canvas = Image.new("RGB", (width, height), (255, 255, 255))
+            canvas.paste(image, (0, 0))
+            image = canvas
+        tensors.append(test_transform(image=np.array(image))["image"][:1])
+    return torch.stack(tensors)
+
+
+class BatchedLatexOCR:
+    """
+    Batches concurrent `LatexOCR` calls into padded encoder/decoder passes.
+
+    Args:
+        model: A loaded `pix2tex.cli.LatexOCR`, or an engine with
+            `prepare(img)` and `predict(images)` such as `OnnxLatexOCR`.
+        max_batch: Largest number of images per forward pass.
+        max_wait_ms: How long the first queued image waits for company.
+    """
+
+    def __init__(self, model, max_batch=PIX2TEX_MAX_BATCH, max_wait_ms=PIX2TEX_MAX_WAIT_MS):
+        self.model = model
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._start()
+        # Threads don't survive fork(); a pre-forked worker gets its own queue and thread
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.images = 0
+        self.batches = 0
+        self.errors = 0
+        self.largest_batch = 0
+        self.wait_seconds = 0.0
+        self.busy_seconds = 0.0
+        self._thread = threading.Thread(target=self._serve, name="pix2tex-batcher", daemon=True)
+        self._thread.start()
+
+    def share_memory(self):
+        """
+        Moves the torch weights into shared memory so forked workers map the
+        master's copy instead of duplicating it.
+        """
+        for module in (getattr(self.model, "model", None), getattr(self.model, "image_resizer", None)):
+            if module is not None:
+                module.share_memory()
+
+    def __call__(self, img, timeout=None):
+        """
+        Queues an image and waits for its LaTeX.
+
+        Args:
+            img: A PIL image, as accepted by `LatexOCR.__call__`.
+            timeout: Seconds to wait for the result, or None to wait indefinitely.
+
+        Returns:
+            str: The predicted LaTeX.
+        """
+        future = Future()
+        self._queue.put((img, future, time.perf_counter()))
+        return future.result(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve(self):
+        import torch
+
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+
+            # Resize each image the way LatexOCR would; a bad image only fails its own request
+            ready = []
+            for img, future, queued in batch:
+                try:
+                    with torch.no_grad():
+                        ready.append((self._prepare(img), future))
+                except Exception as e:
+                    future.set_exception(e)
+
+            errors = len(batch) - len(ready)
+            if ready:
+                try:
+                    predictions = self._generate([image for image, _ in ready])
+                except Exception as e:
+                    errors = len(batch)
+                    for _, future in ready:
+                        future.set_exception(e)
+                else:
+                    for (_, future), prediction in zip(ready, predictions):
+                        future.set_result(prediction)
+
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.batches += 1
+                self.images += len(batch)
+                self.errors += errors
+                self.largest_batch = max(self.largest_batch, len(batch))
+                self.wait_seconds += sum(start - queued for _, _, queued in batch)
+                self.busy_seconds += elapsed
+
+    def _prepare(self, img):
+        if hasattr(self.model, "prepare"):
+            return self.model.prepare(img)
+
+        resizer = self.model.image_resizer
+        device = self.model.args.device
+        width = None if resizer is None else (lambda t: (resizer(t.to(device)).argmax(-1).item() + 1) * 32)
+        return prepare_image(img, self.model.args, width)
+
+    def _generate(self, images):
+        if hasattr(self.model, "predict"):
+            return self.model.predict(images)
+
+        from pix2tex.utils import post_process, token2str
+
+        import torch
+
+        args = self.model.args
+        with torch.no_grad():
+            batch = pad_batch(images).to(args.device)
+            dec = self.model.model.generate(batch, temperature=args.get("temperature", .25))
+        return [post_process(text) for text in token2str(dec, self.model.tokenizer)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "maxBatch": self.max_batch,
+                "maxWaitMs": round(1000 * self.max_wait, 2),
+                "queueDepth": self._queue.qsize(),
+                "images": self.images,
+                "batches": self.batches,
+                "errors": self.errors,
+                "avgBatchSize": round(self.images / self.batches, 2) if self.batches else 0.0,
+                "largestBatch": self.largest_batch,
+                "avgWaitMs": round(1000 * self.wait_seconds / self.images, 2) if self.images else 0.0,
+                "imagesPerSecond": round(self.images / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+            }
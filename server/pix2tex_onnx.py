@@ -0,0 +1,452 @@
+"""
+ONNX Runtime export and serving engine for the pix2tex LatexOCR model.
+
+Export (needs torch, pix2tex and onnx; run once per model version):
+
+    python pix2tex_onnx.py --out pix2tex-onnx [--int8]
+
+writes three graphs next to a copy of the tokenizer and a config.json:
+
+    resizer.onnx   the ResNet that picks the input width (if the checkpoint has one)
+    encoder.onnx   image + patch position indices -> cross-attention keys/values
+    decoder.onnx   one decoding step with a self-attention KV cache
+
+The encoder graph ends in the decoder's cross-attention projections, so the
+keys and values of the image are computed once per image instead of once per
+token, and the decoder graph takes and returns the self-attention keys/values
+of all previous tokens so each step only runs the new token. `--int8` adds
+dynamically quantized `*.int8.onnx` copies (int8 MatMul/Gemm weights).
+
+After exporting, the graphs are checked against the eager model on sample
+images (the bundled p1.png and q1.png unless --images is given), both
+decoding greedily, and the agreement is written to parity.json. The export
+rewires x-transformers' attention internals, so a version of x-transformers
+whose layers differ from what `_export_modules` expects shows up here.
+
+`OnnxLatexOCR(model_dir)` serves the exported graphs and is a drop-in for
+`LatexOCR()(img)`; set PIX2TEX_BACKEND=onnx and PIX2TEX_ONNX_DIR to use it for
+the pix2tex engine. The engine only switches when parity.json shows at least
+PIX2TEX_ONNX_MIN_AGREEMENT of the samples decoding the same (after
+`normalize_latex`) and otherwise keeps the eager model. It decodes greedily
+unless a temperature is given; the eager model samples at 0.25, so the two
+can differ on ambiguous images even with identical graphs.
+compare_pix2tex.py reports latency and agreement on any images.
+"""
+import json
+import os
+
+import numpy as np
+
+from pix2tex_batcher import PIX2TEX_THREADS, pad_batch, prepare_image
+
+# Dummy input for tracing. All sizes pix2tex feeds the model are multiples of 32,
+# for which the "same" padding of its strided convolutions is size independent,
+# so the traced constants hold for every input size.
+_EXPORT_SIZE = (64, 320)
+
+PIX2TEX_ONNX_MIN_AGREEMENT = float(os.getenv("PIX2TEX_ONNX_MIN_AGREEMENT", "1.0"))
+# pix2tex samples from softmax(logits / temperature); this close to 0 it is argmax
+GREEDY_TEMPERATURE = 1e-4
+PARITY_FILE = "parity.json"
+
+
+# ----------------------------------------------------------------------
+#  Export
+# ----------------------------------------------------------------------
+def _split_heads(t, heads):
+    batch, length = t.shape[0], t.shape[1]
+    return t.reshape(batch, length, heads, -1).transpose(1, 2)
+
+
+def _attend(block, x, k, v):
+    import torch
+
+    q = _split_heads(block.to_q(x), block.heads)
+    attn = torch.softmax(torch.matmul(q, k.transpose(-1, -2)) * block.scale, dim=-1)
+    out = torch.matmul(attn, v).transpose(1, 2)
+    return block.to_out(out.reshape(out.shape[0], out.shape[1], -1))
+
+
+def _layers(net):
+    # x-transformers keeps each layer as [norm, block, residual_fn]
+    for kind, layer in zip(net.attn_layers.layer_types, net.attn_layers.layers):
+        yield kind, layer[0], layer[1], layer[-1]
+
+
+def _export_modules(model):
+    import torch
+
+    encoder = model.model.encoder
+    net = model.model.decoder.net
+
+    class Encoder(torch.nn.Module):
+        """pix2tex's ViT forward_features with the position indices as an input."""
+
+        def __init__(self):
+            super().__init__()
+            self.encoder = encoder
+            self.net = net
+
+        def forward(self, image, pos_index):
+            enc = self.encoder
+            x = enc.patch_embed(image)
+            x = torch.cat((enc.cls_token.expand(x.shape[0], -1, -1), x), dim=1)
+            x = enc.pos_drop(x + enc.pos_embed[:, pos_index])
+            for blk in enc.blocks:
+                x = blk(x)
+            context = enc.norm(x)
+
+            cross = []
+            for kind, _, block, _ in _layers(self.net):
+                if kind == "c":
+                    cross += [_split_heads(block.to_k(context), block.heads),
+                              _split_heads(block.to_v(context), block.heads)]
+            return tuple(cross)
+
+    class DecoderStep(torch.nn.Module):
+        """One token of TransformerWrapper.forward with cached keys/values."""
+
+        def __init__(self, max_seq_len):
+            super().__init__()
+            self.net = net
+            self.pre_norm = getattr(net.attn_layers, "pre_norm", True)
+            dim = net.token_emb.embedding_dim
+            with torch.no_grad():
+                # Whatever scaling the positional embedding applies, evaluated once for every position
+                table = net.pos_emb(torch.zeros(1, max_seq_len, dim))
+                table = table.expand(1, max_seq_len, dim) if torch.is_tensor(table) else torch.zeros(1, max_seq_len, dim)
+            self.register_buffer("pos_table", table[0].clone())
+
+        def forward(self, tokens, position, *caches):
+            self_caches = sum(2 for kind, *_ in _layers(self.net) if kind == "a")
+            past, cross = caches[:self_caches], caches[self_caches:]
+
+            x = self.net.token_emb(tokens) + self.pos_table[position].unsqueeze(0)
+            x = self.net.project_emb(x)
+            present = []
+            layers = list(_layers(self.net))
+            for i, (kind, norm, block, residual_fn) in enumerate(layers):
+                residual = x
+                if self.pre_norm:
+                    x = norm(x)
+                if kind == "a":
+                    n = len(present)
+                    k = torch.cat((past[n], _split_heads(block.to_k(x), block.heads)), dim=2)
+                    v = torch.cat((past[n + 1], _split_heads(block.to_v(x), block.heads)), dim=2)
+                    present += [k, v]
+                    out = _attend(block, x, k, v)
+                elif kind == "c":
+                    n = sum(2 for other, *_ in layers[:i] if other == "c")
+                    out = _attend(block, x, cross[n], cross[n + 1])
+                else:
+                    out = block(x)
+                x = residual_fn(out, residual)
+                if not self.pre_norm and i < len(layers) - 1:
+                    x = norm(x)
+            logits = self.net.to_logits(self.net.norm(x))[:, -1]
+            return (logits, *present)
+
+    return Encoder().eval(), DecoderStep(model.args.max_seq_len).eval()
+
+
+def pos_index(height, width, patch_size, max_width):
+    """
+    Returns the positional embedding rows pix2tex's encoder uses for an image size.
+    """
+    h, w = height // patch_size, width // patch_size
+    rows = np.repeat(np.arange(h) * (max_width // patch_size - w), w) + np.arange(h * w)
+    return np.concatenate(([0], rows + 1)).astype(np.int64)
+
+
+def export(out_dir, int8=False, opset=14):
+    """
+    Exports a LatexOCR model to ONNX.
+
+    Args:
+        out_dir: Directory that receives the graphs, tokenizer and config.
+        int8: Also write dynamically quantized `*.int8.onnx` graphs.
+        opset: ONNX opset version.
+
+    Returns:
+        list: The paths written.
+    """
+    import shutil
+
+    import torch
+    from pix2tex.cli import LatexOCR
+    from pix2tex.utils import in_model_path
+
+    out_dir = os.path.abspath(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    model = LatexOCR()
+    args = model.args
+    encoder, decoder = _export_modules(model)
+    written = []
+
+    height, width = _EXPORT_SIZE
+    image = torch.randn(1, 1, height, width)
+
+    if model.image_resizer is not None:
+        path = os.path.join(out_dir, "resizer.onnx")
+        torch.onnx.export(
+            model.image_resizer, (image,), path, opset_version=opset,
+            input_names=["image"], output_names=["logits"],
+            dynamic_axes={"image": {2: "height", 3: "width"}},
+        )
+        written.append(path)
+
+    patch_size, max_width = encoder.encoder.patch_size, encoder.encoder.width
+    index = torch.from_numpy(pos_index(height, width, patch_size, max_width))
+    with torch.no_grad():
+        cross = encoder(image, index)
+    cross_names = [f"cross_{kv}_{i}" for i in range(len(cross) // 2) for kv in ("k", "v")]
+    path = os.path.join(out_dir, "encoder.onnx")
+    torch.onnx.export(
+        encoder, (image, index), path, opset_version=opset,
+        input_names=["image", "pos_index"], output_names=cross_names,
+        dynamic_axes={
+            "image": {0: "batch", 2: "height", 3: "width"},
+            "pos_index": {0: "patches"},
+            **{name: {0: "batch", 2: "patches"} for name in cross_names},
+        },
+    )
+    written.append(path)
+
+    # Trace the step with a few cached tokens so the cache length stays dynamic
+    heads, dim_head = cross[0].shape[1], cross[0].shape[3]
+    self_layers = sum(1 for kind, *_ in _layers(decoder.net) if kind == "a")
+    past = [torch.zeros(1, heads, 3, dim_head) for _ in range(2 * self_layers)]
+    past_names = [f"past_{kv}_{i}" for i in range(self_layers) for kv in ("k", "v")]
+    present_names = [name.replace("past", "present") for name in past_names]
+    tokens = torch.full((1, 1), args.bos_token, dtype=torch.long)
+    position = torch.tensor([3], dtype=torch.long)
+    path = os.path.join(out_dir, "decoder.onnx")
+    torch.onnx.export(
+        decoder, (tokens, position, *past, *cross), path, opset_version=opset,
+        input_names=["tokens", "position", *past_names, *cross_names],
+        output_names=["logits", *present_names],
+        dynamic_axes={
+            "tokens": {0: "batch"},
+            "logits": {0: "batch"},
+            **{name: {0: "batch", 2: "past"} for name in past_names},
+            **{name: {0: "batch", 2: "total"} for name in present_names},
+            **{name: {0: "batch", 2: "patches"} for name in cross_names},
+        },
+    )
+    written.append(path)
+
+    if int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        for path in list(written):
+            quantized = path.replace(".onnx", ".int8.onnx")
+            quantize_dynamic(path, quantized, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+            written.append(quantized)
+
+    with in_model_path():
+        shutil.copy(args.tokenizer, os.path.join(out_dir, "tokenizer.json"))
+    config = {
+        "max_dimensions": list(args.max_dimensions),
+        "min_dimensions": list(args.min_dimensions),
+        "max_seq_len": args.max_seq_len,
+        "bos_token": args.bos_token,
+        "eos_token": args.eos_token,
+        "pad_token": args.pad_token,
+        "patch_size": patch_size,
+        "max_width": max_width,
+    }
+    with open(os.path.join(out_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    written += [os.path.join(out_dir, "tokenizer.json"), os.path.join(out_dir, "config.json")]
+    return written
+
+
+def check_parity(model_dir, images, int8=False):
+    """
+    Decodes sample images greedily with the eager model and the exported
+    graphs and records how often they agree in `model_dir`/parity.json.
+
+    Args:
+        model_dir: Directory written by `export`.
+        images: Paths of the sample images.
+        int8: Check the quantized graphs instead.
+
+    Returns:
+        dict: {"int8", "images", "agreement", "samples": [{"image", "eager", "onnx"}, ...]}
+    """
+    from PIL import Image
+    from pix2tex.cli import LatexOCR
+
+    from normalize import normalize_latex
+
+    eager = LatexOCR()
+    eager.args.temperature = GREEDY_TEMPERATURE
+    onnx = OnnxLatexOCR(model_dir, int8=int8)
+    samples = []
+    for path in images:
+        image = Image.open(path).convert("RGB")
+        samples.append({"image": os.path.basename(path), "eager": eager(image), "onnx": onnx(image)})
+    agreed = sum(normalize_latex(s["eager"]) == normalize_latex(s["onnx"]) for s in samples)
+    report = {
+        "int8": int8,
+        "images": len(samples),
+        "agreement": round(agreed / len(samples), 4) if samples else 0.0,
+        "samples": samples,
+    }
+    name = PARITY_FILE.replace(".json", ".int8.json") if int8 else PARITY_FILE
+    with open(os.path.join(model_dir, name), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def verified(model_dir, int8=False, min_agreement=PIX2TEX_ONNX_MIN_AGREEMENT):
+    """
+    Tells whether `check_parity` passed for the graphs in `model_dir`.
+
+    Returns:
+        tuple: (bool, reason)
+    """
+    name = PARITY_FILE.replace(".json", ".int8.json") if int8 else PARITY_FILE
+    try:
+        with open(os.path.join(model_dir, name)) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return False, f"no {name} in {model_dir}; run pix2tex_onnx.py to export and check the graphs"
+    if not report.get("images"):
+        return False, f"{name} was checked on no images"
+    if report.get("agreement", 0.0) < min_agreement:
+        return False, f"graphs agree with the eager model on {report['agreement']:.0%} of samples, need {min_agreement:.0%}"
+    return True, f"graphs agree with the eager model on {report['agreement']:.0%} of {report['images']} samples"
+
+
+# ----------------------------------------------------------------------
+#  Serving
+# ----------------------------------------------------------------------
+class OnnxLatexOCR:
+    """
+    LatexOCR on ONNX Runtime with a KV-cached decoder.
+
+    Args:
+        model_dir: Directory written by `export`.
+        int8: Load the quantized graphs.
+        threads: Intra-op threads per session, 0 for ONNX Runtime's default.
+        temperature: 0 for greedy decoding, otherwise pix2tex's top-k sampling.
+    """
+
+    def __init__(self, model_dir, int8=False, threads=PIX2TEX_THREADS, temperature=0.0):
+        import onnxruntime as ort
+        from munch import Munch
+        from transformers import PreTrainedTokenizerFast
+
+        with open(os.path.join(model_dir, "config.json")) as f:
+            self.args = Munch(json.load(f))
+        self.temperature = temperature
+        self.tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(model_dir, "tokenizer.json"))
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        suffix = ".int8.onnx" if int8 else ".onnx"
+
+        def session(name):
+            path = os.path.join(model_dir, name + suffix)
+            if not os.path.exists(path):
+                return None
+            return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+        self.resizer = session("resizer")
+        self.encoder = session("encoder")
+        self.decoder = session("decoder")
+        if self.encoder is None or self.decoder is None:
+            raise FileNotFoundError(f"No exported pix2tex{suffix} graphs in {model_dir}")
+
+        self.cross_names = [o.name for o in self.encoder.get_outputs()]
+        self.past_inputs = [i for i in self.decoder.get_inputs() if i.name.startswith("past_")]
+
+    def __call__(self, img):
+        return self.predict([self.prepare(img)])[0]
+
+    def prepare(self, img):
+        """
+        Returns the padded PIL image for the encoder, as LatexOCR prepares it.
+        """
+        if self.resizer is None:
+            return prepare_image(img, self.args)
+
+        def width(t):
+            logits = self.resizer.run(None, {"image": t.numpy()})[0]
+            return (int(logits.argmax(-1)[0]) + 1) * 32
+        return prepare_image(img, self.args, width)
+
+    def predict(self, images):
+        """
+        Decodes a batch of prepared images.
+
+        Returns:
+            list: One LaTeX string per image.
+        """
+        from pix2tex.utils import post_process, token2str
+
+        batch = pad_batch(images).numpy()
+        size = len(images)
+        index = pos_index(batch.shape[2], batch.shape[3], self.args.patch_size, self.args.max_width)
+        cross = dict(zip(self.cross_names, self.encoder.run(None, {"image": batch, "pos_index": index})))
+
+        feeds = dict(cross)
+        for i in self.past_inputs:
+            feeds[i.name] = np.zeros((size, i.shape[1], 0, i.shape[3]), np.float32)
+        tokens = np.full((size, 1), self.args.bos_token, np.int64)
+        finished = np.zeros(size, bool)
+        out = []
+        for position in range(self.args.max_seq_len):
+            feeds["tokens"] = tokens
+            feeds["position"] = np.array([position], np.int64)
+            logits, *present = self.decoder.run(None, feeds)
+            for i, value in zip(self.past_inputs, present):
+                feeds[i.name] = value
+
+            sample = self._select(logits)
+            sample[finished] = self.args.pad_token
+            out.append(sample)
+            finished |= sample == self.args.eos_token
+            if finished.all():
+                break
+            tokens = sample[:, None]
+        return [post_process(text) for text in token2str(np.stack(out, axis=1), self.tokenizer)]
+
+    def _select(self, logits):
+        if not self.temperature:
+            return logits.argmax(-1).astype(np.int64)
+
+        # pix2tex's top_k filter (thres=0.9) keeps the top 10% of the vocabulary
+        k = max(1, int(0.1 * logits.shape[-1]))
+        top = np.argpartition(-logits, k - 1, axis=-1)[:, :k]
+        scaled = np.take_along_axis(logits, top, axis=-1) / self.temperature
+        probs = np.exp(scaled - scaled.max(-1, keepdims=True))
+        probs /= probs.sum(-1, keepdims=True)
+        choice = [np.random.choice(k, p=p) for p in probs]
+        return top[np.arange(len(top)), choice].astype(np.int64)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export pix2tex LatexOCR to ONNX")
+    parser.add_argument("--out", default="pix2tex-onnx", help="output directory")
+    parser.add_argument("--int8", action="store_true", help="also write int8 dynamically quantized graphs")
+    parser.add_argument("--opset", type=int, default=14)
+    parser.add_argument("--images", nargs="*", help="sample images for the parity check")
+    cli_args = parser.parse_args()
+    for path in export(cli_args.out, int8=cli_args.int8, opset=cli_args.opset):
+        print(path)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = cli_args.images or [os.path.join(here, name) for name in ("p1.png", "q1.png")]
+    for quantized in (False, True) if cli_args.int8 else (False,):
+        report = check_parity(cli_args.out, samples, int8=quantized)
+        label = "int8" if quantized else "fp32"
+        print(f"parity ({label}): {report['agreement']:.0%} of {report['images']} samples")
+        for sample in report["samples"]:
+            if sample["eager"] != sample["onnx"]:
+                print(f"  {sample['image']}: eager {sample['eager']!r} onnx {sample['onnx']!r}")
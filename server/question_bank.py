@@ -0,0 +1,315 @@
+"""
+Persistent bank of generated quiz questions.
+
+Every validated question that /generate-quiz gets from the model is stored in
+a SQLite file (QUESTION_BANK_DB) under its normalized topic, quiz type and
+difficulty. An in-memory index maps each (quizType, difficulty) to its
+topics, so a new request is matched against them with rapidfuzz
+(token_sort_ratio >= QUESTION_BANK_TOPIC_SIMILARITY, and the same numbers, so
+"Algebra 2" never gets "Algebra 1" questions).
+
+Each client is served a bank question at most once (the last
+QUESTION_BANK_MAX_CLIENTS clients are remembered). The routes record what a
+quiz actually contained with `record_served`, whether it came from the bank,
+the quiz pool or the model. A whole quiz comes from
+the bank only when the matching topics hold more than
+QUESTION_BANK_POOL_FACTOR times as many distinct questions the client hasn't
+seen as the quiz needs, so nobody gets the same few questions over and over;
+until then at most half the quiz comes from the bank and the model is asked
+for the rest, which keeps the bank growing.
+
+Questions are picked at random among the matches; near-identical question
+texts count as one. Several processes can share the file: each one picks up
+rows written by the others on its next lookup. Set QUESTION_BANK=0 to turn
+the bank off.
+"""
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+QUESTION_BANK_ENABLED = os.getenv("QUESTION_BANK", "1") == "1"
+QUESTION_BANK_DB = os.getenv(
+    "QUESTION_BANK_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "question_bank.db")
+)
+QUESTION_BANK_TOPIC_SIMILARITY = float(os.getenv("QUESTION_BANK_TOPIC_SIMILARITY", "90"))
+QUESTION_BANK_POOL_FACTOR = float(os.getenv("QUESTION_BANK_POOL_FACTOR", "3"))
+QUESTION_BANK_MAX_CLIENTS = int(os.getenv("QUESTION_BANK_MAX_CLIENTS", "10000"))
+# Questions whose texts are at least this similar (and use the same numbers) count as duplicates
+QUESTION_BANK_DUPLICATE_SIMILARITY = float(os.getenv("QUESTION_BANK_DUPLICATE_SIMILARITY", "90"))
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+_NUMBERS = re.compile(r"\d+")
+
+
+def normalize_topic(text):
+    """Folds case, punctuation and spacing: "Quadratic  Equations!" -> "quadratic equations"."""
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", str(text).casefold())).strip()
+
+
+def _question_key(item):
+    return normalize_topic(item.get("question", ""))
+
+
+def _same_topic(topic, other):
+    # "Algebra 1" and "Algebra 2" are different courses
+    return _NUMBERS.findall(topic) == _NUMBERS.findall(other)
+
+
+def _duplicate(key, other):
+    # "Solve 2x + 3 = 7" and "Solve 2x + 5 = 7" are different questions
+    if _NUMBERS.findall(key) != _NUMBERS.findall(other):
+        return False
+    from rapidfuzz import fuzz
+
+    return fuzz.ratio(key, other) >= QUESTION_BANK_DUPLICATE_SIMILARITY
+
+
+class QuestionBank:
+    """
+    SQLite-backed question store with an in-memory fuzzy topic index.
+
+    Args:
+        path: The SQLite file. Created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # (quiz_type, difficulty) -> {topic: [question id, ...]}
+        self._topics = {}
+        # question id -> (question key, question dict)
+        self._questions = {}
+        # (quiz_type, difficulty, question key) -> question id
+        self._ids = {}
+        self._last_id = 0
+        # client id -> question ids it was served, least recently active first
+        self._served = OrderedDict()
+        self._local = threading.local()
+        self.lookups = 0
+        self.hits = 0
+        self.partial = 0
+        self.served = 0
+        self.stored = 0
+        self.lookup_seconds = 0.0
+        self.max_lookup_seconds = 0.0
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS questions ("
+            " id INTEGER PRIMARY KEY, topic TEXT NOT NULL, quiz_type TEXT NOT NULL,"
+            " difficulty TEXT NOT NULL, question_key TEXT NOT NULL, body TEXT NOT NULL, created REAL NOT NULL,"
+            " UNIQUE (quiz_type, difficulty, question_key))"
+        )
+        conn.commit()
+        self._sync()
+        # A forked worker must not reuse the parent's connections
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _sync(self):
+        """Indexes the rows added since the last sync, by this process or another one."""
+        rows = self._conn().execute(
+            "SELECT id, topic, quiz_type, difficulty, question_key, body FROM questions WHERE id > ? ORDER BY id",
+            (self._last_id,),
+        ).fetchall()
+        with self._lock:
+            for row_id, topic, quiz_type, difficulty, question_key, body in rows:
+                if row_id in self._questions:
+                    continue
+                self._questions[row_id] = (question_key, json.loads(body))
+                self._ids[(quiz_type, difficulty, question_key)] = row_id
+                self._topics.setdefault((quiz_type, difficulty), {}).setdefault(topic, []).append(row_id)
+                self._last_id = max(self._last_id, row_id)
+
+    def add(self, topic, quiz_type, difficulty, questions):
+        """
+        Stores the valid questions of a generated quiz. Exact duplicates
+        (same normalized text for the same type and difficulty) are skipped.
+
+        Returns:
+            int: How many questions were new.
+        """
+        import llm
+
+        now = time.time()
+        rows = [
+            (normalize_topic(topic), quiz_type, normalize_topic(difficulty), _question_key(item), json.dumps(item), now)
+            for item in questions
+            if llm.valid_question(item, quiz_type)
+        ]
+        if not rows:
+            return 0
+        try:
+            conn = self._conn()
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO questions (topic, quiz_type, difficulty, question_key, body, created)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+            added = conn.total_changes - before
+        except sqlite3.Error as e:
+            print(f"Question bank write failed: {e}")
+            return 0
+        with self._lock:
+            self.stored += added
+        return added
+
+    def assemble(self, topic, quiz_type, difficulty, count=5, client_id=None):
+        """
+        Picks up to `count` distinct questions on topics matching the request
+        that `client_id` hasn't been served yet. Nothing is recorded as served:
+        call `record_served` with the quiz that is actually returned.
+
+        Returns:
+            list: The questions found: `count` only when the bank holds plenty
+                more, otherwise at most half of them (or none).
+        """
+        from rapidfuzz import fuzz, process
+
+        started = time.perf_counter()
+        try:
+            self._sync()
+        except sqlite3.Error as e:
+            print(f"Question bank read failed: {e}")
+
+        topic = normalize_topic(topic)
+        with self._lock:
+            topics = self._topics.get((quiz_type, normalize_topic(difficulty)), {})
+            matches = process.extract(
+                topic,
+                list(topics),
+                scorer=fuzz.token_sort_ratio,
+                score_cutoff=QUESTION_BANK_TOPIC_SIMILARITY,
+                limit=None,
+            )
+            seen = self._served.get(client_id, ())
+            candidates = [
+                (row_id, *self._questions[row_id])
+                for match in matches if _same_topic(topic, match[0])
+                for row_id in topics[match[0]] if row_id not in seen
+            ]
+
+        random.shuffle(candidates)
+        distinct = []
+        for row_id, key, item in candidates:
+            if len(distinct) > QUESTION_BANK_POOL_FACTOR * count:
+                break
+            if not any(_duplicate(key, other) for _, other, _ in distinct):
+                distinct.append((row_id, key, item))
+        limit = count if len(distinct) > QUESTION_BANK_POOL_FACTOR * count else count // 2
+        chosen = [item for _, _, item in distinct[:limit]]
+
+        elapsed = time.perf_counter() - started
+        metrics.observe_stage("question_bank", elapsed, started)
+        with self._lock:
+            self.lookups += 1
+            self.hits += len(chosen) == count
+            self.partial += 0 < len(chosen) < count
+            self.served += len(chosen)
+            self.lookup_seconds += elapsed
+            self.max_lookup_seconds = max(self.max_lookup_seconds, elapsed)
+        return chosen
+
+    def record_served(self, client_id, quiz_type, difficulty, questions):
+        """
+        Records the questions of a returned quiz as served to `client_id`, so
+        the bank doesn't offer them to it again. Questions that aren't in the
+        bank are ignored.
+        """
+        if client_id is None or not questions:
+            return
+        try:
+            # Picks up questions just generated, by this process or another one
+            self._sync()
+        except sqlite3.Error as e:
+            print(f"Question bank read failed: {e}")
+        difficulty = normalize_topic(difficulty)
+        with self._lock:
+            row_ids = [
+                self._ids.get((quiz_type, difficulty, _question_key(item)))
+                for item in questions if isinstance(item, dict)
+            ]
+        self._remember(client_id, [row_id for row_id in row_ids if row_id is not None])
+
+    def _remember(self, client_id, row_ids):
+        if not row_ids:
+            return
+        with self._lock:
+            served = self._served.pop(client_id, set())
+            served.update(row_ids)
+            # Re-inserted last, so the dict stays in least recently active order
+            self._served[client_id] = served
+            if len(self._served) > QUESTION_BANK_MAX_CLIENTS:
+                del self._served[next(iter(self._served))]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.lookups
+            return {
+                "enabled": True,
+                "questions": len(self._questions),
+                "topics": sum(len(topics) for topics in self._topics.values()),
+                "lookups": lookups,
+                "hits": self.hits,
+                "partial": self.partial,
+                "misses": lookups - self.hits - self.partial,
+                "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "questionsServed": self.served,
+                "questionsStored": self.stored,
+                "avgLookupMs": round(1000 * self.lookup_seconds / lookups, 3) if lookups else 0.0,
+                "maxLookupMs": round(1000 * self.max_lookup_seconds, 3),
+            }
+
+
+def build_bank():
+    """Returns the QuestionBank configured from the environment, or None when it is disabled."""
+    if not QUESTION_BANK_ENABLED:
+        return None
+    try:
+        return QuestionBank(QUESTION_BANK_DB)
+    except sqlite3.Error as e:
+        print(f"Question bank disabled, could not open {QUESTION_BANK_DB}: {e}")
+        return None
+
+
+def merge(found, generated, count=5):
+    """
+    Tops up the questions found in the bank with newly generated ones,
+    skipping any that repeat a question already in the quiz.
+
+    Returns:
+        list: At most `count` questions; fewer when generated ones were
+            skipped, in which case the caller generates the rest.
+    """
+    keys = {_question_key(item) for item in found}
+    quiz = list(found)
+    for item in generated:
+        if len(quiz) == count:
+            break
+        key = _question_key(item) if isinstance(item, dict) else None
+        if key not in keys:
+            quiz.append(item)
+            keys.add(key)
+    return quiz
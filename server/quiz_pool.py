@@ -0,0 +1,194 @@
+"""
+Pool of pre-generated quizzes for the popular /generate-quiz requests.
+
+Most quiz requests hit a small set of (topic, quizType, difficulty) keys, and
+each one otherwise waits seconds for a full GPT-4o generation. `QuizPool`
+keeps an exponentially decayed request count per key; for the hottest
+QUIZ_POOL_HOT_KEYS keys (seen at least QUIZ_POOL_MIN_REQUESTS times) a
+background producer keeps up to QUIZ_POOL_SIZE validated quizzes ready, so a
+request is answered straight from memory and the pool is topped up
+afterwards.
+
+Pooled quizzes expire after QUIZ_POOL_MAX_AGE seconds, each is handed to at
+most QUIZ_POOL_MAX_SERVES clients, and a client never receives the same
+pooled quiz twice.
+"""
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+QUIZ_POOL_ENABLED = os.getenv("QUIZ_POOL", "1") == "1"
+QUIZ_POOL_SIZE = int(os.getenv("QUIZ_POOL_SIZE", "3"))
+QUIZ_POOL_HOT_KEYS = int(os.getenv("QUIZ_POOL_HOT_KEYS", "20"))
+QUIZ_POOL_MIN_REQUESTS = float(os.getenv("QUIZ_POOL_MIN_REQUESTS", "2"))
+QUIZ_POOL_HALF_LIFE = float(os.getenv("QUIZ_POOL_HALF_LIFE", "3600"))
+QUIZ_POOL_MAX_AGE = float(os.getenv("QUIZ_POOL_MAX_AGE", str(6 * 3600)))
+QUIZ_POOL_MAX_SERVES = int(os.getenv("QUIZ_POOL_MAX_SERVES", "1"))
+QUIZ_POOL_WORKERS = int(os.getenv("QUIZ_POOL_WORKERS", "2"))
+# Request counters kept for at most this many keys
+_MAX_TRACKED = 1000
+
+
+def quiz_key(topic, quiz_type, difficulty):
+    """Folds case and spacing so "Algebra " and "algebra" share a pool."""
+    return (" ".join(str(topic).split()).casefold(), quiz_type, str(difficulty).casefold())
+
+
+class _Entry:
+    __slots__ = ("id", "questions", "created", "served_to")
+
+    def __init__(self, entry_id, questions):
+        self.id = entry_id
+        self.questions = questions
+        self.created = time.time()
+        self.served_to = set()
+
+
+class QuizPool:
+    """
+    Per-key pools of ready quizzes, refilled by background threads.
+
+    Args:
+        generate: Callable (topic, quiz_type, difficulty) -> validated list of
+            questions. Runs on the producer threads.
+    """
+
+    def __init__(self, generate, size=QUIZ_POOL_SIZE, workers=QUIZ_POOL_WORKERS):
+        self.generate = generate
+        self.size = size
+        self.workers = workers
+        self._ids = itertools.count(1)
+        self._start()
+        # Threads don't survive fork(); a pre-forked worker starts its own producers
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._scores = {}
+        self._pending = set()
+        self._jobs = queue.Queue()
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_errors = 0
+        self.expired = 0
+        for i in range(self.workers):
+            threading.Thread(target=self._produce, name=f"quiz-pool-{i}", daemon=True).start()
+
+    # ------------------------------------------------------------------
+    #  Request side
+    # ------------------------------------------------------------------
+    def take(self, topic, quiz_type, difficulty, client_id):
+        """
+        Records a request for a key and returns a pooled quiz for it, if any.
+
+        Args:
+            topic, quiz_type, difficulty: The /generate-quiz fields.
+            client_id: Identifies the student, so nobody gets the same quiz twice.
+
+        Returns:
+            list or None: The questions, or None when the caller must generate.
+        """
+        key = quiz_key(topic, quiz_type, difficulty)
+        now = time.time()
+        with self._lock:
+            self._bump(key, now)
+            questions = self._pop(key, client_id, now)
+            if questions is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._schedule(key, (topic, quiz_type, difficulty))
+        return questions
+
+    def _bump(self, key, now):
+        score, last = self._scores.get(key, (0.0, now))
+        self._scores[key] = (score * 0.5 ** ((now - last) / QUIZ_POOL_HALF_LIFE) + 1, now)
+        if len(self._scores) > _MAX_TRACKED:
+            coldest = min(self._scores, key=lambda k: self._decayed(k, now))
+            del self._scores[coldest]
+            self._pools.pop(coldest, None)
+
+    def _decayed(self, key, now):
+        score, last = self._scores[key]
+        return score * 0.5 ** ((now - last) / QUIZ_POOL_HALF_LIFE)
+
+    def _pop(self, key, client_id, now):
+        pool = self._pools.get(key)
+        if not pool:
+            return None
+        for entry in list(pool):
+            if now - entry.created > QUIZ_POOL_MAX_AGE:
+                pool.remove(entry)
+                self.expired += 1
+            elif client_id not in entry.served_to:
+                entry.served_to.add(client_id)
+                if len(entry.served_to) >= QUIZ_POOL_MAX_SERVES:
+                    pool.remove(entry)
+                return entry.questions
+        return None
+
+    def _hot(self, key, now):
+        # The threshold applies to the count as of the key's last request, so a
+        # refill chain isn't cut short by a few seconds of decay
+        if round(self._scores[key][0], 6) < QUIZ_POOL_MIN_REQUESTS:
+            return False
+        hottest = heapq.nlargest(QUIZ_POOL_HOT_KEYS, self._scores, key=lambda k: self._decayed(k, now))
+        return key in hottest
+
+    def _schedule(self, key, request):
+        if key in self._pending or not self._hot(key, time.time()):
+            return
+        if len(self._pools.get(key, ())) >= self.size:
+            return
+        self._pending.add(key)
+        self._jobs.put((key, request))
+
+    # ------------------------------------------------------------------
+    #  Producer side
+    # ------------------------------------------------------------------
+    def _produce(self):
+        while True:
+            key, request = self._jobs.get()
+            try:
+                questions = self.generate(*request)
+            except Exception as e:
+                print(f"Quiz pool refill for {key} failed:", e)
+                with self._lock:
+                    self.refill_errors += 1
+                    self._pending.discard(key)
+                continue
+
+            with self._lock:
+                self.refills += 1
+                pool = self._pools.setdefault(key, deque())
+                pool.append(_Entry(next(self._ids), questions))
+                self._pending.discard(key)
+                # Keep going until the pool is full or the key cools down
+                self._schedule(key, request)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            requests = self.hits + self.misses
+            hot = heapq.nlargest(5, self._scores, key=lambda k: self._decayed(k, now))
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / requests, 4) if requests else 0.0,
+                "refills": self.refills,
+                "refillErrors": self.refill_errors,
+                "expired": self.expired,
+                "trackedKeys": len(self._scores),
+                "pooledQuizzes": sum(len(pool) for pool in self._pools.values()),
+                "refillQueue": self._jobs.qsize(),
+                "hottest": [
+                    {"key": list(key), "score": round(self._decayed(key, now), 2), "pooled": len(self._pools.get(key, ()))}
+                    for key in hot
+                ],
+            }
@@ -0,0 +1,134 @@
+"""
+Server-sent-event streaming of step-by-step solutions.
+
+The model streams the `math_solution` JSON a few characters at a time.
+`SolutionStreamParser` scans those chunks as they arrive and reports each
+top-level field (`overview`, `finalAnswer`) and each element of `steps` as
+soon as its closing quote or brace has been received, so the client can render
+the first step long before the whole solution is finished.
+"""
+import json
+
+
+class SolutionStreamParser:
+    """
+    Incremental parser for a streamed `math_solution` JSON object.
+
+    Call `feed(chunk)` with each piece of text; it returns the events that
+    became complete within that chunk as `(event, data)` tuples:
+
+        ("overview", "...")
+        ("step", {"index": 0, "title": "...", "content": "..."})
+        ("finalAnswer", "...")
+
+    `result()` returns the fully parsed object once the stream has ended.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+        self._after_colon = False
+        self._key = None
+        self._object_start = None
+        self._step_index = 0
+
+    def feed(self, chunk):
+        events = []
+        self.buffer += chunk
+        buf = self.buffer
+
+        for i in range(self._pos, len(buf)):
+            c = buf[i]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        text = json.loads(buf[self._string_start:i + 1])
+                        if self._after_colon:
+                            events.append((self._key, text))
+                        else:
+                            self._key = text
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                self._depth += 1
+                if self._depth == 3 and c == "{" and self._key == "steps":
+                    self._object_start = i
+            elif c in "}]":
+                if self._depth == 3 and c == "}" and self._key == "steps":
+                    step = json.loads(buf[self._object_start:i + 1])
+                    step["index"] = self._step_index
+                    self._step_index += 1
+                    events.append(("step", step))
+                self._depth -= 1
+            elif self._depth == 1 and c == ":":
+                self._after_colon = True
+            elif self._depth == 1 and c == ",":
+                self._after_colon = False
+
+        self._pos = len(buf)
+        return events
+
+    def result(self):
+        return json.loads(self.buffer)
+
+
+def solution_events(solution):
+    """
+    Yields the same events as SolutionStreamParser for an already complete solution.
+    """
+    yield "overview", solution.get("overview", "")
+    for index, step in enumerate(solution.get("steps", [])):
+        yield "step", dict(step, index=index)
+    yield "finalAnswer", solution.get("finalAnswer", "")
+
+
+def sse(event, data):
+    """
+    Formats one server-sent event.
+
+    Args:
+        event: The event name.
+        data: Any JSON serialisable payload.
+
+    Returns:
+        str: The encoded event, terminated by a blank line.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def ndjson(event, data):
+    """
+    Formats one newline-delimited JSON record: `data` with an "event" field added.
+    """
+    return json.dumps(dict(data, event=event)) + "\n"
+
+
+def stream_deltas(stream):
+    """
+    Yields the text content of each chunk of a blocking OpenAI chat completion stream.
+    """
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def astream_deltas(stream):
+    """
+    Async counterpart of stream_deltas for AsyncOpenAI streams.
+    """
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
@@ -0,0 +1,524 @@
+"""
+Local SymPy solver for the tractable /solve-math problems.
+
+Most homework submissions are one of a handful of shapes: a linear or quadratic
+equation, a small linear system, the derivative or integral of a polynomial,
+or an expression to simplify or evaluate. `solve` parses the LaTeX input,
+recognises those shapes and writes the same `overview` / `steps` /
+`finalAnswer` object the model returns, so they are answered in milliseconds
+without an upstream call. Anything else (prose word problems, inequalities,
+non-polynomial calculus, ...) returns None and goes to the model.
+
+Each attempt runs on a small thread pool with a SYMBOLIC_TIME_BUDGET_MS budget;
+when it runs out, or every solver thread is busy, the caller falls back to the
+model. Set SYMBOLIC_SOLVER=0 to always use the model.
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import metrics
+from normalize import normalize_latex, parse_round_trips
+
+SYMBOLIC_SOLVER = os.getenv("SYMBOLIC_SOLVER", "1") == "1"
+SYMBOLIC_TIME_BUDGET_MS = float(os.getenv("SYMBOLIC_TIME_BUDGET_MS", "500"))
+SYMBOLIC_WORKERS = int(os.getenv("SYMBOLIC_WORKERS", "2"))
+
+# Leading instructions, matched on normalize_latex output (prose is lowercased)
+_INTENTS = [
+    ("derivative", re.compile(r"^(?:find\s+)?(?:the\s+)?(?:derivative|differentiate)(?:\s+of)?\s*:?\s*")),
+    ("integral", re.compile(r"^(?:find\s+|evaluate\s+)?(?:the\s+)?(?:integral|integrate|antiderivative)(?:\s+of)?\s*:?\s*")),
+    ("expand", re.compile(r"^expand\s*:?\s*")),
+    ("factor", re.compile(r"^factori[sz]e\s*:?\s*|^factor\s*:?\s*")),
+    ("simplify", re.compile(r"^simplify\s*:?\s*")),
+    ("solve", re.compile(r"^(?:solve|find\s+[a-z](?:\s+and\s+[a-z])?)(?:\s+(?:the\s+)?(?:equation|system))?"
+                         r"(?:\s+for\s+[a-z](?:\s*(?:,|and)\s*[a-z])*)?\s*:?\s*")),
+    ("evaluate", re.compile(r"^(?:evaluate|calculate|compute|find)\s*:?\s*")),
+]
+_RESPECT_TO = re.compile(r"\s*(?:with\s+respect\s+to|w\.r\.t\.?)\s*([a-z])\s*$")
+# Any prose word left after the instruction means this is a word problem
+_PROSE = re.compile(r"(?<![\\A-Za-z])[A-Za-z]{3,}")
+_CASES = re.compile(r"\\(?:begin|end)\{(?:cases|array|aligned)\}(?:\{[^}]*\})?|&")
+_SYSTEM_SEPARATOR = re.compile(r",|;|\\\\|\s+and\s+")
+# parse_latex reads \log as ln; homework usually means base 10
+_UNQUALIFIED_LOG = re.compile(r"\\log(?![_A-Za-z])")
+
+_executor = ThreadPoolExecutor(max_workers=SYMBOLIC_WORKERS, thread_name_prefix="symbolic")
+_slots = threading.BoundedSemaphore(SYMBOLIC_WORKERS)
+_lock = threading.Lock()
+_counts = {"attempts": 0, "solved": 0, "unsupported": 0, "timeouts": 0, "busy": 0, "errors": 0, "solvedSeconds": 0.0}
+_kinds = {}
+_warmup_thread = None
+
+
+class Unsupported(Exception):
+    """Raised when the problem isn't one of the shapes the local solver handles."""
+
+
+def _step(title, content):
+    return {"title": title, "content": content}
+
+
+def _m(expr):
+    from sympy import latex
+
+    return latex(expr)
+
+
+def _single_variable(expr, default="x"):
+    from sympy import Symbol
+
+    symbols = sorted(expr.free_symbols, key=str)
+    if len(symbols) > 1:
+        raise Unsupported("more than one variable")
+    return symbols[0] if symbols else Symbol(default)
+
+
+def _numeric_poly(expr, var, max_degree=None):
+    from sympy import Poly
+
+    if not expr.is_polynomial(var):
+        raise Unsupported("not a polynomial")
+    poly = Poly(expr, var)
+    if not all(c.is_number for c in poly.all_coeffs()):
+        raise Unsupported("symbolic coefficients")
+    if max_degree is not None and poly.degree() > max_degree:
+        raise Unsupported("degree too high")
+    return poly
+
+
+def _terms(poly):
+    # Highest power first, the way the problem would be written
+    return [coeff * poly.gens[0] ** power for (power,), coeff in poly.terms()]
+
+
+def _group(expr):
+    from sympy import Add
+
+    return f"\\left({_m(expr)}\\right)" if isinstance(expr, Add) else _m(expr)
+
+
+def _exact(expr):
+    # 0.5x = 2 should give x = 4, not x = 4.0
+    from sympy import Float, nsimplify
+
+    if expr.has(Float):
+        return nsimplify(expr, rational=True)
+    return expr
+
+
+# ----------------------------------------------------------------------
+#  Problem shapes
+# ----------------------------------------------------------------------
+def _linear(eq, var, poly):
+    a, b = poly.all_coeffs()
+    solution = -b / a
+    v = _m(var)
+    steps = [_step("Write down the equation", f"${_m(eq.lhs)} = {_m(eq.rhs)}$")]
+    if eq.rhs != 0:
+        steps.append(_step(
+            "Collect the terms on one side",
+            f"Subtract ${_m(eq.rhs)}$ from both sides and combine like terms: ${_m(poly.as_expr())} = 0$.",
+        ))
+    steps.append(_step("Isolate the variable term", f"Move the constant to the right-hand side: ${_m(a * var)} = {_m(-b)}$."))
+    if a.is_Rational and a.p == 1 and a.q != 1:
+        steps.append(_step(f"Multiply both sides by ${_m(1 / a)}$", f"${v} = {_m(1 / a)} \\cdot {_group(-b)} = {_m(solution)}$"))
+    elif a != 1:
+        steps.append(_step(
+            f"Divide both sides by ${_m(a)}$",
+            f"${v} = \\frac{{{_m(-b)}}}{{{_m(a)}}} = {_m(solution)}$",
+        ))
+    steps.append(_step(
+        "Check the answer",
+        f"Substituting ${v} = {_m(solution)}$ gives ${_m(eq.lhs.subs(var, solution))} = {_m(eq.rhs.subs(var, solution))}$, so the equation holds.",
+    ))
+    return {
+        "overview": f"This is a linear equation in ${v}$. Collect the terms in ${v}$ on one side and divide by its coefficient.",
+        "steps": steps,
+        "finalAnswer": f"${v} = {_m(solution)}$",
+    }
+
+
+def _quadratic(eq, var, poly):
+    from sympy import factor, solve, sqrt
+
+    a, b, c = poly.all_coeffs()
+    v = _m(var)
+    discriminant = b ** 2 - 4 * a * c
+    roots = solve(poly.as_expr(), var)
+    steps = [
+        _step("Write the equation in standard form", f"${_m(poly.as_expr())} = 0$"),
+        _step("Identify the coefficients", f"$a = {_m(a)}$, $b = {_m(b)}$, $c = {_m(c)}$"),
+    ]
+    if discriminant > 0:
+        kind = "two real solutions"
+    elif discriminant == 0:
+        kind = "one repeated real solution"
+    else:
+        kind = "no real solutions, only two complex ones"
+    four_ac = _m(4 * a * c) if 4 * a * c >= 0 else f"\\left({_m(4 * a * c)}\\right)"
+    steps.append(_step(
+        "Compute the discriminant",
+        f"$\\Delta = b^2 - 4ac = {_m(b ** 2)} - {four_ac} = {_m(discriminant)}$, so there are {kind}.",
+    ))
+
+    factored = factor(poly.as_expr())
+    if discriminant >= 0 and sqrt(discriminant).is_rational and factored.is_Mul:
+        steps.append(_step("Factor", f"${_m(factored)} = 0$"))
+    steps.append(_step(
+        "Apply the quadratic formula",
+        f"${v} = \\frac{{-b \\pm \\sqrt{{\\Delta}}}}{{2a}} = \\frac{{{_m(-b)} \\pm \\sqrt{{{_m(discriminant)}}}}}{{{_m(2 * a)}}}$",
+    ))
+    answer = " or ".join(f"${v} = {_m(root)}$" for root in roots)
+    steps.append(_step("Write the solutions", answer))
+    return {
+        "overview": f"This is a quadratic equation in ${v}$. Bring it to standard form and solve it with the quadratic formula.",
+        "steps": steps,
+        "finalAnswer": answer,
+    }
+
+
+def _equation(eq):
+    from sympy import expand
+
+    var = _single_variable(eq)
+    poly = _numeric_poly(expand(eq.lhs - eq.rhs), var, max_degree=2)
+    if poly.degree() == 1:
+        return "linear", _linear(eq, var, poly)
+    if poly.degree() == 2:
+        return "quadratic", _quadratic(eq, var, poly)
+    raise Unsupported("no variable term")
+
+
+def _system(equations):
+    from sympy import Matrix, Poly, linear_eq_to_matrix, linsolve
+
+    symbols = sorted(set().union(*(eq.free_symbols for eq in equations)), key=str)
+    if not 2 <= len(symbols) == len(equations) <= 3:
+        raise Unsupported("not a square system")
+    expressions = [eq.lhs - eq.rhs for eq in equations]
+    for expr in expressions:
+        if not expr.is_polynomial(*symbols):
+            raise Unsupported("non-linear system")
+        poly = Poly(expr, *symbols)
+        if poly.total_degree() > 1 or not all(c.is_number for c in poly.coeffs()):
+            raise Unsupported("non-linear system")
+    A, b = linear_eq_to_matrix(expressions, symbols)
+    if A.det() == 0:
+        raise Unsupported("singular system")
+    (solution,) = linsolve((A, b), symbols)
+
+    augmented = A.row_join(b)
+    reduced, _ = augmented.rref()
+    standard = ", \\quad ".join(f"{_m((A.row(i) * Matrix(symbols))[0])} = {_m(b[i])}" for i in range(len(equations)))
+    answer = ", ".join(f"${_m(s)} = {_m(value)}$" for s, value in zip(symbols, solution))
+    names = ", ".join(f"${_m(s)}$" for s in symbols)
+    return "system", {
+        "overview": f"This is a system of {len(equations)} linear equations in {names}. Write it as an augmented matrix and eliminate variables row by row.",
+        "steps": [
+            _step("Write the system in standard form", f"${standard}$"),
+            _step("Form the augmented matrix", f"${_m(augmented)}$"),
+            _step("Row reduce", f"Eliminating one variable at a time gives the reduced row echelon form ${_m(reduced)}$."),
+            _step("Read off the solution", answer),
+        ],
+        "finalAnswer": answer,
+    }
+
+
+def _derivative(expr, var):
+    from sympy import diff, expand
+
+    poly = _numeric_poly(expand(expr), var)
+    v = _m(var)
+    rules = ", \\quad ".join(f"\\frac{{d}}{{d{v}}}\\left({_m(t)}\\right) = {_m(diff(t, var))}" for t in _terms(poly))
+    result = diff(poly.as_expr(), var)
+    lhs = f"\\frac{{d}}{{d{v}}}\\left({_m(expr)}\\right)"
+    steps = []
+    if poly.as_expr() != expr:
+        steps.append(_step("Expand the expression", f"${lhs} = \\frac{{d}}{{d{v}}}\\left({_m(poly.as_expr())}\\right)$"))
+    steps += [
+        _step("Apply the power rule to each term", f"${rules}$"),
+        _step("Combine the terms", f"${lhs} = {_m(result)}$"),
+    ]
+    return "derivative", {
+        "overview": f"Differentiate the polynomial term by term with the power rule $\\frac{{d}}{{d{v}}} {v}^n = n {v}^{{n-1}}$.",
+        "steps": steps,
+        "finalAnswer": f"${lhs} = {_m(result)}$",
+    }
+
+
+def _integral(expr, var, bounds=None):
+    from sympy import expand, integrate
+
+    poly = _numeric_poly(expand(expr), var)
+    v = _m(var)
+    rules = ", \\quad ".join(f"\\int {_m(t)} \\, d{v} = {_m(integrate(t, var))}" for t in _terms(poly))
+    antiderivative = integrate(poly.as_expr(), var)
+    steps = [
+        _step("Apply the power rule to each term", f"${rules}$"),
+        _step("Combine the terms", f"$F({v}) = {_m(antiderivative)}$"),
+    ]
+    if bounds is None:
+        answer = f"$\\int {_group(expr)} \\, d{v} = {_m(antiderivative)} + C$"
+        steps.append(_step("Add the constant of integration", answer))
+        overview = f"Integrate the polynomial term by term with the power rule $\\int {v}^n \\, d{v} = \\frac{{{v}^{{n+1}}}}{{n+1}} + C$."
+    else:
+        low, high = bounds
+        value = antiderivative.subs(var, high) - antiderivative.subs(var, low)
+        steps.append(_step(
+            "Evaluate at the bounds",
+            f"$F({_m(high)}) - F({_m(low)}) = {_m(antiderivative.subs(var, high))} - {_m(antiderivative.subs(var, low))} = {_m(value)}$",
+        ))
+        answer = f"$\\int_{{{_m(low)}}}^{{{_m(high)}}} {_group(expr)} \\, d{v} = {_m(value)}$"
+        overview = "Find an antiderivative term by term with the power rule, then evaluate it at the upper and lower bounds."
+    return "integral", {"overview": overview, "steps": steps, "finalAnswer": answer}
+
+
+def _decimal(value):
+    # 3.5 + 1.25 is 4.75, not 19/4; values with no finite decimal keep their exact form
+    from sympy import factorint
+
+    if value.is_Rational and set(factorint(value.q)) <= {2, 5}:
+        return str(Decimal(value.p) / Decimal(value.q))
+    return _m(value)
+
+
+def _expression(expr, intent, raw):
+    from sympy import Float, Function, S, expand, factor, simplify
+
+    if not expr.free_symbols:
+        # Show the arithmetic as written, not parse_latex's evaluated tree
+        source = _m(raw)
+        value = simplify(expr.doit())
+        if not value.is_number or value.has(S.ComplexInfinity, S.NaN) or value.atoms(Function):
+            raise Unsupported("no closed-form value")
+        answer = _decimal(value) if raw.has(Float) else _m(value)
+        return "arithmetic", {
+            "overview": "Evaluate the expression, following the order of operations.",
+            "steps": [_step("Evaluate", f"${source} = {answer}$")],
+            "finalAnswer": f"${answer}$",
+        }
+    if intent not in ("simplify", "expand", "factor"):
+        raise Unsupported("no instruction for an expression with variables")
+
+    source = _m(expr)
+    result = {"expand": expand, "factor": factor, "simplify": simplify}[intent](expr)
+    verb = {"expand": "Expand", "factor": "Factor", "simplify": "Simplify"}[intent]
+    return intent, {
+        "overview": f"{verb} the expression using algebraic identities.",
+        "steps": [
+            _step("Write down the expression", f"${source}$"),
+            _step(verb, f"${source} = {_m(result)}$"),
+        ],
+        "finalAnswer": f"${_m(result)}$",
+    }
+
+
+# ----------------------------------------------------------------------
+#  Entry points
+# ----------------------------------------------------------------------
+def _parse(text):
+    """
+    Parses one LaTeX statement, keeping its floats.
+
+    Raises:
+        Unsupported: If it doesn't parse, or the parse doesn't round-trip to
+            the text (parse_latex joins `12 3` into 123).
+    """
+    from sympy.parsing.latex import parse_latex
+
+    if _UNQUALIFIED_LOG.search(text):
+        raise Unsupported("logarithm without a base")
+    try:
+        expr = parse_latex(text)
+    except Exception as e:
+        raise Unsupported(f"unparseable: {e}")
+    if not parse_round_trips(text, expr):
+        raise Unsupported("parse doesn't round-trip")
+    return expr
+
+
+def _rebuild(expr):
+    """
+    Re-creates parse_latex's unevaluated tree bottom up, so (x^3 - 4x) + 1 becomes
+    x^3 - 4x + 1. Derivatives and integrals stay unevaluated.
+    """
+    from sympy import Basic, S
+    from sympy.core.traversal import bottom_up
+
+    expr = bottom_up(_exact(expr), lambda e: e.func(*e.args) if e.args else e)
+    if not isinstance(expr, Basic) or expr.is_Boolean and not expr.is_Relational:
+        raise Unsupported("trivial statement")
+    if expr.has(S.ComplexInfinity, S.NaN, S.Infinity, S.NegativeInfinity):
+        raise Unsupported("division by zero")
+    return expr
+
+
+def _attempt(input_text):
+    from sympy import Derivative, Eq, Integral, Symbol
+    from sympy.core.relational import Relational
+
+    # Row breaks in cases/aligned separate equations; normalize_latex would fold them into spaces
+    text = normalize_latex(input_text.replace("\\\\", ","))
+    intent = None
+    for name, pattern in _INTENTS:
+        match = pattern.match(text)
+        if match:
+            intent, text = name, text[match.end():]
+            break
+    var = None
+    match = _RESPECT_TO.search(text)
+    if match:
+        var, text = Symbol(match.group(1)), text[:match.start()]
+    text = _CASES.sub(" ", text).strip().rstrip("?")
+    if not text or _PROSE.search(re.sub(r"\\[A-Za-z]+", "", text)):
+        raise Unsupported("prose")
+
+    parts = [part for part in _SYSTEM_SEPARATOR.split(text) if part.strip()]
+    if len(parts) > 1 and all("=" in part for part in parts):
+        equations = [_rebuild(_parse(part)) for part in parts]
+        if not all(isinstance(eq, Eq) for eq in equations):
+            raise Unsupported("not a system of equations")
+        return _system(equations)
+
+    raw = _parse(text)
+    expr = _rebuild(raw)
+    if isinstance(expr, Eq):
+        return _equation(expr)
+    if isinstance(expr, Relational):
+        raise Unsupported("inequality")
+    if isinstance(expr, Derivative):
+        if len(expr.variable_count) != 1 or expr.variable_count[0][1] != 1:
+            raise Unsupported("higher-order derivative")
+        return _derivative(expr.expr, expr.variables[0])
+    if isinstance(expr, Integral):
+        if len(expr.limits) != 1:
+            raise Unsupported("multiple integral")
+        limit = expr.limits[0]
+        return _integral(expr.function, limit[0], tuple(limit[1:]) if len(limit) == 3 else None)
+    if intent == "derivative":
+        return _derivative(expr, var or _single_variable(expr))
+    if intent == "integral":
+        return _integral(expr, var or _single_variable(expr))
+    return _expression(expr, intent, raw)
+
+
+def _run(input_text):
+    start = time.perf_counter()
+    try:
+        kind, solution = _attempt(input_text)
+    except Unsupported:
+        _count("unsupported")
+        return None
+    except Exception as e:
+        print("Symbolic solver error:", e)
+        _count("errors")
+        return None
+    _count("solved", time.perf_counter() - start, kind)
+    return solution
+
+
+def _submit(input_text):
+    if not SYMBOLIC_SOLVER:
+        return None
+    _count("attempts")
+    if not _slots.acquire(blocking=False):
+        # Every solver thread is still busy (possibly with a runaway simplify)
+        _count("busy")
+        return None
+    future = _executor.submit(_run, input_text)
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def warm_up():
+    """
+    Imports SymPy and builds the LaTeX parser in the background; the first
+    parse takes about a second, far over the per-request budget.
+    """
+    def run():
+        from sympy.parsing.latex import parse_latex
+
+        try:
+            parse_latex("x=1")
+        except Exception as e:
+            print("Symbolic solver unavailable:", e)
+
+    global _warmup_thread
+    if SYMBOLIC_SOLVER:
+        _warmup_thread = threading.Thread(target=run, name="symbolic-warmup", daemon=True)
+        _warmup_thread.start()
+
+
+def wait_warm_up(timeout=None):
+    """
+    Blocks until `warm_up` has finished. A process forked while it is still
+    importing SymPy inherits a half-initialized module that fails every import.
+    """
+    if _warmup_thread is not None:
+        _warmup_thread.join(timeout)
+
+
+def solve(input_text):
+    """
+    Solves a /solve-math problem locally when it is one of the supported shapes.
+
+    Args:
+        input_text: The `inputText` sent by the client.
+
+    Returns:
+        dict or None: A `math_solution` object, or None when the caller should
+            ask the model (unsupported problem, time budget exceeded or solver busy).
+    """
+    future = _submit(input_text)
+    if future is None:
+        return None
+    try:
+        with metrics.stage("symbolic"):
+            return future.result(timeout=SYMBOLIC_TIME_BUDGET_MS / 1000)
+    except FutureTimeoutError:
+        _count("timeouts")
+        return None
+
+
+async def solve_async(input_text):
+    """Same as `solve`, without blocking the event loop."""
+    future = _submit(input_text)
+    if future is None:
+        return None
+    try:
+        with metrics.stage("symbolic"):
+            return await asyncio.wait_for(asyncio.wrap_future(future), SYMBOLIC_TIME_BUDGET_MS / 1000)
+    except asyncio.TimeoutError:
+        _count("timeouts")
+        return None
+
+
+def _count(outcome, seconds=0.0, kind=None):
+    with _lock:
+        _counts[outcome] += 1
+        _counts["solvedSeconds"] += seconds
+        if kind:
+            _kinds[kind] = _kinds.get(kind, 0) + 1
+
+
+def stats():
+    """
+    Returns how many /solve-math problems were answered locally, by kind.
+    """
+    with _lock:
+        attempts, solved = _counts["attempts"], _counts["solved"]
+        report = {key: value for key, value in _counts.items() if key != "solvedSeconds"}
+        report.update({
+            "enabled": SYMBOLIC_SOLVER,
+            "timeBudgetMs": SYMBOLIC_TIME_BUDGET_MS,
+            "localRate": round(solved / attempts, 4) if attempts else 0.0,
+            "avgSolvedMs": round(1000 * _counts["solvedSeconds"] / solved, 2) if solved else 0.0,
+            "kinds": dict(_kinds),
+        })
+        return report
@@ -0,0 +1,295 @@
+"""
+Pool of long-lived Tesseract workers.
+
+`pytesseract.image_to_string` starts a new `tesseract` process for every call,
+writes the image to a temp file and reloads the language data, which is most
+of the /text latency on small images. Here each worker keeps one initialised
+Tesseract instance for the life of the process and receives images in memory.
+
+Backends, in order of preference:
+    tesserocr   the Cython binding, if installed
+    capi        libtesseract's C API through ctypes
+    subprocess  plain pytesseract, used when neither is available or neither
+                could be initialised
+
+Only the first two are persistent. The subprocess backend still starts a
+`tesseract` process per call, so it saves nothing on latency; the pool then
+only caps how many run at once (the pool size).
+"""
+import ctypes
+import ctypes.util
+import os
+import queue
+import threading
+import time
+
+# Tesseract parallelises a single page with OpenMP; with one instance per core
+# that only adds contention, so keep each instance single-threaded.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+PSM_AUTO = 3  # Same page segmentation as the tesseract command line default
+
+
+class _TesserocrWorker:
+    def __init__(self, lang):
+        import tesserocr
+
+        self.api = tesserocr.PyTessBaseAPI(lang=lang, psm=tesserocr.PSM.AUTO)
+
+    def image_to_string(self, image):
+        return self.recognize(image)[0]
+
+    def recognize(self, image):
+        self.api.SetImage(image)
+        try:
+            text = self.api.GetUTF8Text()
+            return text, list(self.api.AllWordConfidences())
+        finally:
+            self.api.Clear()
+
+    def close(self):
+        self.api.End()
+
+
+def _load_capi():
+    path = os.getenv("TESSERACT_LIB") or ctypes.util.find_library("tesseract")
+    if not path:
+        return None
+    lib = ctypes.CDLL(path)
+    handle = ctypes.c_void_p
+
+    lib.TessBaseAPICreate.restype = handle
+    lib.TessBaseAPIInit3.argtypes = [handle, ctypes.c_char_p, ctypes.c_char_p]
+    lib.TessBaseAPIInit3.restype = ctypes.c_int
+    lib.TessBaseAPISetPageSegMode.argtypes = [handle, ctypes.c_int]
+    lib.TessBaseAPISetImage.argtypes = [handle, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    lib.TessBaseAPISetSourceResolution.argtypes = [handle, ctypes.c_int]
+    lib.TessBaseAPIGetUTF8Text.argtypes = [handle]
+    lib.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+    lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+    lib.TessBaseAPIAllWordConfidences.argtypes = [handle]
+    lib.TessBaseAPIAllWordConfidences.restype = ctypes.POINTER(ctypes.c_int)
+    lib.TessDeleteIntArray.argtypes = [ctypes.POINTER(ctypes.c_int)]
+    lib.TessBaseAPIClear.argtypes = [handle]
+    lib.TessBaseAPIEnd.argtypes = [handle]
+    lib.TessBaseAPIDelete.argtypes = [handle]
+    return lib
+
+
+class _CapiWorker:
+    def __init__(self, lib, lang):
+        self.lib = lib
+        self.handle = lib.TessBaseAPICreate()
+        datapath = os.getenv("TESSDATA_PREFIX")
+        if lib.TessBaseAPIInit3(self.handle, datapath.encode() if datapath else None, lang.encode()) != 0:
+            lib.TessBaseAPIDelete(self.handle)
+            raise RuntimeError(f"Could not initialise Tesseract for language '{lang}'")
+        lib.TessBaseAPISetPageSegMode(self.handle, PSM_AUTO)
+
+    def image_to_string(self, image):
+        return self.recognize(image)[0]
+
+    def recognize(self, image):
+        if image.mode != "L":
+            image = image.convert("L")
+        width, height = image.size
+        pixels = image.tobytes()
+
+        lib = self.lib
+        lib.TessBaseAPISetImage(self.handle, pixels, width, height, 1, width)
+        lib.TessBaseAPISetSourceResolution(self.handle, int(image.info.get("dpi", (300,))[0]) or 300)
+        text_ptr = lib.TessBaseAPIGetUTF8Text(self.handle)
+        conf_ptr = None
+        try:
+            text = ctypes.string_at(text_ptr).decode("utf-8") if text_ptr else ""
+            # A -1 terminated array with one entry per recognized word
+            conf_ptr = lib.TessBaseAPIAllWordConfidences(self.handle)
+            confidences = []
+            if conf_ptr:
+                i = 0
+                while conf_ptr[i] != -1:
+                    confidences.append(conf_ptr[i])
+                    i += 1
+            return text, confidences
+        finally:
+            if text_ptr:
+                lib.TessDeleteText(text_ptr)
+            if conf_ptr:
+                lib.TessDeleteIntArray(conf_ptr)
+            lib.TessBaseAPIClear(self.handle)
+
+    def close(self):
+        self.lib.TessBaseAPIEnd(self.handle)
+        self.lib.TessBaseAPIDelete(self.handle)
+
+
+class _SubprocessWorker:
+    def __init__(self, lang):
+        import pytesseract
+
+        # If you're on Windows, point TESSERACT_CMD to the path where you installed Tesseract
+        pytesseract.pytesseract.tesseract_cmd = os.getenv("TESSERACT_CMD", "tesseract")
+        self.pytesseract = pytesseract
+        self.lang = lang
+
+    def image_to_string(self, image):
+        return self.pytesseract.image_to_string(image, lang=self.lang)
+
+    def recognize(self, image):
+        data = self.pytesseract.image_to_data(image, lang=self.lang, output_type=self.pytesseract.Output.DICT)
+        lines = []
+        current = None
+        confidences = []
+        for i, word in enumerate(data["text"]):
+            if not word.strip():
+                continue
+            line = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            if line != current:
+                lines.append([])
+                current = line
+            lines[-1].append(word)
+            confidences.append(int(float(data["conf"][i])))
+        return "\n".join(" ".join(words) for words in lines), confidences
+
+    def close(self):
+        pass
+
+
+def _start(make, size):
+    workers = []
+    try:
+        for _ in range(size):
+            workers.append(make())
+    except Exception:
+        for worker in workers:
+            worker.close()
+        raise
+    return workers
+
+
+def _make_workers(backend, size, lang):
+    # In "auto" mode a backend that fails to load or initialise (missing
+    # library or symbols, no traineddata for `lang`) falls through to the next
+    if backend in ("auto", "tesserocr"):
+        try:
+            return "tesserocr", _start(lambda: _TesserocrWorker(lang), size)
+        except Exception as e:
+            if backend == "tesserocr":
+                raise
+            if not isinstance(e, ImportError):
+                print(f"tesserocr backend unavailable, trying the next one: {e}")
+
+    if backend in ("auto", "capi"):
+        try:
+            lib = _load_capi()
+            if lib is None:
+                raise RuntimeError("libtesseract not found; set TESSERACT_LIB")
+            return "capi", _start(lambda: _CapiWorker(lib, lang), size)
+        except Exception as e:
+            if backend == "capi":
+                raise
+            print(f"Tesseract C API backend unavailable, using pytesseract subprocesses: {e}")
+
+    return "subprocess", [_SubprocessWorker(lang) for _ in range(size)]
+
+
+class TesseractPool:
+    """
+    Fixed-size pool of Tesseract workers with a drop-in `image_to_string`.
+
+    Args:
+        size: Number of workers. Defaults to the number of cores.
+        lang: Tesseract language code(s), e.g. "eng" or "eng+equ".
+        backend: "auto", "tesserocr", "capi" or "subprocess".
+    """
+
+    def __init__(self, size=None, lang="eng", backend="auto"):
+        size = size or os.cpu_count() or 1
+        self.backend, workers = _make_workers(backend, size, lang)
+        self.size = size
+        self._idle = queue.Queue()
+        for worker in workers:
+            self._idle.put(worker)
+
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.busy = 0
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _acquire(self, timeout):
+        with self._lock:
+            self.waiting += 1
+        start = time.perf_counter()
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No Tesseract worker became free in time")
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                self.wait_seconds += time.perf_counter() - start
+        with self._lock:
+            self.busy += 1
+        return worker
+
+    def _release(self, worker, elapsed, failed):
+        with self._lock:
+            self.busy -= 1
+            self.calls += 1
+            self.errors += failed
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+        self._idle.put(worker)
+
+    def run(self, method, image, timeout=None):
+        """
+        Runs `worker.<method>(image)` on the next free worker.
+
+        Args:
+            method: Name of the worker method to call.
+            image: A PIL image.
+            timeout: Seconds to wait for a free worker (None waits forever).
+        """
+        worker = self._acquire(timeout)
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = getattr(worker, method)(image)
+            failed = False
+            return result
+        finally:
+            self._release(worker, time.perf_counter() - start, failed)
+
+    def image_to_string(self, image, timeout=None):
+        return self.run("image_to_string", image, timeout)
+
+    def recognize(self, image, timeout=None):
+        """
+        Returns the recognized text and the confidence (0-100) of each word.
+        """
+        return self.run("recognize", image, timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "workers": self.size,
+                "busy": self.busy,
+                "queueDepth": self.waiting,
+                "calls": self.calls,
+                "errors": self.errors,
+                "avgMs": round(1000 * self.total_seconds / self.calls, 2) if self.calls else 0.0,
+                "maxMs": round(1000 * self.max_seconds, 2),
+                "avgWaitMs": round(1000 * self.wait_seconds / self.calls, 2) if self.calls else 0.0,
+            }
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The server modules are imported by name, as app.py and asgi.py do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
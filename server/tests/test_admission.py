@@ -0,0 +1,116 @@
+import ipaddress
+import threading
+import time
+
+import pytest
+
+import admission
+
+
+def _controller(**options):
+    settings = dict(rate=0, burst=1, concurrency=1, min_concurrency=1)
+    settings.update(options)
+    return admission.AdmissionController(**settings)
+
+
+def _wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_rate_limit_answers_429_with_retry_after():
+    controller = _controller(rate=0.01, burst=2, concurrency=8)
+    for _ in range(2):
+        controller.release(controller.acquire("/solve-math", "addr:a"))
+
+    with pytest.raises(admission.Rejected) as rejected:
+        controller.acquire("/solve-math", "addr:a")
+    assert rejected.value.status == 429
+    assert rejected.value.retry_after >= 60
+    # Other clients have their own bucket; jobs were charged when submitted
+    controller.release(controller.acquire("/solve-math", "addr:b"))
+    with admission.job():
+        controller.release(controller.acquire("/generate-quiz", "addr:a"))
+    assert controller.stats()["rateLimited"] == 1
+
+
+def test_full_queue_answers_503():
+    controller = _controller()
+    controller.queue_sizes["/solve-math"] = 0
+    ticket = controller.acquire("/solve-math", "addr:a")
+
+    with pytest.raises(admission.Rejected) as rejected:
+        controller.acquire("/solve-math", "addr:b")
+    assert rejected.value.status == 503
+    assert rejected.value.retry_after >= 1
+    controller.release(ticket)
+    controller.release(controller.acquire("/solve-math", "addr:b"))
+    assert controller.stats()["queueFull"] == 1
+
+
+def test_wait_past_the_class_limit_answers_503(monkeypatch):
+    monkeypatch.setitem(admission.MAX_WAIT, admission.INTERACTIVE, 0.05)
+    controller = _controller()
+    ticket = controller.acquire("/latex", "addr:a")
+
+    with pytest.raises(admission.Rejected) as rejected:
+        controller.acquire("/latex", "addr:b")
+    assert rejected.value.status == 503
+    controller.release(ticket)
+    assert controller.stats()["timedOut"] == 1
+    assert controller.stats()["inFlight"] == 0
+
+
+def test_interactive_requests_are_admitted_before_batch_ones():
+    controller = _controller()
+    ticket = controller.acquire("/solve-math", "addr:a")
+    order = []
+
+    def request(route, client):
+        held = controller.acquire(route, client)
+        order.append(route)
+        controller.release(held)
+
+    threads = []
+    for waiting, (route, client) in enumerate([("/generate-quiz", "addr:b"), ("/solve-math", "addr:c")], start=1):
+        threads.append(threading.Thread(target=request, args=(route, client)))
+        threads[-1].start()
+        _wait_until(lambda: controller.stats()["queued"] == waiting)
+
+    controller.release(ticket)
+    for thread in threads:
+        thread.join(5)
+    assert order == ["/solve-math", "/generate-quiz"]
+
+
+def test_upstream_429_backs_off_once_per_interval(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_BACKOFF", 0.5)
+    controller = _controller(concurrency=16, min_concurrency=3)
+
+    controller.observe_upstream(429)
+    controller.observe_upstream(429)
+    assert controller.limit == 8
+    assert controller.stats()["upstream429"] == 2
+
+    monkeypatch.setattr(admission, "ADMISSION_BACKOFF_INTERVAL", 0)
+    for _ in range(3):
+        controller.observe_upstream(429)
+    assert controller.limit == 3
+
+    # Successes raise it by 1/limit each
+    for _ in range(3):
+        controller.observe_upstream(200)
+    assert int(controller.limit) == 3 and controller.limit > 3.9
+    controller.observe_upstream(200)
+    assert int(controller.limit) == 4
+
+
+def test_client_key_trusts_only_configured_proxies(monkeypatch):
+    headers = {"X-Forwarded-For": "198.51.100.7, 10.0.0.5"}
+    assert admission.client_key(headers, "203.0.113.9") == "addr:203.0.113.9"
+
+    monkeypatch.setattr(admission, "ADMISSION_TRUSTED_PROXIES", [ipaddress.ip_network("10.0.0.0/8")])
+    assert admission.client_key(headers, "10.0.0.1") == "addr:198.51.100.7"
+    assert admission.client_key({}, "10.0.0.1") == "addr:10.0.0.1"
@@ -0,0 +1,86 @@
+import io
+import os
+
+import pytest
+from PIL import Image, ImageDraw
+
+import caching
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "p1.png")
+
+
+def _sample():
+    with open(SAMPLE, "rb") as f:
+        return f.read()
+
+
+def _encode(image_bytes, fmt, **options):
+    buffer = io.BytesIO()
+    image = Image.open(io.BytesIO(image_bytes))
+    (image.convert("RGB") if fmt == "JPEG" else image).save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def _other():
+    image = Image.new("RGB", (600, 300), "white")
+    ImageDraw.Draw(image).rectangle([50, 50, 300, 250], fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _images(mode, tmp_path=None):
+    disk = caching.SQLiteStore(str(tmp_path / "ocr.db")) if tmp_path else None
+    return caching.ImageCache(caching.TieredCache("ocr", caching.LRUCache(), disk), mode)
+
+
+def test_image_key_modes():
+    sample = _sample()
+    resaved = _encode(sample, "PNG")
+
+    assert caching.image_key(sample, "text") == caching.image_key(resaved, "text")
+    assert caching.image_key(sample, "text") != caching.image_key(sample, "latex")
+    assert caching.image_key(sample, "text") != caching.image_key(_other(), "text")
+    assert ":p:" in caching.image_key(sample, "text", "phash")
+
+
+def test_exact_mode_hits_on_bytes_then_pixels():
+    images = _images("exact")
+    sample = _sample()
+    value, keys = images.get(sample, "text")
+    assert value is None
+    images.set(keys, {"text": "x"})
+
+    assert images.get(sample, "text") == ({"text": "x"}, [keys[0]])
+    # Same pixels in a different file: found by the pixel key
+    assert images.get(_encode(sample, "PNG"), "text")[0] == {"text": "x"}
+    assert images.get(_encode(sample, "JPEG", quality=85), "text")[0] is None
+    assert images.get(sample, "latex")[0] is None
+    assert images.cache.stats()["misses"] == 3
+
+
+@pytest.mark.parametrize("quality", [95, 90, 85])
+def test_phash_mode_hits_on_reencoded_jpeg(quality):
+    images = _images("phash")
+    sample = _sample()
+    images.set(images.get(sample, "latex")[1], {"latex": "x"})
+
+    assert images.get(_encode(sample, "JPEG", quality=quality), "latex")[0] == {"latex": "x"}
+    assert images.get(_other(), "latex")[0] is None
+    assert images.get(_encode(sample, "JPEG", quality=quality), "text")[0] is None
+
+
+def test_phash_index_is_shared_through_the_disk_tier(tmp_path):
+    sample = _sample()
+    first = _images("phash", tmp_path)
+    first.set(first.get(sample, "latex")[1], {"latex": "x"})
+
+    # A second process: empty memory tier and band index, same SQLite file
+    second = _images("phash", tmp_path)
+    assert second.get(_encode(sample, "JPEG", quality=85), "latex")[0] == {"latex": "x"}
+    assert second.stats()["nearHits"] == 1
+
+
+def test_image_cache_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        _images("fuzzy")
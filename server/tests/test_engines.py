@@ -0,0 +1,43 @@
+import threading
+import time
+
+import engines
+
+
+def test_slow_load_does_not_block_other_engines():
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.5)
+        return "slow"
+
+    engines.register("test-slow", slow)
+    engines.register("test-fast", lambda: "fast")
+    loading = threading.Thread(target=engines.get, args=("test-slow",))
+    loading.start()
+    started.wait(2)
+
+    began = time.perf_counter()
+    assert engines.get("test-fast") == "fast"
+    assert time.perf_counter() - began < 0.25
+    loading.join(5)
+    assert engines.get("test-slow") == "slow"
+
+
+def test_concurrent_gets_load_an_engine_once():
+    loads = []
+
+    def loader():
+        loads.append(1)
+        time.sleep(0.05)
+        return object()
+
+    engines.register("test-once", loader)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(engines.get("test-once"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(loads) == 1 and len({id(result) for result in results}) == 1
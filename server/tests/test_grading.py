@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import grading
+
+
+def _item(answer, reference=None, options=None):
+    item = {"question": "Q", "answer": answer}
+    if reference is not None:
+        item["correctAnswer"] = reference
+    if options is not None:
+        item["options"] = options
+    return item
+
+
+@pytest.mark.parametrize("item, rule, score", [
+    (_item("Paris", "paris."), "exact", 5),
+    (_item("Na", "Na"), "exact", 5),
+    (_item("N/A", "N/A"), "exact", 5),
+    (_item("", "Paris"), "unanswered", 1),
+    (_item(None, "Paris"), "unanswered", 1),
+    (_item("Not Answered", "Paris"), "unanswered", 1),
+    (_item("I don't know", None), "unanswered", 1),
+    (_item("b", "Berlin", ["Paris", "Berlin", "Rome"]), "option", 5),
+    (_item("Rome", "Berlin", ["Paris", "Berlin", "Rome"]), "option", 1),
+    (_item("0.5", "1/2"), "math", 5),
+    (_item("x = 4", "x=4.0"), "math", 5),
+    (_item("Photosynthesis makes glucose from light", "photosynthesis make glucose from light"), "fuzzy", 5),
+])
+def test_local_grade_decides(item, rule, score):
+    decided = grading.local_grade(item)
+    assert decided is not None
+    assert (decided[0], decided[1]["score"]) == (rule, score)
+
+
+@pytest.mark.parametrize("item", [
+    _item("NA", "sodium (Na)"),
+    _item("9.8", "9.81"),
+    _item("3.14", "pi"),
+    _item("0.333", "1/3"),
+    _item("1798", "1789"),
+    _item("x = 4", "y = 4"),
+    _item("100 degrees", "10 degrees"),
+    _item("It is not soluble in water", "It is soluble in water"),
+    _item("Paris", None),
+])
+def test_local_grade_leaves_the_rest_to_the_model(item):
+    assert grading.local_grade(item) is None
+
+
+def _answers():
+    return [_item("Paris", "Paris"), _item("a guess", "Berlin"), _item(""), _item("another guess", "Rome")]
+
+
+def test_grade_sends_only_unresolved_answers_in_order():
+    sent = []
+
+    def grade_with_llm(chunk):
+        sent.extend(item["answer"] for item in chunk)
+        return [{"score": 3, "feedback": "Partly."} for _ in chunk]
+
+    results = grading.grade(_answers(), grade_with_llm)
+    assert sorted(sent) == ["a guess", "another guess"]
+    assert [result["score"] for result in results] == [5, 3, 1, 3]
+
+
+def test_agrade_marks_answers_it_cannot_grade():
+    async def grade_with_llm(chunk):
+        if any(item["answer"] == "a guess" for item in chunk):
+            raise RuntimeError("upstream failed")
+        return [{"score": 4, "feedback": "Good."} for _ in chunk]
+
+    results = asyncio.run(grading.agrade(_answers(), grade_with_llm))
+    assert [result["score"] for result in results] == [5, 0, 1, 4]
+    assert results[1]["feedback"] == grading.UNGRADED["feedback"]
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def store(tmp_path):
+    return jobs.JobStore(str(tmp_path / "jobs.db"))
+
+
+def test_same_key_and_payload_returns_the_existing_job(store):
+    job, created = store.create("solve-math", {"inputText": "x + 1 = 2"}, "key-1")
+    again, created_again = store.create("solve-math", {"inputText": "x + 1 = 2"}, "key-1")
+
+    assert created and not created_again
+    assert again["id"] == job["id"]
+    assert store.stats()["reused"] == 1
+
+
+def test_same_key_with_a_different_payload_is_rejected(store):
+    store.create("solve-math", {"inputText": "x + 1 = 2"}, "key-1")
+
+    with pytest.raises(jobs.JobError) as rejected:
+        store.create("solve-math", {"inputText": "x + 2 = 2"}, "key-1")
+    assert rejected.value.status == 422
+    with pytest.raises(jobs.JobError):
+        store.create("latex", {"inputText": "x + 1 = 2"}, "key-1")
+
+
+def test_without_a_key_every_submission_runs(store):
+    first, _ = store.create("solve-math", {"inputText": "x"})
+    second, created = store.create("solve-math", {"inputText": "x"})
+    assert created and second["id"] != first["id"]
+
+
+def test_an_expired_job_gives_up_its_key(tmp_path):
+    store = jobs.JobStore(str(tmp_path / "jobs.db"), ttl=0.05)
+    first, _ = store.create("solve-math", {"inputText": "x"}, "key-1")
+    time.sleep(0.1)
+
+    second, created = store.create("solve-math", {"inputText": "y"}, "key-1")
+    assert created and second["id"] != first["id"]
+
+
+def test_wait_returns_when_the_job_finishes(store):
+    job, _ = store.create("solve-math", {"inputText": "x"}, "key-1")
+    store.start(job["id"])
+    threading.Timer(0.05, store.finish, (job["id"], 200, {"finalAnswer": "x"}, 0.05)).start()
+
+    done = store.wait(job["id"], 5)
+    assert (done["status"], done["httpStatus"], done["result"]) == ("done", 200, {"finalAnswer": "x"})
+
+
+@pytest.mark.parametrize("data, message", [
+    (None, "Invalid input data"),
+    ({"route": "worksheet", "payload": {}}, "route must be"),
+    ({"route": "/solve-math", "payload": "x"}, "payload must be"),
+])
+def test_parse_submission_rejects_bad_bodies(data, message):
+    with pytest.raises(jobs.JobError, match=message) as rejected:
+        jobs.parse_submission(data, {})
+    assert rejected.value.status == 400
+
+
+def test_parse_submission_reads_the_key_and_forwarded_headers():
+    headers = {"Idempotency-Key": "key-1", "X-Client-Id": "student", "Authorization": "secret"}
+    assert jobs.parse_submission({"route": "/solve-math", "payload": {"inputText": "x"}}, headers) == (
+        "solve-math", {"inputText": "x"}, "key-1", {"X-Client-Id": "student"}
+    )
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+
+
+def _lines(prefix):
+    return [line for line in metrics.render().splitlines() if line.startswith(prefix)]
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, route='a"b')
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{route="a\\"b",le="0.1"} 1',
+        'test_seconds_bucket{route="a\\"b",le="1"} 3',
+        'test_seconds_bucket{route="a\\"b",le="+Inf"} 4',
+        'test_seconds_sum{route="a\\"b"} 4.25',
+        'test_seconds_count{route="a\\"b"} 4',
+    ]
+
+
+def test_stages_and_errors_are_attributed_to_the_current_request(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TRACE_RATE", 1.0)
+    state = metrics.begin("/test-route")
+    with metrics.stage("parse"):
+        pass
+    metrics.record_usage(SimpleNamespace(prompt_tokens=7, completion_tokens=3), "gpt-test")
+    metrics.end(state, 500, RuntimeError("boom"))
+
+    assert _lines('kord_stage_duration_seconds_count{route="/test-route",stage="parse"}') != []
+    assert _lines('kord_errors_total{route="/test-route",type="RuntimeError"} 1')
+    assert _lines('kord_upstream_tokens_total{route="/test-route",model="gpt-test",kind="prompt"} 7')
+    assert _lines('kord_requests_in_flight{route="/test-route"} 0')
+    trace = metrics.traces()[0]
+    assert (trace["route"], trace["tokens"], trace["error"]) == ("/test-route", 10, "RuntimeError")
+    assert [span["stage"] for span in trace["spans"]] == ["parse"]
+
+    metrics.observe_stage("refill", 0.01)
+    assert _lines('kord_stage_duration_seconds_count{route="background",stage="refill"}')
+
+
+def test_instrumented_client_counts_usage_and_upstream_errors():
+    def create(**kwargs):
+        if kwargs.get("fail"):
+            raise TimeoutError("slow")
+        return SimpleNamespace(usage=SimpleNamespace(prompt_tokens=5, completion_tokens=2))
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    metrics.instrument_openai(client)
+
+    state = metrics.begin("/test-upstream")
+    client.chat.completions.create(model="gpt-upstream")
+    with pytest.raises(TimeoutError):
+        client.chat.completions.create(model="gpt-upstream", fail=True)
+    metrics.end(state, 200)
+
+    assert _lines('kord_upstream_tokens_total{route="/test-upstream",model="gpt-upstream",kind="completion"} 2')
+    assert _lines('kord_upstream_errors_total{route="/test-upstream",type="TimeoutError"} 1')
+    assert _lines('kord_stage_duration_seconds_count{route="/test-upstream",stage="upstream"} 2')
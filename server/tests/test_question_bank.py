@@ -0,0 +1,62 @@
+import pytest
+
+import question_bank
+
+
+def _questions(count, start=0):
+    return [{"question": f"What is {i} + {i * 7}?", "correctAnswer": str(i * 8)} for i in range(start, start + count)]
+
+
+@pytest.fixture
+def bank(tmp_path):
+    return question_bank.QuestionBank(str(tmp_path / "bank.db"))
+
+
+def _texts(questions):
+    return {item["question"] for item in questions}
+
+
+def test_assemble_serves_half_a_quiz_until_the_bank_is_large(bank):
+    bank.add("Algebra", "Short Questions", "Easy", _questions(6))
+    assert len(bank.assemble("algebra!", "Short Questions", "easy", client_id="a")) == 2
+
+    bank.add("Algebra", "Short Questions", "Easy", _questions(20, start=6))
+    quiz = bank.assemble("Algebra", "Short Questions", "Easy", client_id="a")
+    assert len(quiz) == 5 and len(_texts(quiz)) == 5
+    assert bank.assemble("Algebra 2", "Short Questions", "Easy") == []
+    assert bank.assemble("Algebra", "MCQs", "Easy") == []
+
+
+def test_only_returned_questions_count_as_served(bank):
+    bank.add("Algebra", "Short Questions", "Easy", _questions(40))
+    first = bank.assemble("Algebra", "Short Questions", "Easy", client_id="a")
+    bank.record_served("a", "Short Questions", "Easy", first)
+    for _ in range(5):
+        again = bank.assemble("Algebra", "Short Questions", "Easy", client_id="a")
+        assert not _texts(again) & _texts(first)
+    assert len(bank.assemble("Algebra", "Short Questions", "Easy", client_id="b")) == 5
+
+
+def test_assemble_alone_records_nothing(bank):
+    bank.add("Algebra", "Short Questions", "Easy", _questions(6))
+    for _ in range(10):
+        assert len(bank.assemble("Algebra", "Short Questions", "Easy", client_id="a")) == 2
+
+
+def test_generated_questions_are_recorded_as_served(bank):
+    generated = _questions(6)
+    bank.add("Algebra", "Short Questions", "Easy", generated)
+    bank.record_served("a", "Short Questions", "easy", generated[:4] + [{"question": "Not in the bank"}])
+
+    for _ in range(5):
+        assert _texts(bank.assemble("Algebra", "Short Questions", "Easy", client_id="a")) <= _texts(generated[4:])
+
+
+def test_merge_skips_repeated_questions():
+    found = _questions(2)
+    quiz = question_bank.merge(found, [{"question": "what is 0 + 0"}] + _questions(3, start=2))
+    assert len(quiz) == 5 and quiz[:2] == found
+
+    short = question_bank.merge(found, [dict(found[1])] + _questions(2, start=2))
+    assert len(short) == 4
+    assert len(question_bank.merge(short, _questions(2, start=3))) == 5
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import worksheet
+
+
+@pytest.mark.parametrize("latex, problem", [
+    ("3. 3y - 5 = 10", "3y - 5 = 10"),
+    ("2) x^2 - 4 = 0", "x^2 - 4 = 0"),
+    ("(a) 2x + 3 = 7", "2x + 3 = 7"),
+    ("(iv)\\; x + 1 = 2", "x + 1 = 2"),
+    ("Q3 \\frac{d}{dx} x^3", "\\frac{d}{dx} x^3"),
+    ("Q.12: x - 1 = 0", "x - 1 = 0"),
+    ("\\textbf{4.}\\quad 5x = 10", "5x = 10"),
+    ("b.~\\sqrt{16}", "\\sqrt{16}"),
+    ("(b) -3x + 1 = 4", "-3x + 1 = 4"),
+])
+def test_strip_enumerator(latex, problem):
+    assert worksheet.strip_enumerator(latex) == problem
+
+
+@pytest.mark.parametrize("latex", [
+    "3.5x = 7",
+    "2x + 3 = 7",
+    "(x+1)(x-1)",
+    "\\frac{1}{2} + \\frac{1}{3}",
+    "12 + 30",
+    "3.",
+    "(x)(x+1)=0",
+    "(a)(a+2)=3",
+    "x.y=6",
+    "(x)=2",
+    "(x) = 2",
+    "(x) - 1 = 0",
+    "(2)(x+1)=0",
+])
+def test_strip_enumerator_keeps_problems(latex):
+    assert worksheet.strip_enumerator(latex) == latex
+
+
+def _regions(*latex):
+    return [{"index": i, "image": text, "box": [0, 0, 1, 1]} for i, text in enumerate(latex)]
+
+
+def test_pipeline_solves_without_problem_numbers():
+    solved = []
+
+    def solve(problem):
+        solved.append(problem)
+        return {"finalAnswer": problem}
+
+    regions = _regions("3. 3y - 5 = 10", "2) x^2 - 4 = 0")
+    events = list(worksheet.pipeline(regions, False, lambda image: {"latex": image}, solve))
+
+    assert sorted(solved) == ["3y - 5 = 10", "x^2 - 4 = 0"]
+    recognized = {p["index"]: p["latex"] for e, p in events if e == "recognized"}
+    assert recognized == {0: "3. 3y - 5 = 10", 1: "2) x^2 - 4 = 0"}
+    problems = {p["index"]: p["problem"] for e, p in events if e == "solved"}
+    assert problems == {0: "3y - 5 = 10", 1: "x^2 - 4 = 0"}
+
+
+def test_apipeline_solves_without_problem_numbers():
+    solved = []
+
+    async def recognize(image):
+        return {"latex": image}
+
+    async def solve(problem):
+        solved.append(problem)
+        return {"finalAnswer": problem}
+
+    async def run():
+        regions = _regions("(a) 2x + 3 = 7", "Q2 x + 1 = 2")
+        return [event async for event in worksheet.apipeline(regions, False, recognize, solve)]
+
+    events = asyncio.run(run())
+    assert sorted(solved) == ["2x + 3 = 7", "x + 1 = 2"]
+    assert events[-1][1]["solved"] == 2
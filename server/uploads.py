@@ -0,0 +1,128 @@
+"""
+Binary image uploads for the OCR routes.
+
+The JSON routes take a base64 `data:` URI, which is a third larger than the
+image and has to be buffered and parsed as one big string. The upload routes
+accept either `multipart/form-data` (field "image", or the first file) or a raw
+`image/*` body. Raw bodies are streamed in chunks into a spooled buffer that
+only moves to disk past UPLOAD_SPOOL_BYTES, and anything larger than
+MAX_UPLOAD_BYTES is rejected as early as possible: from Content-Length before
+reading, or as soon as a chunked body crosses the limit.
+"""
+import os
+import tempfile
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """
+    Raised for uploads that can't be accepted; carries the HTTP status to return.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def check_content_length(content_length, max_bytes=MAX_UPLOAD_BYTES):
+    if content_length is not None and int(content_length) > max_bytes:
+        raise UploadError(f"Upload exceeds the {max_bytes} byte limit", 413)
+
+
+def _spooled_read(chunks, max_bytes):
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES) as spool:
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadError(f"Upload exceeds the {max_bytes} byte limit", 413)
+            spool.write(chunk)
+        if total == 0:
+            raise UploadError("Empty upload")
+        spool.seek(0)
+        return spool.read()
+
+
+def _raw_image_type(content_type):
+    mimetype = (content_type or "").split(";", 1)[0].strip().lower()
+    if mimetype == "application/octet-stream":
+        return "image/jpeg"
+    if not mimetype.startswith("image/"):
+        raise UploadError("Expected multipart/form-data or an image/* body", 415)
+    return mimetype
+
+
+def read_flask_upload(request, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Reads an image upload from a Flask request.
+
+    Returns:
+        tuple: (image bytes, mimetype)
+
+    Raises:
+        UploadError: For missing, oversized or unsupported uploads.
+    """
+    check_content_length(request.content_length, max_bytes)
+
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("image") or next(iter(request.files.values()), None)
+        if upload is None:
+            raise UploadError("Missing image file")
+        data = _spooled_read(iter(lambda: upload.stream.read(CHUNK_SIZE), b""), max_bytes)
+        return data, upload.mimetype or "image/jpeg"
+
+    mimetype = _raw_image_type(request.content_type)
+    data = _spooled_read(iter(lambda: request.stream.read(CHUNK_SIZE), b""), max_bytes)
+    return data, mimetype
+
+
+async def read_asgi_upload(request, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Reads an image upload from a Starlette/FastAPI request.
+
+    Returns:
+        tuple: (image bytes, mimetype)
+
+    Raises:
+        UploadError: For missing, oversized or unsupported uploads.
+    """
+    check_content_length(request.headers.get("content-length"), max_bytes)
+    content_type = request.headers.get("content-type", "")
+
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            upload = next((v for v in form.values() if not isinstance(v, str)), None)
+        if upload is None:
+            raise UploadError("Missing image file")
+        data = await upload.read()
+        await upload.close()
+        if len(data) > max_bytes:
+            raise UploadError(f"Upload exceeds the {max_bytes} byte limit", 413)
+        if not data:
+            raise UploadError("Empty upload")
+        return data, upload.content_type or "image/jpeg"
+
+    mimetype = _raw_image_type(content_type)
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES) as spool:
+        total = 0
+        async for chunk in request.stream():
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadError(f"Upload exceeds the {max_bytes} byte limit", 413)
+            spool.write(chunk)
+        if total == 0:
+            raise UploadError("Empty upload")
+        spool.seek(0)
+        return spool.read(), mimetype
+
+
+def to_data_uri(image_data, mimetype):
+    """Encodes image bytes as the `data:` URI the vision API expects."""
+    import base64
+
+    return f"data:{mimetype};base64," + base64.b64encode(image_data).decode("ascii")
@@ -0,0 +1,206 @@
+"""
+Shrinks scans before they are sent to the GPT-4o vision API.
+
+With "detail": "high" the API bills 85 tokens plus 170 per 512px tile of the
+image after it has been fitted into 2048x2048 and its shortest side reduced to
+768px, and the whole file is uploaded first. Phone photos of a single equation
+are mostly empty paper, so `optimize_for_vision`:
+
+    1. deskews the scan and crops it to the ink bounding box (plus a margin),
+    2. measures the median glyph height and scales the crop down until glyphs
+       are VISION_MIN_GLYPH_PX tall, or further if the API would shrink it
+       more than that anyway,
+    3. switches to "detail": "low" (a flat 85 tokens) when the result fits a
+       single 512x512 tile, and
+    4. re-encodes as a grayscale JPEG.
+
+The returned report carries the token estimate before and after.
+"""
+import math
+import os
+import threading
+
+VISION_MIN_GLYPH_PX = float(os.getenv("VISION_MIN_GLYPH_PX", "20"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+VISION_MAX_SKEW = float(os.getenv("VISION_MAX_SKEW", "10"))
+VISION_MARGIN = float(os.getenv("VISION_MARGIN", "0.03"))
+
+# Analysis (thresholding, component stats) runs on a copy no larger than this
+_ANALYSIS_SIDE = 1600
+_TILE = 512
+
+_stats_lock = threading.Lock()
+_totals = {"requests": 0, "tokensBefore": 0, "tokensAfter": 0, "bytesBefore": 0, "bytesAfter": 0}
+
+
+def openai_scale(width, height):
+    """
+    Returns the factor the vision API itself resizes a "high" detail image by.
+    """
+    fit = min(1.0, 2048 / max(width, height))
+    shortest = min(width, height) * fit
+    return fit * min(1.0, 768 / shortest) if shortest else fit
+
+
+def image_tokens(width, height, detail="high"):
+    """
+    Estimates the prompt tokens GPT-4o charges for an image.
+    """
+    if detail == "low":
+        return 85
+    scale = openai_scale(width, height)
+    tiles = math.ceil(width * scale / _TILE) * math.ceil(height * scale / _TILE)
+    return 85 + 170 * tiles
+
+
+def _analyze(gray):
+    import cv2
+
+    height, width = gray.shape
+    factor = min(1.0, _ANALYSIS_SIDE / max(height, width))
+    small = gray
+    if factor < 1:
+        small = cv2.resize(gray, (round(width * factor), round(height * factor)), interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (3, 3), 0)
+    _, ink = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return factor, ink, cv2.findNonZero(ink)
+
+
+def _skew_angle(points):
+    import cv2
+
+    angle = cv2.minAreaRect(points)[-1]
+    # OpenCV >= 4.5 reports angles in (0, 90]; older versions in [-90, 0)
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    return angle
+
+
+def median_glyph_height(ink):
+    """Returns the median height in pixels of the glyphs in a binary ink mask, or None."""
+    import cv2
+    import numpy as np
+
+    count, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    if count <= 1:
+        return None
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    # Drop specks and anything taller than half the crop (rules, borders, shadows)
+    keep = (areas >= 4) & (heights < ink.shape[0] / 2)
+    if not keep.any():
+        return None
+    return float(np.median(heights[keep]))
+
+
+def optimize_for_vision(image_data, min_glyph_px=VISION_MIN_GLYPH_PX, jpeg_quality=VISION_JPEG_QUALITY):
+    """
+    Crops, deskews, resizes and re-encodes an image for the vision API.
+
+    Args:
+        image_data: The encoded image bytes.
+        min_glyph_px: Median glyph height to keep after all resizing.
+        jpeg_quality: Quality of the re-encoded JPEG.
+
+    Returns:
+        tuple: (image bytes, mimetype, detail, report). When nothing can be
+            saved the original bytes are returned with "high" detail.
+    """
+    import cv2
+    import numpy as np
+
+    gray = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Could not decode image")
+    orig_h, orig_w = gray.shape
+    tokens_before = image_tokens(orig_w, orig_h)
+    report = {
+        "originalSize": [orig_w, orig_h],
+        "originalBytes": len(image_data),
+        "originalTokens": tokens_before,
+        "skewDegrees": 0.0,
+    }
+
+    factor, ink, points = _analyze(gray)
+    if points is None:
+        # Blank page, nothing to crop to
+        return _unchanged(image_data, report)
+
+    angle = _skew_angle(points)
+    if 0.5 <= abs(angle) <= VISION_MAX_SKEW:
+        center = (orig_w / 2, orig_h / 2)
+        matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+        gray = cv2.warpAffine(gray, matrix, (orig_w, orig_h), flags=cv2.INTER_LINEAR, borderValue=255)
+        factor, ink, points = _analyze(gray)
+        report["skewDegrees"] = round(angle, 2)
+
+    # Crop to the ink, in full-resolution coordinates
+    x, y, w, h = cv2.boundingRect(points)
+    margin = VISION_MARGIN * max(w, h)
+    x0 = max(0, int((x - margin) / factor))
+    y0 = max(0, int((y - margin) / factor))
+    x1 = min(orig_w, int(math.ceil((x + w + margin) / factor)))
+    y1 = min(orig_h, int(math.ceil((y + h + margin) / factor)))
+    crop = gray[y0:y1, x0:x1]
+    crop_h, crop_w = crop.shape
+
+    glyph = median_glyph_height(ink[y:y + h, x:x + w])
+    legible = min(1.0, min_glyph_px / (glyph / factor)) if glyph else 1.0
+    # Anything larger than what the API would shrink it to anyway is wasted upload
+    scale = min(legible, openai_scale(crop_w, crop_h))
+
+    out_w, out_h = max(1, round(crop_w * scale)), max(1, round(crop_h * scale))
+    if scale < 1:
+        crop = cv2.resize(crop, (out_w, out_h), interpolation=cv2.INTER_AREA)
+
+    detail = "low" if out_w <= _TILE and out_h <= _TILE else "high"
+    tokens_after = image_tokens(out_w, out_h, detail)
+
+    ok, encoded = cv2.imencode(".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    if not ok:
+        raise ValueError("Could not encode optimized image")
+    optimized = encoded.tobytes()
+
+    if tokens_after >= tokens_before and len(optimized) >= len(image_data):
+        return _unchanged(image_data, report)
+
+    report.update({
+        "optimizedSize": [out_w, out_h],
+        "optimizedBytes": len(optimized),
+        "optimizedTokens": tokens_after,
+        "tokensSaved": tokens_before - tokens_after,
+        "glyphPx": round(glyph / factor, 1) if glyph else None,
+        "detail": detail,
+    })
+    _record(report)
+    return optimized, "image/jpeg", detail, report
+
+
+def _unchanged(image_data, report):
+    report.update({
+        "optimizedBytes": len(image_data),
+        "optimizedTokens": report["originalTokens"],
+        "tokensSaved": 0,
+        "detail": "high",
+    })
+    _record(report)
+    return image_data, None, "high", report
+
+
+def _record(report):
+    with _stats_lock:
+        _totals["requests"] += 1
+        _totals["tokensBefore"] += report["originalTokens"]
+        _totals["tokensAfter"] += report["optimizedTokens"]
+        _totals["bytesBefore"] += report["originalBytes"]
+        _totals["bytesAfter"] += report["optimizedBytes"]
+
+
+def stats():
+    """
+    Returns the running totals of tokens and bytes before/after optimization.
+    """
+    with _stats_lock:
+        return dict(_totals, tokensSaved=_totals["tokensBefore"] - _totals["tokensAfter"])
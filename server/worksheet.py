@@ -0,0 +1,309 @@
+"""
+Worksheet batches: one photo of a page in, one solution per problem out.
+
+`segment` splits the page into problem regions. The ink is thresholded and
+dilated sideways by WORKSHEET_WORD_GAP median glyph heights, which merges
+the symbols of each line. The lines are then dilated downwards by
+WORKSHEET_LINE_GAP median line heights, so the lines of one problem (and the
+parts of a fraction) merge while the wider gaps between problems don't. Each
+resulting blob is one problem, in reading order.
+
+`pipeline` (threads) and `apipeline` (asyncio) then recognize the regions
+and solve each problem as soon as its LaTeX is known, with at most
+WORKSHEET_OCR_CONCURRENCY regions in OCR and WORKSHEET_SOLVE_CONCURRENCY
+problems in the solver at a time. The problem number printed in front of a
+problem ("3.", "2)", "(a)", "Q3") is stripped before it is solved, so the
+solver and the cache key only see the math. Events are yielded in completion
+order:
+
+    segmented   {"problems": n, "truncated": bool, "boxes": [[x, y, w, h], ...]}
+    recognized  {"index": i, "latex": ..., "source": ...}
+    solved      {"index": i, "problem": ..., "solution": {...}}
+    error       {"index": i, "stage": "ocr" | "solve", "error": ...}
+    done        {"problems": n, "solved": k, "elapsedMs": ...}
+"""
+import asyncio
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import imaging
+import vision
+
+WORKSHEET_MAX_PROBLEMS = int(os.getenv("WORKSHEET_MAX_PROBLEMS", "30"))
+WORKSHEET_OCR_CONCURRENCY = int(os.getenv("WORKSHEET_OCR_CONCURRENCY", "4"))
+WORKSHEET_SOLVE_CONCURRENCY = int(os.getenv("WORKSHEET_SOLVE_CONCURRENCY", "4"))
+WORKSHEET_WORD_GAP = float(os.getenv("WORKSHEET_WORD_GAP", "3.0"))
+WORKSHEET_LINE_GAP = float(os.getenv("WORKSHEET_LINE_GAP", "0.75"))
+
+# Segmentation runs on a copy of the page reduced to this size
+_ANALYSIS_SIDE = 1600
+# Blobs smaller than this many glyph heights (specks, stray marks) are dropped
+_MIN_BLOB = 0.8
+
+# "3.", "2)", "(a)", "(iv)", "Q3:", optionally in \textbf{...}, and the spacing after it.
+# A dot followed by a digit is a decimal (3.5x = 7), not a problem number. A letter
+# is only an enumerator when spacing follows it ("(x)(x+1)=0" and "x.y=6" are math),
+# and nothing counts as one when an operator, "=" or "(" comes next ("(x) = 2").
+_SPACING = r"(?:\s|~|\\[,;:! ]|\\q?quad(?![A-Za-z]))"
+_ENUMERATOR = re.compile(
+    r"^\s*(?:\\(?:textbf|text|mathrm|mathbf)\s*\{)?\s*(?:"
+    r"(?:\(\s*\d{1,3}\s*\)|\d{1,3}\s*[.)](?!\d)|Q\s*\.?\s*\d{1,3}\s*[.):]?)\s*\}?" + _SPACING + "*"
+    r"|(?:\(\s*(?:[a-z]|[ivx]{1,4})\s*\)|[a-z]\s*[.)])\s*\}?" + _SPACING + "+"
+    r")(?![\s~=+*/^<>(]|-\s|\\[,;:! ]|\\q?quad(?![A-Za-z]))",
+    re.IGNORECASE,
+)
+
+_lock = threading.Lock()
+_counts = {"pages": 0, "problems": 0, "solved": 0, "errors": 0, "segmentSeconds": 0.0, "pageSeconds": 0.0}
+
+
+def _merge_overlapping(boxes):
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                ax, ay, aw, ah = boxes[i]
+                bx, by, bw, bh = boxes[j]
+                if ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah:
+                    x, y = min(ax, bx), min(ay, by)
+                    boxes[i] = (x, y, max(ax + aw, bx + bw) - x, max(ay + ah, by + bh) - y)
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def _median_line_height(lines, glyph):
+    import cv2
+    import numpy as np
+
+    count, _, stats, _ = cv2.connectedComponentsWithStats(lines, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT][stats[1:, cv2.CC_STAT_WIDTH] >= 2 * glyph]
+    return float(np.median(heights)) if len(heights) else 2 * glyph
+
+
+def segment(image_data, max_problems=WORKSHEET_MAX_PROBLEMS):
+    """
+    Splits a worksheet photo into one image per problem.
+
+    Args:
+        image_data: The encoded page image.
+        max_problems: Regions beyond this many (in reading order) are dropped.
+
+    Returns:
+        tuple: (list of {"index", "box", "image"} dicts with PNG bytes and
+            [x, y, w, h] boxes in page pixels, True if regions were dropped).
+
+    Raises:
+        ValueError: If the image can't be decoded.
+    """
+    import cv2
+    import numpy as np
+
+    started = time.perf_counter()
+    gray = imaging.decode_grayscale(image_data)
+    height, width = gray.shape
+    factor = min(1.0, _ANALYSIS_SIDE / max(height, width))
+    small = gray
+    if factor < 1:
+        small = cv2.resize(gray, (round(width * factor), round(height * factor)), interpolation=cv2.INTER_AREA)
+    small = cv2.GaussianBlur(small, (3, 3), 0)
+    _, ink = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+
+    glyph = vision.median_glyph_height(ink) or 20.0
+    lines = cv2.dilate(ink, cv2.getStructuringElement(cv2.MORPH_RECT, (max(1, round(glyph * WORKSHEET_WORD_GAP)), 1)))
+    line_height = _median_line_height(lines, glyph)
+    # Anchored at the bottom, so each line reaches down towards the next one only
+    gap = max(1, round(line_height * WORKSHEET_LINE_GAP))
+    blobs = cv2.dilate(lines, np.ones((gap + 1, 1), np.uint8), anchor=(0, gap))
+    contours, _ = cv2.findContours(blobs, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = [
+        box for box in map(cv2.boundingRect, contours)
+        if box[3] >= glyph * _MIN_BLOB and box[2] >= glyph * _MIN_BLOB
+    ]
+    boxes = _merge_overlapping(boxes)
+    # Reading order: rows of about two glyphs, then left to right
+    boxes.sort(key=lambda box: (round(box[1] / (2 * glyph)), box[0]))
+    truncated = len(boxes) > max_problems
+    boxes = boxes[:max_problems]
+
+    # Crop the full-size page, with a little margin around the ink
+    pad = round(glyph / 2)
+    regions = []
+    for index, (x, y, w, h) in enumerate(boxes):
+        # The downward dilation added `gap` rows below the last line
+        h = max(1, h - gap)
+        x0, y0 = max(0, int((x - pad) / factor)), max(0, int((y - pad) / factor))
+        x1, y1 = min(width, int((x + w + pad) / factor) + 1), min(height, int((y + h + pad) / factor) + 1)
+        ok, encoded = cv2.imencode(".png", gray[y0:y1, x0:x1])
+        if ok:
+            regions.append({"index": index, "box": [x0, y0, x1 - x0, y1 - y0], "image": encoded.tobytes()})
+
+    with _lock:
+        _counts["pages"] += 1
+        _counts["problems"] += len(regions)
+        _counts["segmentSeconds"] += time.perf_counter() - started
+    return regions, truncated
+
+
+def strip_enumerator(latex):
+    """
+    Removes the problem number in front of a recognized problem.
+
+    Args:
+        latex: The LaTeX recognized for one region, e.g. "3. 3y - 5 = 10".
+
+    Returns:
+        str: The problem without its number, e.g. "3y - 5 = 10". Text that is
+        only a number is returned unchanged.
+    """
+    stripped = _ENUMERATOR.sub("", latex, count=1).strip()
+    return stripped or latex
+
+
+def _segmented(regions, truncated):
+    return "segmented", {"problems": len(regions), "truncated": truncated, "boxes": [r["box"] for r in regions]}
+
+
+def _done(regions, solved, started):
+    elapsed = time.perf_counter() - started
+    with _lock:
+        _counts["solved"] += solved
+        _counts["errors"] += len(regions) - solved
+        _counts["pageSeconds"] += elapsed
+    return "done", {"problems": len(regions), "solved": solved, "elapsedMs": round(1000 * elapsed, 1)}
+
+
+def pipeline(regions, truncated, recognize, solve):
+    """
+    Recognizes and solves the regions on two bounded thread pools.
+
+    Args:
+        regions: The output of `segment`.
+        truncated: Whether `segment` dropped regions.
+        recognize: Callable (image bytes) -> {"latex": ..., "source": ...}.
+        solve: Callable (problem text) -> solution dict.
+
+    Yields:
+        tuple: (event name, payload), in completion order.
+    """
+    started = time.perf_counter()
+    yield _segmented(regions, truncated)
+    if not regions:
+        yield _done(regions, 0, started)
+        return
+
+    events = queue.Queue()
+    ocr_pool = ThreadPoolExecutor(max_workers=WORKSHEET_OCR_CONCURRENCY, thread_name_prefix="worksheet-ocr")
+    solve_pool = ThreadPoolExecutor(max_workers=WORKSHEET_SOLVE_CONCURRENCY, thread_name_prefix="worksheet-solve")
+
+    def solve_one(index, latex):
+        problem = strip_enumerator(latex)
+        try:
+            events.put(("solved", {"index": index, "problem": problem, "solution": solve(problem)}))
+        except Exception as e:
+            events.put(("error", {"index": index, "stage": "solve", "error": str(e)}))
+
+    def recognize_one(region):
+        index = region["index"]
+        try:
+            result = recognize(region["image"])
+            latex = (result.get("latex") or "").strip()
+            if not latex:
+                raise ValueError("No problem recognized in this region")
+        except Exception as e:
+            events.put(("error", {"index": index, "stage": "ocr", "error": str(e)}))
+            return
+        events.put(("recognized", {"index": index, "latex": latex, "source": result.get("source")}))
+        # Straight into the solver, without waiting for the other regions
+        solve_pool.submit(solve_one, index, latex)
+
+    try:
+        for region in regions:
+            ocr_pool.submit(recognize_one, region)
+        finished = solved = 0
+        while finished < len(regions):
+            event, payload = events.get()
+            if event in ("solved", "error"):
+                finished += 1
+                solved += event == "solved"
+            yield event, payload
+        yield _done(regions, solved, started)
+    finally:
+        # A client that disconnects early leaves the queued work to be dropped
+        ocr_pool.shutdown(wait=False, cancel_futures=True)
+        solve_pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def apipeline(regions, truncated, recognize, solve):
+    """
+    Async counterpart of `pipeline`: `recognize` and `solve` are coroutine
+    functions and each stage is bounded by a semaphore.
+    """
+    started = time.perf_counter()
+    yield _segmented(regions, truncated)
+    if not regions:
+        yield _done(regions, 0, started)
+        return
+
+    events = asyncio.Queue()
+    ocr_slots = asyncio.Semaphore(WORKSHEET_OCR_CONCURRENCY)
+    solve_slots = asyncio.Semaphore(WORKSHEET_SOLVE_CONCURRENCY)
+
+    async def process(region):
+        index = region["index"]
+        try:
+            async with ocr_slots:
+                result = await recognize(region["image"])
+            latex = (result.get("latex") or "").strip()
+            if not latex:
+                raise ValueError("No problem recognized in this region")
+        except Exception as e:
+            await events.put(("error", {"index": index, "stage": "ocr", "error": str(e)}))
+            return
+        await events.put(("recognized", {"index": index, "latex": latex, "source": result.get("source")}))
+        problem = strip_enumerator(latex)
+        try:
+            async with solve_slots:
+                solution = await solve(problem)
+            await events.put(("solved", {"index": index, "problem": problem, "solution": solution}))
+        except Exception as e:
+            await events.put(("error", {"index": index, "stage": "solve", "error": str(e)}))
+
+    tasks = [asyncio.create_task(process(region)) for region in regions]
+    try:
+        finished = solved = 0
+        while finished < len(regions):
+            event, payload = await events.get()
+            if event in ("solved", "error"):
+                finished += 1
+                solved += event == "solved"
+            yield event, payload
+        yield _done(regions, solved, started)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def stats():
+    """
+    Returns page and problem counts and the average segmentation and page times.
+    """
+    with _lock:
+        pages, problems = _counts["pages"], _counts["problems"]
+        return {
+            "pages": pages,
+            "problems": problems,
+            "solved": _counts["solved"],
+            "errors": _counts["errors"],
+            "avgSegmentMs": round(1000 * _counts["segmentSeconds"] / pages, 2) if pages else 0.0,
+            "avgPageMs": round(1000 * _counts["pageSeconds"] / pages, 2) if pages else 0.0,
+        }
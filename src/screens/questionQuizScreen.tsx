@@ -18,6 +18,7 @@ import { SERVER_END_POINT } from '@/constants';
 
 // Define the structure of a single question
 type Question = {
+  id?: string;
   question: string;
 };
 
@@ -87,6 +88,8 @@ const QuestionQuizScreen = () => {
     const answersPayload = quizData.map((question, index) => ({
       question: question.question,
       answer: userAnswers[index] || 'Not Answered',
+      // The server grades against the answer key it stored under this id
+      id: question.id,
     }));
 
     try {